@@ -0,0 +1,166 @@
+#!/usr/bin/env python3
+
+# This file is part of cron-wrap.
+#
+# cron-wrap is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# cron-wrap is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with cron-wrap.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Measures the latency of sending failure reports with the Mailer, over SMTP
+to a local server, both reusing one session and connecting for every
+report, and with a fake sendmail script which reads the message and exits.
+The local server accepts and discards everything, so this is the cost on
+the cwrap side of formatting and handing over the reports.
+"""
+
+from argparse import ArgumentParser
+import json
+import os
+import shutil
+import socketserver
+import statistics
+import sys
+import tempfile
+import threading
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(
+    __file__))))
+import cwrap
+
+FAKE_SENDMAIL = '#!/bin/sh\ncat > /dev/null\n'
+
+
+class SmtpHandler(socketserver.StreamRequestHandler):
+    """
+    Just enough of an SMTP server to accept mail from smtplib
+    """
+    def reply(self, *lines):
+        # One write for all the lines, so Nagle's algorithm doesn't hold
+        # back a multiline reply
+        self.wfile.write(''.join(l + '\r\n' for l in lines).encode('ascii'))
+
+    def handle(self):
+        self.reply('220 localhost bench SMTP')
+        while True:
+            line = self.rfile.readline()
+            if not line:
+                return
+            verb = line[:4].upper()
+            if verb == b'EHLO':
+                self.reply('250-localhost', '250-8BITMIME', '250 SIZE 0')
+            elif verb == b'DATA':
+                self.reply('354 End data with <CR><LF>.<CR><LF>')
+                for line in self.rfile:
+                    if line == b'.\r\n':
+                        break
+                self.reply('250 OK')
+            elif verb == b'QUIT':
+                self.reply('221 Bye')
+                return
+            else:
+                self.reply('250 OK')
+
+
+class SmtpServer(socketserver.ThreadingMixIn, socketserver.TCPServer):
+    allow_reuse_address = True
+    daemon_threads = True
+
+
+def getOpts():
+    p = ArgumentParser(description=__doc__)
+    p.add_argument('-s', '--size', type=int, action='append', default=[],
+        help='A report size in KB to test, can be specified multiple times '
+        '[default: 1, 100, 1024]')
+    p.add_argument('-i', '--iterations', type=int, default=20,
+        help='The number of reports to send for each case '
+        '[default: %(default)s]')
+    p.add_argument('-j', '--json', default=False, action='store_true',
+        help='Print the results as JSON [default: %(default)s]')
+    opts = p.parse_args()
+    if not opts.size:
+        opts.size = [1, 100, 1024]
+    return opts
+
+
+def makeReport(size):
+    line = 'x' * 70 + '\n'
+    return ''.join('%08d %s' % (i, line) for i in range(size * 1024 // 80))
+
+
+def timeSends(opts, report, iterations, reuse):
+    """
+    Returns the median time to format and send the report in seconds
+    """
+    times = []
+    mailer = cwrap.Mailer(opts)
+    try:
+        for i in range(iterations):
+            t = time.perf_counter()
+            mailer.send(opts.mailFrom, opts.mailRecips, cwrap.formatEmail(
+                opts.mailFrom, opts.mailRecips, opts.mailSubject, report,
+                opts.emailAttach))
+            if not reuse:
+                mailer.close()
+            times.append(time.perf_counter() - t)
+    finally:
+        mailer.close()
+    return statistics.median(times)
+
+
+def main():
+    bOpts = getOpts()
+    tmpDir = tempfile.mkdtemp(prefix='cwrap-bench-')
+    server = SmtpServer(('127.0.0.1', 0), SmtpHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    sendmail = os.path.join(tmpDir, 'sendmail')
+    with open(sendmail, 'w') as fh:
+        fh.write(FAKE_SENDMAIL)
+    os.chmod(sendmail, 0o755)
+    results = []
+    try:
+        opts = cwrap.getOpts(['-d', tmpDir, '-M', '-R', 'bench@localhost',
+            '-X', '127.0.0.1', '-T', str(server.server_address[1]),
+            'true'])[0]
+        for size in bOpts.size:
+            report = makeReport(size)
+            for mode in ('smtp-reuse', 'smtp-connect', 'sendmail'):
+                for attach in (False, True):
+                    opts.emailAttach = attach
+                    opts.smtpServer = '' if mode == 'sendmail' else \
+                        '127.0.0.1'
+                    opts.sendmail = sendmail
+                    sec = timeSends(opts, report, bOpts.iterations,
+                        mode == 'smtp-reuse')
+                    results.append({
+                        'mode': mode,
+                        'attach': attach,
+                        'size_kb': size,
+                        'send_ms': sec * 1000,
+                    })
+    finally:
+        server.shutdown()
+        server.server_close()
+        shutil.rmtree(tmpDir)
+    if bOpts.json:
+        print(json.dumps(results, indent=2))
+    else:
+        print('%-13s %-7s %8s %10s' % ('mode', 'attach', 'size KB',
+            'send ms'))
+        for r in results:
+            print('%-13s %-7s %8d %10.3f' % (r['mode'], r['attach'],
+                r['size_kb'], r['send_ms']))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,319 @@
+#!/usr/bin/env python3
+
+# This file is part of cron-wrap.
+#
+# cron-wrap is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# cron-wrap is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with cron-wrap.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Exercises the webhook, unix and jsonl notifiers against a local HTTP
+server, a datagram socket and a temp file.  For each number of failures,
+the failures are queued with notify() and the time to flush() them is
+measured, and what was received is checked: every failure arrives once,
+with its job, failure count, exit code and output, in batches of at most
+the batch size.  Each notifier is then flushed to a target which never
+takes the data, and it is checked that it gives up after its timeout.
+The exit code is 1 if any check fails.
+"""
+
+from argparse import ArgumentParser
+import fcntl
+import http.server
+import json
+import os
+import shutil
+import socket
+import sys
+import tempfile
+import threading
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(
+    __file__))))
+import cwrap
+
+NOTIFIERS = ('webhook', 'unix', 'jsonl')
+# The timeout of the notifiers for the timeout check, and how much longer
+# than it giving up may take
+TIMEOUT = 0.2
+TIMEOUT_SLACK = 1.0
+
+
+class WebhookHandler(http.server.BaseHTTPRequestHandler):
+    """
+    Keeps the body of each POST, or never answers if the server is stalled
+    """
+    def do_POST(self):
+        body = self.rfile.read(int(self.headers['Content-Length']))
+        if self.server.stalled:
+            self.server.release.wait()
+            return
+        self.server.posts.append(json.loads(body.decode('utf-8')))
+        self.send_response(204)
+        self.end_headers()
+
+    def log_message(self, *args):
+        pass
+
+
+class WebhookServer(http.server.ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, stalled=False):
+        http.server.ThreadingHTTPServer.__init__(self, ('127.0.0.1', 0),
+            WebhookHandler)
+        self.stalled = stalled
+        self.release = threading.Event()
+        self.posts = []
+
+
+class Target(object):
+    """
+    A place for a notifier to send to, which can return the batches it got
+    """
+    def __init__(self, name, tmpDir, stalled=False):
+        self.name = name
+        self._server = None
+        self._sock = None
+        self._lockFd = None
+        if name == 'webhook':
+            self._server = WebhookServer(stalled)
+            threading.Thread(target=self._server.serve_forever,
+                daemon=True).start()
+            self.target = 'http://127.0.0.1:%d/events' % \
+                self._server.server_address[1]
+        elif name == 'unix':
+            self.target = os.path.join(tmpDir, 'notify.sock')
+            if os.path.exists(self.target):
+                os.unlink(self.target)
+            self._sock = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+            self._sock.bind(self.target)
+            self._datagrams = []
+            if not stalled:
+                # The queue of a socket is short, so it's read as the
+                # batches arrive, as a listener would
+                threading.Thread(target=self._receive, daemon=True).start()
+            else:
+                # Fill the socket's queue so the next send blocks
+                filler = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+                filler.setblocking(False)
+                try:
+                    while True:
+                        filler.sendto(b'x' * 1024, self.target)
+                except BlockingIOError:
+                    pass
+                finally:
+                    filler.close()
+        else:
+            self.target = os.path.join(tmpDir, 'notify.jsonl')
+            with open(self.target, 'w'):
+                pass
+            if stalled:
+                # Another writer holding the lock
+                self._lockFd = os.open(self.target, os.O_WRONLY)
+                fcntl.flock(self._lockFd, fcntl.LOCK_EX)
+
+    def _receive(self):
+        while True:
+            try:
+                self._datagrams.append(self._sock.recv(1 << 20))
+            except OSError:
+                return
+
+    def getBatches(self):
+        """
+        Returns the batches received, as lists of events.  The lines of the
+        jsonl file are returned as a single batch.
+        """
+        if self._server is not None:
+            return list(self._server.posts)
+        if self._sock is not None:
+            # Wait for the receiver to catch up
+            numDatagrams = -1
+            while numDatagrams != len(self._datagrams):
+                numDatagrams = len(self._datagrams)
+                time.sleep(0.05)
+            return [json.loads(d) for d in self._datagrams]
+        with open(self.target) as fh:
+            return [[json.loads(line) for line in fh]]
+
+    def close(self):
+        if self._server is not None:
+            self._server.release.set()
+            self._server.shutdown()
+            self._server.server_close()
+        if self._sock is not None:
+            # Wakes up the receiver with an error
+            self._sock.shutdown(socket.SHUT_RDWR)
+            self._sock.close()
+            os.unlink(self.target)
+        if self._lockFd is not None:
+            os.close(self._lockFd)
+
+
+def getOpts():
+    p = ArgumentParser(description=__doc__)
+    p.add_argument('-e', '--events', type=int, action='append', default=[],
+        help='A number of failures to notify, can be specified multiple '
+        'times [default: 1, 100, 1000]')
+    p.add_argument('-b', '--batch', type=int, default=50,
+        help='The batch size of the notifiers [default: %(default)s]')
+    p.add_argument('-n', '--notifier', action='append', default=[],
+        choices=NOTIFIERS,
+        help='A notifier to test, can be specified multiple times '
+        '[default: all of them]')
+    p.add_argument('-j', '--json', default=False, action='store_true',
+        help='Print the results as JSON [default: %(default)s]')
+    opts = p.parse_args()
+    if not opts.events:
+        opts.events = [1, 100, 1000]
+    if not opts.notifier:
+        opts.notifier = list(NOTIFIERS)
+    return opts
+
+
+def checkBatches(name, batches, comSt, numEvents, batchSize):
+    """
+    Returns a list of the problems with the batches received
+    """
+    errs = []
+    events = [e for b in batches for e in b]
+    if len(events) != numEvents:
+        errs.append('got %d events instead of %d' % (len(events), numEvents))
+    if name != 'jsonl':
+        # The lines of the file don't show the batches
+        numBatches = -(-numEvents // batchSize)
+        if len(batches) != numBatches:
+            errs.append('got %d batches instead of %d' % (len(batches),
+                numBatches))
+        if any(len(b) > batchSize for b in batches):
+            errs.append('a batch is larger than %d' % batchSize)
+    job = os.path.basename(cwrap.StateFile.getStateFileName(comSt.opts,
+        comSt.cmdList))
+    for i, e in enumerate(events):
+        fail = e.get('failure', {})
+        expected = {
+            'host': socket.gethostname(),
+            'job': job,
+            'numFails': i + 1,
+            'report': False,
+        }
+        got = dict((k, e.get(k)) for k in expected)
+        if got != expected:
+            errs.append('event %d is %r instead of %r' % (i, got, expected))
+            break
+        if fail.get('exitCode') != 3 or fail.get('stdout') != 'out %d\n' % i \
+                or fail.get('command') != comSt.cmdList:
+            errs.append('event %d has the wrong failure: %r' % (i, fail))
+            break
+    return errs
+
+
+def notifyAll(notifier, comSt, numEvents):
+    for i in range(numEvents):
+        fail = cwrap.Failure(comSt.cmdList, time.time(), 0.5, 3,
+            'out %d\n' % i, 'err %d\n' % i)
+        comSt.failCount = i + 1
+        notifier.notify(comSt, fail, None)
+
+
+def runCase(name, opts, comSt, numEvents, batchSize, tmpDir):
+    target = Target(name, tmpDir)
+    try:
+        notifier = cwrap.NOTIFIERS[name](opts, target.target,
+            batch=batchSize)
+        notifyAll(notifier, comSt, numEvents)
+        t = time.perf_counter()
+        notifier.flush()
+        sec = time.perf_counter() - t
+        errs = checkBatches(name, target.getBatches(), comSt, numEvents,
+            batchSize)
+    finally:
+        target.close()
+    return {
+        'notifier': name,
+        'events': numEvents,
+        'flush_ms': sec * 1000,
+        'per_event_us': sec / numEvents * 1e6,
+        'errors': errs,
+    }
+
+
+def runTimeout(name, opts, comSt, tmpDir):
+    """
+    Returns the seconds the notifier took to give up on a stalled target
+    and the problems found
+    """
+    target = Target(name, tmpDir, True)
+    errs = []
+    try:
+        notifier = cwrap.NOTIFIERS[name](opts, target.target,
+            timeout=TIMEOUT)
+        notifyAll(notifier, comSt, 1)
+        t = time.perf_counter()
+        try:
+            notifier.flush()
+            errs.append('the flush to a stalled target succeeded')
+        except OSError:
+            pass
+        sec = time.perf_counter() - t
+    finally:
+        target.close()
+    if not TIMEOUT <= sec + 0.01 <= TIMEOUT + TIMEOUT_SLACK:
+        errs.append('gave up after %.3f seconds with a timeout of %g' % (sec,
+            TIMEOUT))
+    return (sec, errs)
+
+
+def main():
+    bOpts = getOpts()
+    tmpDir = tempfile.mkdtemp(prefix='cwrap-bench-')
+    results = []
+    try:
+        cmdList = ['/usr/local/bin/nightly-etl', '--all']
+        opts = cwrap.getOpts(['-d', tmpDir, '--no-config-cache'] +
+            cmdList)[0]
+        comSt = cwrap.CommandState(opts, cmdList)
+        for name in bOpts.notifier:
+            for numEvents in bOpts.events:
+                results.append(runCase(name, opts, comSt, numEvents,
+                    bOpts.batch, tmpDir))
+            sec, errs = runTimeout(name, opts, comSt, tmpDir)
+            results.append({
+                'notifier': name,
+                'check': 'timeout',
+                'gave_up_s': sec,
+                'errors': errs,
+            })
+    finally:
+        shutil.rmtree(tmpDir)
+    if bOpts.json:
+        print(json.dumps(results, indent=2))
+    else:
+        print('%-8s %8s %10s %14s  %s' % ('notifier', 'events', 'flush ms',
+            'per event us', 'check'))
+        for r in results:
+            if 'check' in r:
+                print('%-8s %8s %10s %14s  %s' % (r['notifier'], '-', '-',
+                    '-', 'gave up after %.3f s' % r['gave_up_s']))
+            else:
+                print('%-8s %8d %10.3f %14.1f' % (r['notifier'], r['events'],
+                    r['flush_ms'], r['per_event_us']))
+            for err in r['errors']:
+                print('  FAILED: %s' % err)
+    if any(r['errors'] for r in results):
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,108 @@
+#!/usr/bin/env python3
+
+# This file is part of cron-wrap.
+#
+# cron-wrap is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# cron-wrap is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with cron-wrap.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Measures the end to end overhead of wrapping a command with cwrap, the
+median wall clock time of "python3 -m cwrap CMD" minus that of running CMD
+directly, for each state backend and for a succeeding and a failing
+command.  The failing command is run below the report threshold, so the
+overhead is that of recording the failure, not of printing a report.
+"""
+
+from argparse import ArgumentParser
+import json
+import os
+import shutil
+import statistics
+import subprocess as sp
+import sys
+import tempfile
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+BACKENDS = ('pickle', 'binary', 'log', 'sqlite')
+
+
+def getOpts():
+    p = ArgumentParser(description=__doc__)
+    p.add_argument('-n', '--iterations', type=int, default=20,
+        help='The number of runs to take the median of '
+        '[default: %(default)s]')
+    p.add_argument('-b', '--backend', action='append', default=[],
+        choices=BACKENDS,
+        help='A state backend to test, can be specified multiple times '
+        '[default: all of them]')
+    p.add_argument('-j', '--json', default=False, action='store_true',
+        help='Print the results as JSON [default: %(default)s]')
+    opts = p.parse_args()
+    if not opts.backend:
+        opts.backend = list(BACKENDS)
+    return opts
+
+
+def timeCmd(cmd, iterations, env):
+    times = []
+    for i in range(iterations):
+        t = time.perf_counter()
+        sp.run(cmd, stdout=sp.DEVNULL, stderr=sp.DEVNULL, env=env, cwd=ROOT)
+        times.append(time.perf_counter() - t)
+    return statistics.median(times) * 1000
+
+
+def main():
+    bOpts = getOpts()
+    tmpDir = tempfile.mkdtemp(prefix='cwrap-bench-')
+    env = dict(os.environ)
+    # Let cwrap use and write cached bytecode, as an installed module does
+    env.pop('PYTHONDONTWRITEBYTECODE', None)
+    py = sys.executable
+    results = []
+    try:
+        for name, cmd in (('success', ['true']), ('failure', ['false'])):
+            direct = timeCmd(cmd, bOpts.iterations, env)
+            for backend in bOpts.backend:
+                stateDir = os.path.join(tmpDir, backend)
+                os.mkdir(stateDir)
+                wrapped = [py, '-m', 'cwrap', '-d', stateDir,
+                    '--state-backend', backend, '-n', '1000000'] + cmd
+                # Warm up the cached bytecode, the config cache and the
+                # state
+                sp.run(wrapped, env=env, cwd=ROOT, stdout=sp.DEVNULL)
+                total = timeCmd(wrapped, bOpts.iterations, env)
+                results.append({
+                    'command': name,
+                    'backend': backend,
+                    'direct_ms': direct,
+                    'total_ms': total,
+                    'overhead_ms': total - direct,
+                })
+                shutil.rmtree(stateDir)
+    finally:
+        shutil.rmtree(tmpDir)
+    if bOpts.json:
+        print(json.dumps(results, indent=2))
+    else:
+        print('%-8s %-8s %10s %10s %12s' % ('command', 'backend',
+            'direct ms', 'total ms', 'overhead ms'))
+        for r in results:
+            print('%-8s %-8s %10.2f %10.2f %12.2f' % (r['command'],
+                r['backend'], r['direct_ms'], r['total_ms'],
+                r['overhead_ms']))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,225 @@
+#!/usr/bin/env python3
+
+# This file is part of cron-wrap.
+#
+# cron-wrap is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# cron-wrap is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with cron-wrap.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Exercises the "--overlap" policies with real, overlapping cwrap runs of a
+job which sleeps.  For the replace policy, isRunOf() is timed and checked
+against a run of the job started as a script, one started with
+"python3 -m cwrap", a batch run of it and a process which isn't cwrap but
+has the state file open, and each run is then replaced.  For the queue
+policy, a run is started, several more are queued while it runs, and it
+is checked that they are done by exactly one more run and that the
+request is gone.  The exit code is 1 if any check fails.
+"""
+
+from argparse import ArgumentParser
+import json
+import os
+import shutil
+import subprocess as sp
+import sys
+import tempfile
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+import cwrap
+
+# How long the job's command runs, and how long to let a run start up
+JOB_SECS = 2
+START_SECS = 0.5
+
+
+def getOpts():
+    p = ArgumentParser(description=__doc__)
+    p.add_argument('-i', '--iterations', type=int, default=1000,
+        help='The number of isRunOf() calls to time [default: %(default)s]')
+    p.add_argument('-q', '--queued', type=int, default=3,
+        help='The number of runs to queue [default: %(default)s]')
+    p.add_argument('-b', '--backend', action='append', default=[],
+        choices=sorted(cwrap.STATE_BACKENDS),
+        help='A state backend to use, can be specified multiple times '
+        '[default: pickle]')
+    p.add_argument('-j', '--json', default=False, action='store_true',
+        help='Print the results as JSON [default: %(default)s]')
+    opts = p.parse_args()
+    if not opts.backend:
+        opts.backend = ['pickle']
+    return opts
+
+
+class Job(object):
+    """
+    A job whose runs append a line to a file, so they can be counted
+    """
+    def __init__(self, tmpDir, backend, policy):
+        self.tmpDir = tmpDir
+        self.runsName = os.path.join(tmpDir, 'runs')
+        self.args = ['-d', tmpDir, '--state-backend', backend, '--overlap',
+            policy, '--no-config-cache']
+        self.cmdList = ['sh', '-c', 'echo run >> %s; sleep %d' % (
+            self.runsName, JOB_SECS)]
+        self.opts = cwrap.getOpts(self.args + self.cmdList)[0]
+        self.stFName = cwrap.StateFile.getStateFileName(self.opts,
+            self.cmdList)
+
+    def start(self, mode='script'):
+        if mode == 'module':
+            argv = [sys.executable, '-m', 'cwrap']
+        elif mode == 'batch':
+            batchName = os.path.join(self.tmpDir, 'batch')
+            with open(batchName, 'w') as fh:
+                fh.write("sh -c '%s'\n" % self.cmdList[2])
+            return sp.Popen([sys.executable, os.path.join(ROOT, 'cwrap.py')] +
+                self.args + ['--batch', batchName], cwd=ROOT)
+        else:
+            argv = [sys.executable, os.path.join(ROOT, 'cwrap.py')]
+        return sp.Popen(argv + self.args + self.cmdList, cwd=ROOT)
+
+    def getPaths(self):
+        paths = [self.stFName, '%s.lock' % self.stFName]
+        if self.opts.stateBackend == 'sqlite':
+            paths.append(cwrap.SqliteStateFile.getDbName(self.opts))
+        return paths
+
+    def getNumRuns(self):
+        try:
+            with open(self.runsName) as fh:
+                return len(fh.read().split())
+        except FileNotFoundError:
+            return 0
+
+    def hasQueuedRun(self):
+        return os.path.exists('%s.queued' % self.stFName)
+
+
+def checkReplace(tmpDir, backend, mode, iterations):
+    """
+    Starts a run of the job, checks whether isRunOf() takes it for one and
+    then starts a run which replaces it
+    """
+    errs = []
+    job = Job(tmpDir, backend, 'replace')
+    if mode == 'other':
+        # Not cwrap, but it has the state file open
+        open(job.stFName, 'a').close()
+        first = sp.Popen([sys.executable, '-c', 'import time; fh = open(%r); '
+            'time.sleep(%d)' % (job.stFName, JOB_SECS)])
+    else:
+        first = job.start(mode)
+    try:
+        time.sleep(START_SECS)
+        paths = job.getPaths()
+        t = time.perf_counter()
+        for i in range(iterations):
+            isRun = cwrap.isRunOf(first.pid, paths)
+        sec = time.perf_counter() - t
+        expected = mode in ('script', 'module')
+        if isRun != expected:
+            errs.append('isRunOf() is %s for a %s run' % (isRun, mode))
+        if expected:
+            rc = job.start().wait()
+            if rc != 0:
+                errs.append('the replacing run exited with %d' % rc)
+            if first.poll() is None:
+                errs.append('the %s run was not replaced' % mode)
+            if job.getNumRuns() != 2:
+                errs.append('%d runs instead of 2' % job.getNumRuns())
+    finally:
+        if first.poll() is None:
+            first.terminate()
+        first.wait()
+    return {
+        'backend': backend,
+        'check': 'replace',
+        'mode': mode,
+        'is_run_of_us': sec / iterations * 1e6,
+        'errors': errs,
+    }
+
+
+def checkQueue(tmpDir, backend, numQueued):
+    """
+    Starts a run of the job and queues runs while it runs
+    """
+    errs = []
+    job = Job(tmpDir, backend, 'queue')
+    first = job.start()
+    try:
+        time.sleep(START_SECS)
+        t = time.perf_counter()
+        queued = [job.start() for i in range(numQueued)]
+        rcs = [p.wait() for p in queued]
+        sec = time.perf_counter() - t
+        if any(rcs):
+            errs.append('the queued runs exited with %r' % rcs)
+        if first.wait() != 0:
+            errs.append('the first run exited with %d' % first.returncode)
+    finally:
+        if first.poll() is None:
+            first.terminate()
+            first.wait()
+    if job.getNumRuns() != 2:
+        errs.append('%d runs for %d queued instead of 2' % (job.getNumRuns(),
+            numQueued))
+    if job.hasQueuedRun():
+        errs.append('the queued run request was left behind')
+    return {
+        'backend': backend,
+        'check': 'queue',
+        'queued': numQueued,
+        'queue_ms': sec / numQueued * 1000,
+        'errors': errs,
+    }
+
+
+def main():
+    bOpts = getOpts()
+    results = []
+    for backend in bOpts.backend:
+        cases = [('replace', m) for m in ('script', 'module', 'batch',
+            'other')] + [('queue', None)]
+        for check, mode in cases:
+            tmpDir = tempfile.mkdtemp(prefix='cwrap-bench-')
+            try:
+                if check == 'replace':
+                    results.append(checkReplace(tmpDir, backend, mode,
+                        bOpts.iterations))
+                else:
+                    results.append(checkQueue(tmpDir, backend,
+                        bOpts.queued))
+            finally:
+                shutil.rmtree(tmpDir)
+    if bOpts.json:
+        print(json.dumps(results, indent=2))
+    else:
+        print('%-8s %-8s %-8s %s' % ('backend', 'check', 'mode', 'time'))
+        for r in results:
+            if r['check'] == 'replace':
+                print('%-8s %-8s %-8s %.1f us per isRunOf()' % (r['backend'],
+                    r['check'], r['mode'], r['is_run_of_us']))
+            else:
+                print('%-8s %-8s %-8s %.1f ms per queued run' % (
+                    r['backend'], r['check'], '-', r['queue_ms']))
+            for err in r['errors']:
+                print('  FAILED: %s' % err)
+    if any(r['errors'] for r in results):
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,206 @@
+#!/usr/bin/env python3
+
+# This file is part of cron-wrap.
+#
+# cron-wrap is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# cron-wrap is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with cron-wrap.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Runs all the benchmarks and writes their results as one JSON document,
+along with the python version, platform and git revision they were run on.
+If a baseline, the output of an earlier run, is given, every time (the
+"_ms" results) which is slower than in the baseline by more than the
+tolerance is listed and the exit code is 1.  It's also 1 if a benchmark
+fails, which includes it exiting with an error, like the startup benchmark
+going over its budget, even if it printed its results.
+"""
+
+from argparse import ArgumentParser
+import json
+import os
+import platform
+import subprocess as sp
+import sys
+import time
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+ROOT = os.path.dirname(BENCH_DIR)
+
+# The benchmarks, with the arguments for a quicker, less precise run
+BENCHMARKS = (
+    ('startup', ['-n', '5']),
+    ('overhead', ['-n', '5']),
+    ('state_file', ['-i', '5', '-f', '0', '-f', '100']),
+    ('state_codec', ['-i', '5', '-f', '10', '-f', '100']),
+    ('status_scan', ['-j', '200']),
+    ('run_output', ['-i', '1', '-s', '1', '-s', '16']),
+    ('mail', ['-i', '5', '-s', '1', '-s', '100']),
+    ('spawn', ['-n', '50']),
+    ('notifiers', ['-e', '1', '-e', '100']),
+    ('overlap', ['-i', '100']),
+)
+
+# The numeric results which name a case rather than measure it, the other
+# names are the strings
+CASE_KEYS = ('fails', 'size_mb', 'size_kb', 'attach', 'events', 'queued')
+
+
+def getOpts():
+    p = ArgumentParser(description=__doc__)
+    p.add_argument('-b', '--bench', action='append', default=[],
+        choices=[b for b, q in BENCHMARKS],
+        help='A benchmark to run, can be specified multiple times '
+        '[default: all of them]')
+    p.add_argument('-q', '--quick', default=False, action='store_true',
+        help='Run fewer iterations and smaller cases [default: %(default)s]')
+    p.add_argument('-o', '--output', default=None, metavar='FILE',
+        help='Write the results to FILE instead of stdout')
+    p.add_argument('-B', '--baseline', default=None, metavar='FILE',
+        help='The results of an earlier run to compare the times to')
+    p.add_argument('-t', '--tolerance', type=float, default=0.25,
+        help='The fraction by which a time can be slower than the baseline '
+        'before it is a regression [default: %(default)s]')
+    p.add_argument('-m', '--min-delta', dest='minDelta', type=float,
+        default=0.1, metavar='MS',
+        help='Ignore slowdowns of less than this many milliseconds, which '
+        'are noise [default: %(default)s]')
+    return p.parse_args()
+
+
+def getRevision():
+    try:
+        p = sp.run(['git', 'describe', '--always', '--dirty'], cwd=ROOT,
+            stdout=sp.PIPE, stderr=sp.DEVNULL)
+    except OSError:
+        return None
+    return p.stdout.decode('utf-8').strip() or None
+
+
+def runBench(name, args):
+    """
+    Returns the results of the benchmark, or None if it printed none, and
+    its exit code
+    """
+    cmd = [sys.executable, os.path.join(BENCH_DIR, '%s.py' % name),
+        '--json'] + args
+    print('Running %s' % ' '.join(cmd[1:]), file=sys.stderr)
+    p = sp.run(cmd, stdout=sp.PIPE, cwd=ROOT)
+    if p.returncode != 0:
+        print('%s failed with exit code %d' % (name, p.returncode),
+            file=sys.stderr)
+    try:
+        return (json.loads(p.stdout.decode('utf-8')), p.returncode)
+    except ValueError:
+        return (None, p.returncode)
+
+
+def flatten(result, prefix=''):
+    """
+    Returns a dict of the times in the result of a benchmark by a key made
+    of the names of the case, e.g. "binary/100/file/load_ms"
+    """
+    times = {}
+    if isinstance(result, list):
+        for r in result:
+            times.update(flatten(r, prefix))
+    elif isinstance(result, dict):
+        names = [str(v) for k, v in sorted(result.items())
+            if isinstance(v, str) or k in CASE_KEYS]
+        if names:
+            prefix = '%s%s/' % (prefix, '/'.join(names))
+        for k, v in sorted(result.items()):
+            if isinstance(v, (dict, list)):
+                times.update(flatten(v, '%s%s/' % (prefix, k)))
+            elif k.endswith('_ms') and isinstance(v, (int, float)):
+                times[prefix + k] = v
+    return times
+
+
+def getErrors(result):
+    """
+    Returns the errors of the checks some benchmarks make, listed in their
+    "errors" results
+    """
+    errors = []
+    if isinstance(result, list):
+        for r in result:
+            errors.extend(getErrors(r))
+    elif isinstance(result, dict):
+        for k, v in sorted(result.items()):
+            if k == 'errors' and isinstance(v, list):
+                errors.extend(v)
+            else:
+                errors.extend(getErrors(v))
+    return errors
+
+
+def compare(results, baseline, tolerance, minDelta):
+    """
+    Returns a list of (benchmark, case, baseline ms, ms) of the regressions
+    """
+    regressions = []
+    for name, result in sorted(results.items()):
+        old = flatten(baseline.get(name))
+        for case, ms in sorted(flatten(result).items()):
+            if case not in old:
+                continue
+            if ms > old[case] * (1 + tolerance) and \
+                    ms - old[case] >= minDelta:
+                regressions.append((name, case, old[case], ms))
+    return regressions
+
+
+def main():
+    bOpts = getOpts()
+    results = {}
+    failed = []
+    for name, quickArgs in BENCHMARKS:
+        if bOpts.bench and name not in bOpts.bench:
+            continue
+        results[name], rc = runBench(name, quickArgs if bOpts.quick else [])
+        if rc != 0:
+            failed.append(name)
+    doc = {
+        'time': time.time(),
+        'revision': getRevision(),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'quick': bOpts.quick,
+        'results': results,
+    }
+    data = json.dumps(doc, indent=2)
+    if bOpts.output:
+        with open(bOpts.output, 'w') as fh:
+            fh.write(data + '\n')
+    else:
+        print(data)
+    for name, result in sorted(results.items()):
+        for err in getErrors(result):
+            print('CHECK FAILED %s: %s' % (name, err), file=sys.stderr)
+            if name not in failed:
+                failed.append(name)
+    regressions = []
+    if bOpts.baseline:
+        with open(bOpts.baseline) as fh:
+            baseline = json.load(fh)
+        regressions = compare(results, baseline['results'],
+            bOpts.tolerance, bOpts.minDelta)
+        for name, case, old, ms in regressions:
+            print('REGRESSION %s %s: %.3f ms -> %.3f ms (%+.0f%%)' % (name,
+                case, old, ms, (ms / old - 1) * 100 if old else 0),
+                file=sys.stderr)
+    sys.exit(1 if failed or regressions else 0)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,131 @@
+#!/usr/bin/env python3
+
+# This file is part of cron-wrap.
+#
+# cron-wrap is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# cron-wrap is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with cron-wrap.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Measures the throughput and memory use of CommandState.run() capturing
+commands with large output, for a succeeding command and for a failing one,
+whose output is stored and printed in a report.  Each case is run in a new
+process so its peak RSS, less that of a run with no output, is the memory
+used by capturing and reporting the output.
+"""
+
+from argparse import ArgumentParser
+import json
+import os
+import resource
+import shutil
+import statistics
+import subprocess as sp
+import sys
+import tempfile
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+MB = 1024 * 1024
+
+
+def getOpts():
+    p = ArgumentParser(description=__doc__)
+    p.add_argument('-s', '--size', type=int, action='append', default=[],
+        help='An output size in MB to test, can be specified multiple times '
+        '[default: 1, 16, 64]')
+    p.add_argument('-c', '--capture-limit', dest='captureLimit', type=int,
+        default=0, help='The --capture-limit to run with in bytes '
+        '[default: %(default)s]')
+    p.add_argument('-i', '--iterations', type=int, default=3,
+        help='The number of runs to take the median time of '
+        '[default: %(default)s]')
+    p.add_argument('-j', '--json', default=False, action='store_true',
+        help='Print the results as JSON [default: %(default)s]')
+    # Runs a single case, used by main()
+    p.add_argument('--child', nargs=3, metavar=('STATE_DIR', 'MB', 'EXIT'),
+        default=None, help='Run a single case and print its results as JSON')
+    opts = p.parse_args()
+    if not opts.size:
+        opts.size = [1, 16, 64]
+    return opts
+
+
+def runChild(bOpts):
+    """
+    Runs the command once and prints the run time and peak RSS as JSON
+    """
+    sys.path.insert(0, ROOT)
+    import cwrap
+    stateDir, size, exitCode = bOpts.child
+    # Lines of text, like a log, which is what compresses and is decoded
+    cmd = 'yes "%s" | head -c %d; exit %s' % ('x' * 79, int(size) * MB,
+        exitCode)
+    cmdList = ['sh', '-c', cmd]
+    opts = cwrap.getOpts(['-d', stateDir, '--capture-limit',
+        str(bOpts.captureLimit)] + cmdList)[0]
+    st = cwrap.CommandState(opts, cmdList)
+    with open(os.devnull, 'wb') as out:
+        t = time.perf_counter()
+        st.run(out, out)
+        runTime = time.perf_counter() - t
+    print(json.dumps({
+        'run_s': runTime,
+        'maxrss_kb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+    }))
+
+
+def runCase(stateDir, size, exitCode, bOpts):
+    cmd = [sys.executable, os.path.abspath(__file__), '--capture-limit',
+        str(bOpts.captureLimit), '--child', stateDir, str(size),
+        str(exitCode)]
+    p = sp.run(cmd, stdout=sp.PIPE, check=True)
+    return json.loads(p.stdout.decode('utf-8'))
+
+
+def main():
+    bOpts = getOpts()
+    if bOpts.child:
+        return runChild(bOpts)
+    tmpDir = tempfile.mkdtemp(prefix='cwrap-bench-')
+    results = []
+    try:
+        for name, exitCode in (('success', 0), ('failure', 1)):
+            baseRss = runCase(tmpDir, 0, exitCode, bOpts)['maxrss_kb']
+            for size in bOpts.size:
+                runs = [runCase(tmpDir, size, exitCode, bOpts)
+                    for i in range(bOpts.iterations)]
+                runTime = statistics.median(r['run_s'] for r in runs)
+                rss = max(r['maxrss_kb'] for r in runs)
+                results.append({
+                    'command': name,
+                    'size_mb': size,
+                    'run_ms': runTime * 1000,
+                    'mb_per_s': size / runTime,
+                    'rss_kb': rss - baseRss,
+                    'rss_per_mb_kb': (rss - baseRss) / size,
+                })
+    finally:
+        shutil.rmtree(tmpDir)
+    if bOpts.json:
+        print(json.dumps(results, indent=2))
+    else:
+        print('%-8s %8s %10s %10s %10s %10s' % ('command', 'size MB',
+            'run ms', 'MB/s', 'RSS KB', 'KB per MB'))
+        for r in results:
+            print('%-8s %8d %10.1f %10.1f %10d %10.1f' % (r['command'],
+                r['size_mb'], r['run_ms'], r['mb_per_s'], r['rss_kb'],
+                r['rss_per_mb_kb']))
+
+
+if __name__ == '__main__':
+    main()
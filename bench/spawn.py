@@ -0,0 +1,147 @@
+#!/usr/bin/env python3
+
+# This file is part of cron-wrap.
+#
+# cron-wrap is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# cron-wrap is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with cron-wrap.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Measures the latency of starting and reaping true(1) with the ways cwrap
+can spawn a command: subprocess's default path with close_fds, which is
+vfork() and exec() on Linux since python 3.10 and fork() and exec()
+otherwise, posix_spawn() by the full path without close_fds, and through
+/bin/sh as "--single-string" commands used to be, both with bare
+subprocess and with a whole CommandState.run().  The modes are run in turn
+so they all see the same system noise.  The open file limit can be raised
+and the process made larger to see how the spawn cost scales on big hosts.
+"""
+
+from argparse import ArgumentParser
+import json
+import os
+import resource
+import shutil
+import statistics
+import subprocess as sp
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(
+    __file__))))
+import cwrap
+
+
+def getOpts():
+    p = ArgumentParser(description=__doc__)
+    p.add_argument('-n', '--iterations', type=int, default=200,
+        help='The number of spawns to take the median of '
+        '[default: %(default)s]')
+    p.add_argument('-f', '--fds', type=int, default=0,
+        help='Raise the open file limit to at least this and open this many '
+        'descriptors, as a busy host would have [default: %(default)s]')
+    p.add_argument('-r', '--rss', type=int, default=0, metavar='MB',
+        help='Touch this many MB of memory first, to make the process as big '
+        'as one with a large state [default: %(default)s]')
+    p.add_argument('-j', '--json', default=False, action='store_true',
+        help='Print the results as JSON [default: %(default)s]')
+    return p.parse_args()
+
+
+def timeSpawns(modes, iterations):
+    """
+    Returns the median time of each of the (name, func) modes in usecs
+    """
+    times = dict((name, []) for name, func in modes)
+    for i in range(iterations + 1):
+        for name, func in modes:
+            t = time.perf_counter()
+            func()
+            if i:
+                # The first round warms up the caches
+                times[name].append(time.perf_counter() - t)
+    return dict((name, statistics.median(t) * 1e6)
+        for name, t in times.items())
+
+
+def popen(*args, **kwargs):
+    p = sp.Popen(*args, stdout=sp.PIPE, stderr=sp.PIPE, **kwargs)
+    p.communicate()
+
+
+def cwrapRun(stateDir, args, devnull):
+    opts, cmdList = cwrap.getOpts(['-d', stateDir] + args)
+    def run():
+        cwrap.CommandState(opts, cmdList).run(devnull, devnull)
+    return run
+
+
+def main():
+    bOpts = getOpts()
+    fds = []
+    if bOpts.fds:
+        soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+        if hard != resource.RLIM_INFINITY:
+            bOpts.fds = min(bOpts.fds, hard - 64)
+        if soft != resource.RLIM_INFINITY and soft < bOpts.fds + 64:
+            resource.setrlimit(resource.RLIMIT_NOFILE, (bOpts.fds + 64,
+                hard))
+        fds = [os.open(os.devnull, os.O_RDONLY) for i in range(bOpts.fds)]
+    ballast = bytearray(bOpts.rss * 1024 * 1024)
+    for i in range(0, len(ballast), 4096):
+        ballast[i] = 1
+    true = shutil.which('true')
+    tmpDir = tempfile.mkdtemp(prefix='cwrap-bench-')
+    devnull = open(os.devnull, 'wb')
+    # The shell is given the full path, so it doesn't use its builtin
+    # true, and quoting it forces cwrap to use the shell
+    modes = (
+        ('popen-default', lambda: popen([true])),
+        ('popen-posix-spawn', lambda: popen(['true'], executable=true,
+            close_fds=False)),
+        ('popen-shell', lambda: popen(true, shell=True,
+            start_new_session=True)),
+        ('run', cwrapRun(tmpDir, ['true'], devnull)),
+        ('run-no-fast-spawn', cwrapRun(tmpDir, ['--no-fast-spawn', 'true'],
+            devnull)),
+        ('run-single-string', cwrapRun(tmpDir, ['-g', true], devnull)),
+        ('run-single-string-shell', cwrapRun(tmpDir, ['-g', "'%s'" % true],
+            devnull)),
+    )
+    try:
+        times = timeSpawns(modes, bOpts.iterations)
+        results = [{'mode': name, 'spawn_us': times[name]}
+            for name, func in modes]
+    finally:
+        devnull.close()
+        shutil.rmtree(tmpDir)
+        for fd in fds:
+            os.close(fd)
+    for r in results:
+        r['spawn_ms'] = r['spawn_us'] / 1000
+    if bOpts.json:
+        print(json.dumps({
+            'fds': bOpts.fds,
+            'rss_mb': bOpts.rss,
+            'runs': results,
+        }, indent=2))
+    else:
+        print('Open descriptors: %d, ballast: %d MB' % (bOpts.fds,
+            bOpts.rss))
+        print('%-26s %10s' % ('mode', 'spawn us'))
+        for r in results:
+            print('%-26s %10.1f' % (r['mode'], r['spawn_us']))
+
+
+if __name__ == '__main__':
+    main()
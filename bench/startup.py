@@ -0,0 +1,133 @@
+#!/usr/bin/env python3
+
+# This file is part of cron-wrap.
+#
+# cron-wrap is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# cron-wrap is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with cron-wrap.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Measures the startup overhead of cwrap, which is the wall clock time of
+wrapping /bin/true minus the time to start a bare interpreter, both as a
+script, which is recompiled on every run, and with "python3 -m cwrap",
+which uses the cached bytecode.  The slowest imports are listed from
+"python3 -X importtime".  Exits with 1 if an overhead is over the budget.
+"""
+
+from argparse import ArgumentParser
+import json
+import os
+import shutil
+import statistics
+import subprocess as sp
+import sys
+import tempfile
+import time
+
+# The target startup overhead of a cwrap run in milliseconds
+STARTUP_BUDGET = 100
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def getOpts():
+    p = ArgumentParser(description=__doc__)
+    p.add_argument('-n', '--iterations', type=int, default=20,
+        help='The number of runs to take the median of '
+        '[default: %(default)s]')
+    p.add_argument('-b', '--budget', type=float, default=STARTUP_BUDGET,
+        help='The startup overhead budget in milliseconds '
+        '[default: %(default)s]')
+    p.add_argument('-t', '--top', type=int, default=10,
+        help='The number of slowest imports to list [default: %(default)s]')
+    p.add_argument('-j', '--json', default=False, action='store_true',
+        help='Print the results as JSON [default: %(default)s]')
+    return p.parse_args()
+
+
+def timeCmd(cmd, iterations, env):
+    times = []
+    for i in range(iterations):
+        t = time.perf_counter()
+        sp.run(cmd, stdout=sp.DEVNULL, stderr=sp.DEVNULL, env=env, cwd=ROOT)
+        times.append(time.perf_counter() - t)
+    return statistics.median(times) * 1000
+
+
+def getImportTimes(cmd, env, top):
+    """
+    Returns the (module, cumulative usecs) of the slowest top level imports
+    """
+    p = sp.run(cmd, stdout=sp.DEVNULL, stderr=sp.PIPE, env=env, cwd=ROOT)
+    imports = []
+    for line in p.stderr.decode('utf-8').splitlines():
+        if not line.startswith('import time:') or 'cumulative' in line:
+            continue
+        selfUs, cumUs, name = line[len('import time:'):].split('|')
+        # Only the imports done by cwrap itself, not their dependencies
+        if name.startswith('  ') or name.strip() in ('site', 'encodings',
+                'runpy') or name.strip().startswith('_frozen'):
+            continue
+        imports.append((name.strip(), int(cumUs)))
+    imports.sort(key=lambda i: i[1], reverse=True)
+    return imports[:top]
+
+
+def main():
+    bOpts = getOpts()
+    tmpDir = tempfile.mkdtemp(prefix='cwrap-bench-')
+    env = dict(os.environ)
+    # Let the module mode use and write cached bytecode
+    env.pop('PYTHONDONTWRITEBYTECODE', None)
+    args = ['-d', tmpDir, 'true']
+    py = sys.executable
+    try:
+        # Warm up the cached bytecode and the state file
+        sp.run([py, '-m', 'cwrap'] + args, env=env, cwd=ROOT, check=True)
+        base = timeCmd([py, '-c', 'pass'], bOpts.iterations, env)
+        results = []
+        for mode, cmd in (('script', [py, 'cwrap.py']),
+                ('module', [py, '-m', 'cwrap'])):
+            total = timeCmd(cmd + args, bOpts.iterations, env)
+            results.append({
+                'mode': mode,
+                'total_ms': total,
+                'overhead_ms': total - base,
+            })
+        imports = getImportTimes([py, '-X', 'importtime', '-m', 'cwrap'] +
+            args, env, bOpts.top)
+    finally:
+        shutil.rmtree(tmpDir)
+    over = [r for r in results if r['overhead_ms'] > bOpts.budget]
+    if bOpts.json:
+        print(json.dumps({
+            'interpreter_ms': base,
+            'budget_ms': bOpts.budget,
+            'runs': results,
+            'imports': [{'module': m, 'cumulative_us': us}
+                for m, us in imports],
+        }, indent=2))
+    else:
+        print('Bare interpreter: %.1f ms' % base)
+        print('%-8s %10s %12s' % ('mode', 'total ms', 'overhead ms'))
+        for r in results:
+            print('%-8s %10.1f %12.1f%s' % (r['mode'], r['total_ms'],
+                r['overhead_ms'], '  OVER BUDGET' if r in over else ''))
+        print('\nSlowest imports (cumulative us):')
+        for m, us in imports:
+            print('  %-24s %8d' % (m, us))
+        print('\nBudget: %.1f ms' % bOpts.budget)
+    sys.exit(1 if over else 0)
+
+
+if __name__ == '__main__':
+    main()
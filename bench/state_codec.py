@@ -0,0 +1,138 @@
+#!/usr/bin/env python3
+
+# This file is part of cron-wrap.
+#
+# cron-wrap is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# cron-wrap is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with cron-wrap.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Compares the load/save latency and the file size of the state backends
+for a range of failure history lengths and output compression codecs, with
+failures which each have distinct output or repeat the same output.  Note
+that the save time of the binary backend includes the fsync() of its atomic
+replace.
+"""
+
+from argparse import ArgumentParser
+import json
+import os
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(
+    __file__))))
+import cwrap
+
+
+def getOpts():
+    p = ArgumentParser(description=__doc__)
+    p.add_argument('-f', '--fails', type=int, action='append', default=[],
+        help='A failure history length to test, can be specified multiple '
+        'times [default: 1, 10, 100, 1000]')
+    p.add_argument('-o', '--output-size', dest='outSize', type=int,
+        default=2048, help='The size of stdout and stderr of each failure '
+        '[default: %(default)s]')
+    p.add_argument('-c', '--compress', action='append', default=[],
+        choices=['none'] + sorted(cwrap.OUTPUT_CODECS),
+        help='An output compression codec to test, can be specified '
+        'multiple times [default: none, zlib, lzma]')
+    p.add_argument('-r', '--repeat', type=int, default=1,
+        help='The number of consecutive failures with the same output, '
+        'which is stored once [default: %(default)s]')
+    p.add_argument('-i', '--iterations', type=int, default=20,
+        help='The number of load/save cycles to time [default: %(default)s]')
+    p.add_argument('-j', '--json', default=False, action='store_true',
+        help='Print the results as JSON [default: %(default)s]')
+    opts = p.parse_args()
+    if not opts.fails:
+        opts.fails = [1, 10, 100, 1000]
+    if not opts.compress:
+        opts.compress = ['none'] + sorted(cwrap.OUTPUT_CODECS)
+    return opts
+
+
+def makeState(opts, cmdList, numFails, outSize, codec, repeat):
+    st = cwrap.CommandState(opts, cmdList)
+    line = 'x' * 70 + '\n'
+    for i in range(numFails):
+        # Use distinct output for each run of repeated failures so it can't
+        # be shared between them
+        out = ''.join('%08d %s' % (i // repeat, line)
+            for j in range(outSize // 80))
+        f = cwrap.Failure(cmdList, time.time(), 1.5, 1, out, out.upper())
+        f.compress(codec)
+        st._addFailure(f)
+    return st
+
+
+def benchBackend(backend, codec, stFName, opts, st, iterations):
+    cls = cwrap.STATE_BACKENDS[backend]
+    for f in (stFName, stFName + '.journal'):
+        if os.path.exists(f):
+            os.unlink(f)
+    sf = cls.fromOpts(stFName, opts)
+    sf.saveObject(st)
+    sf.close()
+    loadTime = saveTime = 0.0
+    for i in range(iterations):
+        sf = cls.fromOpts(stFName, opts)
+        t = time.perf_counter()
+        obj = sf.getObject()
+        loadTime += time.perf_counter() - t
+        assert obj.NumFails == st.NumFails
+        t = time.perf_counter()
+        sf.saveObject(obj)
+        saveTime += time.perf_counter() - t
+        sf.close()
+    return {
+        'backend': backend,
+        'compress': codec,
+        'fails': st.NumFails,
+        'load_ms': loadTime / iterations * 1000,
+        'save_ms': saveTime / iterations * 1000,
+        'size': os.path.getsize(stFName),
+    }
+
+
+def main():
+    bOpts = getOpts()
+    tmpDir = tempfile.mkdtemp(prefix='cwrap-bench-')
+    cmdList = ['/usr/local/bin/nightly-etl', '--all']
+    sys.argv = ['cwrap', '-d', tmpDir] + cmdList
+    opts = cwrap.getOpts()[0]
+    stFName = os.path.join(tmpDir, 'bench.state')
+    results = []
+    for numFails in bOpts.fails:
+        for codec in bOpts.compress:
+            st = makeState(opts, cmdList, numFails, bOpts.outSize, codec,
+                bOpts.repeat)
+            for backend in ('pickle', 'binary'):
+                results.append(benchBackend(backend, codec, stFName, opts, st,
+                    bOpts.iterations))
+    if bOpts.json:
+        print(json.dumps(results, indent=2))
+    else:
+        print('%-8s %-8s %8s %10s %10s %12s' % ('backend', 'compress',
+            'fails', 'load ms', 'save ms', 'size'))
+        for r in results:
+            print('%-8s %-8s %8d %10.3f %10.3f %12d' % (r['backend'],
+                r['compress'], r['fails'], r['load_ms'], r['save_ms'],
+                r['size']))
+    for f in os.listdir(tmpDir):
+        os.unlink(os.path.join(tmpDir, f))
+    os.rmdir(tmpDir)
+
+
+if __name__ == '__main__':
+    main()
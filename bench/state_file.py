@@ -0,0 +1,152 @@
+#!/usr/bin/env python3
+
+# This file is part of cron-wrap.
+#
+# cron-wrap is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# cron-wrap is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with cron-wrap.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Measures the latency of each step of the state handling of a run, as a
+function of the failure history length: taking the lock on the state
+(StateFile.getStateFile()), loading it, saving it with one more failure and
+releasing the lock.  This is done for each state backend and lock mode, the
+lock mode doesn't apply to the sqlite backend.
+"""
+
+from argparse import ArgumentParser
+import json
+import os
+import shutil
+import statistics
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(
+    __file__))))
+import cwrap
+
+STEPS = ('lock', 'load', 'save', 'unlock')
+
+
+def getOpts():
+    p = ArgumentParser(description=__doc__)
+    p.add_argument('-f', '--fails', type=int, action='append', default=[],
+        help='A failure history length to test, can be specified multiple '
+        'times [default: 0, 10, 100, 1000]')
+    p.add_argument('-b', '--backend', action='append', default=[],
+        choices=sorted(cwrap.STATE_BACKENDS),
+        help='A state backend to test, can be specified multiple times '
+        '[default: all of them]')
+    p.add_argument('-o', '--output-size', dest='outSize', type=int,
+        default=2048, help='The size of stdout and stderr of each failure '
+        '[default: %(default)s]')
+    p.add_argument('-i', '--iterations', type=int, default=20,
+        help='The number of runs to take the median of '
+        '[default: %(default)s]')
+    p.add_argument('-j', '--json', default=False, action='store_true',
+        help='Print the results as JSON [default: %(default)s]')
+    opts = p.parse_args()
+    if not opts.fails:
+        opts.fails = [0, 10, 100, 1000]
+    if not opts.backend:
+        opts.backend = sorted(cwrap.STATE_BACKENDS)
+    return opts
+
+
+def makeFailure(cmdList, i, outSize, codec):
+    line = 'x' * 70 + '\n'
+    out = ''.join('%08d %s' % (i, line) for j in range(outSize // 80))
+    f = cwrap.Failure(cmdList, time.time(), 1.5, 1, out, out.upper())
+    f.compress(codec)
+    return f
+
+
+def benchState(opts, cmdList, numFails, bOpts):
+    """
+    Saves a state with numFails failures, then times the steps of a run
+    which adds a failure to it.  The history is capped at numFails, so it
+    stays the same length.
+    """
+    sf = cwrap.StateFile.getStateFile(opts, cmdList)
+    st = cwrap.CommandState(opts, cmdList)
+    for i in range(numFails):
+        st._addFailure(makeFailure(cmdList, i, bOpts.outSize,
+            opts.compressOutput))
+    st._lastRecord = cwrap.REC_FAIL
+    sf.saveObject(st)
+    sf.close()
+    times = dict((s, []) for s in STEPS)
+    for i in range(bOpts.iterations):
+        t = time.perf_counter()
+        sf = cwrap.StateFile.getStateFile(opts, cmdList)
+        times['lock'].append(time.perf_counter() - t)
+        t = time.perf_counter()
+        st = sf.getObject()
+        times['load'].append(time.perf_counter() - t)
+        st.opts = opts
+        st._addFailure(makeFailure(cmdList, numFails + i, bOpts.outSize,
+            opts.compressOutput))
+        st._lastRecord = cwrap.REC_FAIL
+        t = time.perf_counter()
+        sf.saveObject(st)
+        times['save'].append(time.perf_counter() - t)
+        t = time.perf_counter()
+        sf.close()
+        times['unlock'].append(time.perf_counter() - t)
+    return dict(('%s_ms' % s, statistics.median(times[s]) * 1000)
+        for s in STEPS)
+
+
+def main():
+    bOpts = getOpts()
+    tmpDir = tempfile.mkdtemp(prefix='cwrap-bench-')
+    results = []
+    try:
+        for backend in bOpts.backend:
+            lockModes = ('file', 'flock')
+            if backend == 'sqlite':
+                lockModes = ('row',)
+            for lockMode in lockModes:
+                for numFails in bOpts.fails:
+                    stateDir = os.path.join(tmpDir, 'state')
+                    os.mkdir(stateDir)
+                    cmdList = ['/usr/local/bin/nightly-etl', '--all']
+                    opts = cwrap.getOpts(['-d', stateDir, '--state-backend',
+                        backend, '--max-history', str(max(numFails, 1))] +
+                        cmdList)[0]
+                    if lockMode != 'row':
+                        opts.lockMode = lockMode
+                    r = {
+                        'backend': backend,
+                        'lock_mode': lockMode,
+                        'fails': numFails,
+                    }
+                    r.update(benchState(opts, cmdList, numFails, bOpts))
+                    results.append(r)
+                    shutil.rmtree(stateDir)
+    finally:
+        shutil.rmtree(tmpDir)
+    if bOpts.json:
+        print(json.dumps(results, indent=2))
+    else:
+        print('%-8s %-6s %6s %9s %9s %9s %9s' % ('backend', 'lock', 'fails',
+            'lock ms', 'load ms', 'save ms', 'unlock ms'))
+        for r in results:
+            print('%-8s %-6s %6d %9.3f %9.3f %9.3f %9.3f' % (r['backend'],
+                r['lock_mode'], r['fails'], r['lock_ms'], r['load_ms'],
+                r['save_ms'], r['unlock_ms']))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,112 @@
+#!/usr/bin/env python3
+
+# This file is part of cron-wrap.
+#
+# cron-wrap is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# cron-wrap is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with cron-wrap.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Measures the time to scan a state directory of many failing jobs for
+"--status", decoding the full states versus only their mapped headers, for
+the binary state backend and the indexed columns of the sqlite backend.
+"""
+
+from argparse import ArgumentParser
+import json
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(
+    __file__))))
+import cwrap
+
+
+def getOpts():
+    p = ArgumentParser(description=__doc__)
+    p.add_argument('-j', '--jobs', type=int, default=2000,
+        help='The number of jobs in the state directory '
+        '[default: %(default)s]')
+    p.add_argument('-f', '--fails', type=int, default=50,
+        help='The failure history length of each job [default: %(default)s]')
+    p.add_argument('-o', '--output-size', dest='outSize', type=int,
+        default=2048, help='The size of stdout and stderr of each failure '
+        '[default: %(default)s]')
+    p.add_argument('--json', default=False, action='store_true',
+        help='Print the results as JSON [default: %(default)s]')
+    return p.parse_args()
+
+
+def makeStates(opts, bOpts):
+    out = 'x' * bOpts.outSize
+    for i in range(bOpts.jobs):
+        cmdList = ['/usr/local/bin/job%d' % i, '--all']
+        st = cwrap.CommandState(opts, cmdList)
+        for j in range(bOpts.fails):
+            st._addFailure(cwrap.Failure(cmdList, time.time(), 1.5, 1, out,
+                out))
+        st.runCount = st.lastExitCode = 1
+        stFName = cwrap.StateFile.getStateFileName(opts, cmdList)
+        for backend in ('binary', 'sqlite'):
+            opts.stateBackend = backend
+            sf = cwrap.STATE_BACKENDS[backend].fromOpts(stFName, opts)
+            sf.saveObject(st)
+            sf.close()
+
+
+def timeScan(func):
+    t = time.perf_counter()
+    n = len(func())
+    return (time.perf_counter() - t) * 1000, n
+
+
+def main():
+    bOpts = getOpts()
+    tmpDir = tempfile.mkdtemp(prefix='cwrap-bench-')
+    try:
+        opts = cwrap.getOpts(['-d', tmpDir, '--status'])[0]
+        makeStates(opts, bOpts)
+        results = []
+        for backend, mode, func in (
+                ('binary', 'full', lambda: list(cwrap.iterStates(opts,
+                    True))),
+                ('binary', 'summary', lambda: list(cwrap.iterStates(opts,
+                    True, True))),
+                ('sqlite', 'full', lambda: list(cwrap.iterStates(opts,
+                    True))),
+                ('sqlite', 'index', lambda: cwrap.getStatusRows(opts))):
+            opts.stateBackend = backend
+            # Once to warm the page cache
+            func()
+            ms, n = timeScan(func)
+            results.append({
+                'backend': backend,
+                'mode': mode,
+                'jobs': n,
+                'scan_ms': ms,
+            })
+    finally:
+        shutil.rmtree(tmpDir)
+    if bOpts.json:
+        print(json.dumps(results, indent=2))
+    else:
+        print('%-8s %-8s %8s %10s' % ('backend', 'mode', 'jobs', 'scan ms'))
+        for r in results:
+            print('%-8s %-8s %8d %10.1f' % (r['backend'], r['mode'],
+                r['jobs'], r['scan_ms']))
+
+
+if __name__ == '__main__':
+    main()
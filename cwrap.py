@@ -15,22 +15,31 @@
 # You should have received a copy of the GNU General Public License
 # along with cron-wrap.  If not, see <http://www.gnu.org/licenses/>.
 
-from argparse import ArgumentParser, ArgumentError
-from hashlib import md5
-from io import StringIO
-from smtplib import SMTP, SMTP_SSL
-from random import randint
-import pickle as pickle
+# Only the modules needed by every run are imported here.  The ones only
+# needed by some code paths, like pickle for the pickle state backend,
+# smtplib for sending email or asyncio for batches, are imported where they
+# are used to keep the startup fast.  abc is already loaded by io, and the
+# state codecs of every backend need struct.
+from hashlib import md5, blake2b
+from io import StringIO, BytesIO
+from types import SimpleNamespace
+import abc
+import marshal
+import math
 import subprocess as sp
 import sys
 import time
 import os
+import struct
+import errno
 import signal
 import syslog
-import getpass
+import fcntl
 
 
 STATEFILE = None
+# The CommandState being run
+COMSTATE = None
 LOGPRI = 0
 __version__ = '0.7.0'
 
@@ -39,11 +48,119 @@ E_FC = 1
 # Failure limit reached
 E_FLR = 2
 
+# The default directory of the state files
+DEFAULT_STATE_DIR = '/var/tmp'
+
+# The size of the reads done on the child's output pipes
+CHUNK_SIZE = 65536
+
+# The default "--capture-limit", the bytes of each of stdout and stderr kept
+# in memory
+DEFAULT_CAPTURE_LIMIT = 1 << 20
+
+# The default "--max-history", the number of failures kept in the state, and
+# "--max-fail-output", the characters of each of stdout and stderr stored
+# for a failure
+DEFAULT_MAX_HISTORY = 100
+DEFAULT_MAX_FAIL_OUTPUT = 65536
+
+# A "--single-string" command made only of these characters, and which
+# doesn't start with one of the shell builtins or keywords, needs no shell
+# and is run directly
+SHELL_SAFE_CHARS = frozenset('abcdefghijklmnopqrstuvwxyz'
+    'ABCDEFGHIJKLMNOPQRSTUVWXYZ0123456789 \t-_./:,+@%^')
+SHELL_BUILTINS = frozenset(('.', ':', 'alias', 'bg', 'break', 'builtin',
+    'case', 'cd', 'command', 'continue', 'do', 'done', 'elif', 'else', 'esac',
+    'eval', 'exec', 'exit', 'export', 'fc', 'fg', 'fi', 'for', 'function',
+    'getopts', 'hash', 'if', 'jobs', 'local', 'read', 'readonly', 'return',
+    'select', 'set', 'shift', 'source', 'then', 'time', 'times', 'trap',
+    'type', 'ulimit', 'umask', 'unalias', 'unset', 'until', 'wait', 'while'))
+
+# Whether subprocess starts commands with vfork(), which it does on Linux
+# since python 3.10.  That is faster than its posix_spawn() path, which is
+# only worth taking where subprocess would fork() the whole process.
+SUBPROCESS_VFORK = sys.platform.startswith('linux') and \
+    sys.version_info >= (3, 10)
+
+# The age in seconds after which a lock file without a PID is stale
+STALE_LOCK_AGE = 10
+
+# The number of times a state file is read without a lock before giving up
+# on getting a consistent snapshot of it while a job is writing it
+STATE_READ_TRIES = 3
+
+# The number of seconds between samples of the process tree with
+# --sample-proc
+PROC_SAMPLE_INTERVAL = 1.0
+
+# The fields of the resource usage tuples recorded for each run
+RUSAGE_FIELDS = ('utime', 'stime', 'maxrss', 'inblock', 'oublock', 'nvcsw',
+    'nivcsw', 'treerss')
+
+# The socket of the systemd journal for its native protocol
+JOURNAL_SOCKET = '/run/systemd/journal/socket'
+
+# The upper bounds of the run time histogram buckets, in seconds.  The
+# counts are stored per bucket and made cumulative on export.
+RUNTIME_BUCKETS = (0.1, 0.5, 1, 5, 10, 30, 60, 300, 600, 1800, 3600,
+    float('inf'))
+
+# The run time quantile sketch has RUNTIME_SKETCH_BINS logarithmic bins,
+# the first for run times up to RUNTIME_SKETCH_MIN seconds and each
+# following one RUNTIME_SKETCH_GROWTH times wider, which is up to about 42
+# hours with a relative error of at most 15%
+RUNTIME_SKETCH_MIN = 0.01
+RUNTIME_SKETCH_GROWTH = 1.3
+RUNTIME_SKETCH_BINS = 64
+
+# The weight of the latest run in the exponentially weighted run time mean
+# and variance, and the decay of the sketch per run
+RUNTIME_DECAY = 0.02
+
+# The run time anomaly threshold is never below this many seconds, so
+# short jobs aren't flagged for a few milliseconds of jitter
+ANOMALY_MIN_RUNTIME = 1.0
+
+# The codecs the captured output of failures can be compressed with in the
+# state, by the tag byte which starts the compressed bytes
+OUTPUT_CODECS = {'zlib': b'z', 'lzma': b'x'}
+
+# Output shorter than this many bytes isn't worth compressing
+OUTPUT_COMPRESS_MIN = 128
+
+# The size of the digest which identifies identical output, see
+# outputDigest()
+OUTPUT_DIGEST_SIZE = 16
+
+# With "--email-attach", the report is attached with this name and the body
+# is at most this many lines of the report before the failures
+REPORT_ATTACHMENT = 'cwrap-report.txt.gz'
+REPORT_SUMMARY_LINES = 40
+
+# The policies for a run which overlaps the previous run of the job, see
+# "--overlap"
+OVERLAP_POLICIES = ('fail', 'skip', 'queue', 'replace')
+
+# Run record types for the journal of the log state backend
+REC_SUCCESS = 1
+REC_FAIL = 2
+
 # Exceptions
 class LockError(Exception):
     """
     Error to be raised when a lockfile is found
     """
+    def __init__(self, msg, pid=None):
+        Exception.__init__(self, msg)
+        # The PID of the process holding the lock, if known
+        self.pid = pid
+
+
+class OverlapError(Exception):
+    """
+    Error raised instead of retrying when a previous run of the job still
+    has the lock and the overlap policy is to skip this run or to queue it
+    """
     pass
 
 
@@ -65,16 +182,40 @@ class MailError(Exception):
     pass
 
 
+class UsageError(Exception):
+    """
+    Error raised instead of exiting for invalid command line options of a
+    request to the daemon
+    """
+    pass
+
+
+class DaemonError(Exception):
+    """
+    Error raised when the daemon can't serve its socket
+    """
+    pass
+
+
 # Define classes
 class StateFile:
-    def __init__(self, name, mode='rb+', buffering=-1, lockFile=None):
+    def __init__(self, name, mode='rb+', buffering=-1, lockFile=None,
+            lockMode='file', lockWait=0):
         """
         Override the init function to create a lockfile
+
+            lockMode<str>:      "file" for an exclusively created lock file
+                                or "flock" for a kernel advisory lock on it
+            lockWait<float>:    The number of seconds to block waiting for
+                                an flock before giving up
         """
         if lockFile:
             self._lockName = lockFile
         else:
             self._lockName = '%s.lock' % name
+        self._lockMode = lockMode
+        self._lockWait = lockWait
+        self._lockFd = None
         self._lock()
         # In order to open this r+, we need to have an existing file.  If it
         # does not exist, we want to create it first
@@ -101,6 +242,7 @@ class StateFile:
         """
         Returns the object stored in the state file
         """
+        import pickle
         self.seek(0)
         obj = None
         try:
@@ -116,17 +258,56 @@ class StateFile:
         """
         This will pickle the object in the current state file
         """
+        import pickle
         # delete file contents and add new
         self.seek(0)
         self.truncate(0)
         pickle.dump(obj, self)
 
-    def _upgrade(self, cmdState):
+    def saveSnapshot(self, obj):
+        """
+        Saves the full object.  This is used when more than a single run
+        has happened since the object was loaded.
+        """
+        self.saveObject(obj)
+
+    @staticmethod
+    def _upgrade(cmdState):
         # Upgrading from 0.5.x to 0.6.x adds the _lastEmailNum var.  If it
         # doesn't exist, we need to initialize it to zero
         if isinstance(cmdState, CommandState) and not \
             hasattr(cmdState, '_lastEmailNum'):
             cmdState._lastEmailNum = 0
+        # Upgrading to 0.7.x adds the aggregate failure counters so that the
+        # failure history itself can be bounded
+        if isinstance(cmdState, CommandState) and not \
+                hasattr(cmdState, 'failCount'):
+            cmdState.failCount = len(cmdState.failures)
+            cmdState.failRunTime = sum(f.runTime for f in cmdState.failures)
+            cmdState.firstFailTime = None
+            if cmdState.failures:
+                cmdState.firstFailTime = cmdState.failures[0].timeStarted
+        # These are used by the log state backend
+        if isinstance(cmdState, CommandState) and not \
+                hasattr(cmdState, '_journalSeq'):
+            cmdState._journalSeq = 0
+            cmdState._lastRecord = None
+        if isinstance(cmdState, CommandState) and not \
+                hasattr(cmdState, 'lastRusage'):
+            cmdState.lastRusage = None
+        # The run metrics
+        if isinstance(cmdState, CommandState) and not \
+                hasattr(cmdState, 'runCount'):
+            cmdState._resetMetrics()
+        # The counts of the runs which overlapped a previous one
+        if isinstance(cmdState, CommandState) and not \
+                hasattr(cmdState, 'overlaps'):
+            cmdState.overlaps = {}
+            cmdState.lastOverlapTime = None
+        # The streaming run time statistics
+        if isinstance(cmdState, CommandState) and not \
+                hasattr(cmdState, 'runTimeSketch'):
+            cmdState._resetRuntimeStats()
 
     def _create(self, fname):
         if not os.path.exists(fname):
@@ -139,20 +320,118 @@ class StateFile:
         """
         Create a lockfile or raise LockError if a lockfile is found
         """
+        if self._lockMode == 'flock':
+            return self._flock()
         fd = None
         try:
             fd = os.open(self._lockName, os.O_CREAT | os.O_WRONLY | os.O_EXCL)
         except OSError as e:
-            raise LockError('Lock file exists, cannot open state file: %s' %
-                self._lockName)
+            if not self._removeStaleLock():
+                raise LockError('Lock file exists, cannot open state file: '
+                    '%s' % self._lockName, readLockPid(self._lockName))
+            try:
+                fd = os.open(self._lockName,
+                    os.O_CREAT | os.O_WRONLY | os.O_EXCL)
+            except OSError as e:
+                raise LockError('Lock file exists, cannot open state file: '
+                    '%s' % self._lockName, readLockPid(self._lockName))
         os.fchmod(fd, 0o600)
         os.write(fd, str(os.getpid()).encode('utf-8'))
         os.close(fd)
 
+    def _removeStaleLock(self):
+        """
+        Removes the lockfile if the process whose PID is in it no longer
+        exists.  This is serialized with an flock on a guard file so that two
+        processes can't both decide the same lock is stale.
+
+            returns -> <bool>:  True if a stale lock was removed
+        """
+        guard = os.open('%s.guard' % self._lockName, os.O_CREAT | os.O_RDWR,
+            0o600)
+        try:
+            fcntl.flock(guard, fcntl.LOCK_EX)
+            pid = readLockPid(self._lockName)
+            if pid is None:
+                # An empty lock file is only stale once it's old enough
+                # that its creator can't still be about to write its PID
+                age = time.time() - os.path.getmtime(self._lockName)
+                if age < STALE_LOCK_AGE:
+                    return False
+            elif pidExists(pid):
+                return False
+            os.unlink(self._lockName)
+            return True
+        except OSError:
+            return False
+        finally:
+            os.close(guard)
+
+    def _flock(self):
+        """
+        Takes an exclusive flock on the lock file, optionally blocking for up
+        to lockWait seconds, and writes our PID to it
+        """
+        fd = os.open(self._lockName, os.O_CREAT | os.O_RDWR, 0o600)
+        try:
+            if self._lockWait:
+                self._flockWait(fd)
+            else:
+                fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except (OSError, LockError):
+            os.close(fd)
+            raise LockError('Lock file is locked, cannot open state file: %s'
+                % self._lockName, readLockPid(self._lockName))
+        os.ftruncate(fd, 0)
+        os.write(fd, str(os.getpid()).encode('utf-8'))
+        self._lockFd = fd
+
+    def _flockWait(self, fd):
+        """
+        Blocks on the flock for at most lockWait seconds.  In the main
+        thread, this is a blocking flock interrupted by a timer so that we
+        get the lock the moment it is released.  Signals can only be handled
+        in the main thread, so other threads poll for the lock instead.
+        """
+        import threading
+        if threading.current_thread() is not threading.main_thread():
+            deadline = time.monotonic() + self._lockWait
+            while True:
+                try:
+                    fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                    return
+                except BlockingIOError:
+                    if time.monotonic() >= deadline:
+                        raise
+                    time.sleep(0.01)
+
+        def timeout(signum, frame):
+            raise LockError('Timed out waiting for lock')
+
+        oldHandler = signal.signal(signal.SIGALRM, timeout)
+        signal.setitimer(signal.ITIMER_REAL, self._lockWait)
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX)
+        finally:
+            signal.setitimer(signal.ITIMER_REAL, 0)
+            signal.signal(signal.SIGALRM, oldHandler)
+
     def _unlock(self):
         """
         Simply deletes the lockfile
         """
+        if self._lockFd is not None:
+            # The flock lock file is left in place, deleting it would let
+            # another process lock a new file while a waiter holds the old
+            try:
+                os.ftruncate(self._lockFd, 0)
+                fcntl.flock(self._lockFd, fcntl.LOCK_UN)
+            except OSError as e:
+                print('Failed to unlock "{}": {}'.format(self._lockName, e),
+                    file=sys.stderr)
+            os.close(self._lockFd)
+            self._lockFd = None
+            return
         try:
             with open(self._lockName, 'rb') as fh:
                 pid = int(fh.read())
@@ -165,6 +444,23 @@ class StateFile:
             print('Failed to unlock by deleting "{}": {}'.format(
                 self._lockName, e), file=sys.stderr)
 
+    @classmethod
+    def fromOpts(cls, name, opts, lockFile=None):
+        """
+        Creates an instance of this state file type using the command line
+        options for any backend specific settings
+        """
+        return cls(name, lockFile=lockFile, **StateFile.getLockArgs(opts))
+
+    @staticmethod
+    def getLockArgs(opts):
+        """
+        Returns the locking keyword args for the constructor from the opts
+        """
+        if opts is None:
+            return {}
+        return {'lockMode': opts.lockMode, 'lockWait': opts.lockWait}
+
     @staticmethod
     def getStateFileName(opts, cmdList):
         """
@@ -190,7 +486,7 @@ class StateFile:
         return os.path.join(opts.stateDir, fname)
 
     @staticmethod
-    def getStateFile(opts, cmdList):
+    def getStateFile(opts, cmdList, overlap=False):
         """
         This will determine the state file name and return the StateFile object
         if it is successful.  If it can't get a statefile within the optionally
@@ -199,10 +495,13 @@ class StateFile:
 
             opts<optparse.Values>:      Options passed in on the command line
             cmdList<list>:              The command and args list
+            overlap<bool>:              Apply the "--overlap" policy when a
+                                        previous run has the lock, instead
+                                        of just retrying
 
             returns -> <StateFile>:     A created StateFile instance
 
-            raises -> FileCreationError
+            raises -> FileCreationError, OverlapError
         """
         stFName = StateFile.getStateFileName(opts, cmdList)
         lockFile = None
@@ -210,34 +509,804 @@ class StateFile:
             lockFile = opts.lockFile
         errs = []
         sf = None
+        policy = opts.overlap if overlap else 'fail'
+        queuedName = '%s.queued' % stFName
+
+        cls = STATE_BACKENDS[opts.stateBackend]
 
         for i in range(opts.numRetries + 1):
+            if i:
+                time.sleep(opts.retrySecs)
             try:
-                sf = StateFile(stFName, lockFile=lockFile)
-            except Exception as e:
+                sf = cls.fromOpts(stFName, opts, lockFile)
+            except LockError as e:
                 errs.append(e)
-                raise
+                if policy != 'fail':
+                    break
             else:
                 break
-            if opts.numRetries:
-                time.sleep(opts.retrySecs)
+
+        if not sf and policy == 'queue':
+            # Request the run and then try the lock again.  The previous run
+            # takes the request under the lock before it lets go of it, so
+            # either it sees the request or it has let go of the lock by
+            # the time it's tried again.
+            os.close(os.open(queuedName, os.O_CREAT | os.O_WRONLY, 0o600))
+            try:
+                sf = cls.fromOpts(stFName, opts, lockFile)
+            except LockError as e:
+                errs.append(e)
+
+        if not sf and policy == 'replace' and errs[-1].pid:
+            recordOverlap(stFName, policy)
+            sf = StateFile._replace(opts, stFName, lockFile, errs[-1].pid,
+                errs)
+        elif not sf and policy in ('skip', 'queue'):
+            recordOverlap(stFName, policy)
+            raise OverlapError('A previous run is still running, %s: %s' % (
+                'skipped' if policy == 'skip' else 'queued', stFName))
 
         if not sf:
             raise FileCreationError(
                 'Could not create state file "{}": {}'.format(
                 stFName, errs))
 
+        if policy == 'queue':
+            # This run satisfies any run queued before it started
+            takeQueuedRun(opts, stFName)
         return sf
 
+    @staticmethod
+    def _replace(opts, stFName, lockFile, pid, errs):
+        """
+        Stops the previous run, with the PID which holds the lock, and takes
+        over the lock.  It gets a SIGTERM, which makes it stop its command
+        within the kill grace period, and then a SIGKILL.
+
+            returns -> <StateFile>:     The state file or None if the lock
+                                        couldn't be taken over
+        """
+        if pid == os.getpid():
+            return None
+        cls = STATE_BACKENDS[opts.stateBackend]
+        # The PID in a lock file or row may have been reused or planted, so
+        # only a run of this job is killed
+        paths = [stFName, lockFile or '%s.lock' % stFName]
+        if opts.stateBackend == 'sqlite':
+            paths.append(SqliteStateFile.getDbName(opts))
+        if not isRunOf(pid, paths):
+            errs.append(LockError('Not replacing PID %d, which is not a '
+                'cwrap run of %s' % (pid, stFName), pid))
+            return None
+        for sig, wait in ((signal.SIGTERM, opts.killGrace + 1),
+                (signal.SIGKILL, 1)):
+            try:
+                if sig == signal.SIGTERM or isRunOf(pid, paths):
+                    os.kill(pid, sig)
+            except ProcessLookupError:
+                pass
+            deadline = time.monotonic() + wait
+            while True:
+                try:
+                    return cls.fromOpts(stFName, opts, lockFile)
+                except LockError as e:
+                    if e.pid not in (None, pid):
+                        # Someone else got it first
+                        errs.append(e)
+                        return None
+                    if time.monotonic() >= deadline:
+                        break
+                time.sleep(0.05)
+        errs.append(LockError('Could not replace the previous run with '
+            'PID %d' % pid, pid))
+        return None
+
+
+class OutputRefs(object):
+    """
+    The output stored with the failures of an encoded state, by digest, so
+    that failures with the same output reference the earlier copy instead of
+    storing it again.  Hashing all the output would cost as much as storing
+    it, so digests are only computed for output which is referenced.
+    """
+    def __init__(self):
+        # The stored output seen while encoding, with its digest once it has
+        # been referenced
+        self._seen = {}
+        # The output decoded in full, which is hashed as needed to resolve
+        # references
+        self._decoded = []
+        self._numHashed = 0
+        self._byDigest = {}
+
+    def getRef(self, stored):
+        """
+        Returns the digest to store in place of the stored output if it was
+        already stored, or None after noting it if it wasn't
+        """
+        if stored not in self._seen:
+            self._seen[stored] = None
+            return None
+        digest = self._seen[stored]
+        if digest is None:
+            digest = self._seen[stored] = outputDigest(stored)
+        return digest
+
+    def add(self, stored):
+        """
+        Adds output which was decoded in full
+        """
+        self._decoded.append(stored)
+
+    def resolve(self, digest):
+        """
+        Returns the decoded output with the digest.  A ValueError is raised
+        if there isn't any.
+        """
+        while digest not in self._byDigest and \
+                self._numHashed < len(self._decoded):
+            stored = self._decoded[self._numHashed]
+            self._byDigest.setdefault(outputDigest(stored), stored)
+            self._numHashed += 1
+        try:
+            return self._byDigest[digest]
+        except KeyError:
+            raise ValueError('Unknown output reference')
+
+
+class StateCodec(object):
+    """
+    A compact, versioned binary encoding for a CommandState and its
+    failures.  The command line options are not stored since they are
+    replaced by the current ones on every run.
+    """
+    magic = b'CWST'
+    version = 1
+    # magic, version, journal sequence number, failure count, last email
+    # number, number of stored failures, first failure time, total failure
+    # run time, command length, meta length
+    header = struct.Struct('>4sHQIIIddII')
+    # start time, run time, exit code, flags, stdout length, stderr length,
+    # python error length
+    failHeader = struct.Struct('>ddiBIII')
+    # The resource usage which follows the failure header if the
+    # F_RUSAGE flag is set, see RUSAGE_FIELDS
+    failRusage = struct.Struct('>ddQQQQQQ')
+    F_RUSAGE = 0x01
+    # The stdout or stderr is stored as bytes from compressOutput()
+    F_STDOUT_COMP = 0x02
+    F_STDERR_COMP = 0x04
+    # The stdout or stderr is the digest of the same output stored with an
+    # earlier failure in the state, see outputDigest()
+    F_STDOUT_REF = 0x08
+    F_STDERR_REF = 0x10
+    # The failure is a warning, see Failure
+    F_WARNING = 0x20
+    # Extra CommandState attributes stored as JSON in the meta section
+    metaAttrs = ('lastRusage', 'runCount', 'lastExitCode', 'lastRunTime',
+        'lastRunEnd', 'lastSuccessTime', 'emailsSent', 'runTimeBuckets',
+        'runTimeSum', 'overlaps', 'lastOverlapTime', 'runTimeMean',
+        'runTimeVar', 'runTimeSketch', 'runTimeSamples', 'anomalyStreak',
+        'anomalyCount')
+
+    @classmethod
+    def encodeMeta(cls, cmdState):
+        """
+        Returns the JSON bytes of the extra CommandState attributes
+        """
+        import json
+        return json.dumps(dict((a, getattr(cmdState, a))
+            for a in cls.metaAttrs)).encode('utf-8')
+
+    @classmethod
+    def applyMeta(cls, cmdState, meta):
+        """
+        Sets the extra CommandState attributes from the JSON bytes
+        """
+        if not meta:
+            return
+        import json
+        for k, v in json.loads(bytes(meta).decode('utf-8')).items():
+            if k == 'lastRusage' and v is not None:
+                v = tuple(v)
+            setattr(cmdState, k, v)
+
+    @classmethod
+    def encode(cls, cmdState):
+        """
+        Returns the bytes for the CommandState
+        """
+        cmd = '\0'.join(cmdState.cmdList).encode('utf-8')
+        meta = cls.encodeMeta(cmdState)
+        firstFail = cmdState.firstFailTime
+        if firstFail is None:
+            firstFail = float('nan')
+        parts = [cls.header.pack(cls.magic, cls.version,
+            cmdState._journalSeq, cmdState.failCount,
+            cmdState._lastEmailNum, len(cmdState.failures), firstFail,
+            cmdState.failRunTime, len(cmd), len(meta)), cmd, meta]
+        refs = OutputRefs()
+        for f in cmdState.failures:
+            parts.append(cls.encodeFailure(f, refs))
+        return b''.join(parts)
+
+    @classmethod
+    def decode(cls, data, opts=None):
+        """
+        Returns the CommandState for the bytes in data, using opts as its
+        options.  A ValueError is raised if data is not a valid encoded state.
+        """
+        data = memoryview(data)
+        st, off, numFails = cls._decodeHead(data, opts)
+        refs = OutputRefs()
+        for i in range(numFails):
+            f, off = cls.decodeFailure(data, off, st.cmdList, refs)
+            st.failures.append(f)
+        return st
+
+    @classmethod
+    def decodeSummary(cls, data, opts=None):
+        """
+        Returns the CommandState for the bytes in data without its failure
+        history, which isn't needed to report on a job.  Only the header,
+        command and meta section at the start of data are read, so data can
+        be an mmap of a state file with a long history.
+        """
+        return cls._decodeHead(data, opts)[0]
+
+    @classmethod
+    def _decodeHead(cls, data, opts):
+        """
+        Decodes the header, command and meta section
+
+            returns -> (<CommandState>, <int>, <int>):  The state, the
+                        offset of the first failure and the number of
+                        failures
+        """
+        try:
+            (magic, version, seq, failCount, lastEmailNum, numFails,
+                firstFail, failRunTime, cmdLen, metaLen) = \
+                cls.header.unpack_from(data)
+        except struct.error as e:
+            raise ValueError('Invalid state header: %s' % e)
+        if magic != cls.magic or version != cls.version:
+            raise ValueError('Unknown state format: %r, %r' % (magic,
+                version))
+        off = cls.header.size
+        if off + cmdLen + metaLen > len(data):
+            raise ValueError('Truncated state header')
+        cmdList = bytes(data[off:off + cmdLen]).decode('utf-8').split('\0')
+        off += cmdLen
+        meta = data[off:off + metaLen]
+        off += metaLen
+        st = CommandState(opts, cmdList)
+        st.failCount = failCount
+        st.failRunTime = failRunTime
+        if firstFail == firstFail:
+            # Not a NaN
+            st.firstFailTime = firstFail
+        st._lastEmailNum = lastEmailNum
+        st._journalSeq = seq
+        cls.applyMeta(st, meta)
+        return (st, off, numFails)
+
+    @classmethod
+    def encodeFailure(cls, f, refs=None):
+        """
+        Returns the bytes for a single failure.  If refs, an OutputRefs, is
+        given, output already stored with an earlier failure is stored as a
+        reference to it.
+        """
+        flags = 0
+        blobs = []
+        for stored, compFlag, refFlag in zip(f.getStoredOutput(),
+                (cls.F_STDOUT_COMP, cls.F_STDERR_COMP),
+                (cls.F_STDOUT_REF, cls.F_STDERR_REF)):
+            if isinstance(stored, bytes):
+                flags |= compFlag
+                blob = stored
+            else:
+                blob = stored.encode('utf-8')
+            if refs is not None and len(blob) > OUTPUT_DIGEST_SIZE:
+                digest = refs.getRef(stored)
+                if digest is not None:
+                    flags |= refFlag
+                    blob = digest
+            blobs.append(blob)
+        out, err = blobs
+        pyErr = f.pyError.encode('utf-8')
+        rusage = b''
+        if f.warning:
+            flags |= cls.F_WARNING
+        if f.rusage:
+            flags |= cls.F_RUSAGE
+            rusage = cls.failRusage.pack(*f.rusage)
+        return b''.join((cls.failHeader.pack(f.timeStarted, f.runTime,
+            f.exitCode, flags, len(out), len(err), len(pyErr)), rusage, out,
+            err, pyErr))
+
+    @classmethod
+    def decodeFailure(cls, data, off, command, refs=None):
+        """
+        Decodes the failure at offset, off, in data and returns a tuple of
+        the Failure and the offset following it.  refs is the OutputRefs
+        of the failures before it in data, which this failure's output is
+        added to.
+        """
+        try:
+            start, runTime, exitCode, flags, outLen, errLen, pyLen = \
+                cls.failHeader.unpack_from(data, off)
+        except struct.error as e:
+            raise ValueError('Invalid failure header: %s' % e)
+        off += cls.failHeader.size
+        rusage = None
+        if flags & cls.F_RUSAGE:
+            try:
+                rusage = cls.failRusage.unpack_from(data, off)
+            except struct.error as e:
+                raise ValueError('Invalid failure rusage: %s' % e)
+            off += cls.failRusage.size
+        blobs = []
+        for length, comp, ref in (
+                (outLen, flags & cls.F_STDOUT_COMP, flags & cls.F_STDOUT_REF),
+                (errLen, flags & cls.F_STDERR_COMP, flags & cls.F_STDERR_REF),
+                (pyLen, 0, 0)):
+            if off + length > len(data):
+                raise ValueError('Truncated failure record')
+            blob = bytes(data[off:off + length])
+            off += length
+            if ref:
+                if refs is None:
+                    raise ValueError('Unknown output reference')
+                # The failures share the one copy of the output
+                blobs.append(refs.resolve(blob))
+                continue
+            # Compressed output is only decompressed when it's read
+            if not comp:
+                blob = blob.decode('utf-8')
+            if refs is not None and length > OUTPUT_DIGEST_SIZE:
+                refs.add(blob)
+            blobs.append(blob)
+        return (Failure(command, start, runTime, exitCode, *blobs,
+            rusage=rusage, warning=bool(flags & cls.F_WARNING)), off)
+
+
+class BinaryStateFile(StateFile):
+    """
+    A state file which stores the CommandState in the compact StateCodec
+    format instead of as a pickle.  The file is replaced atomically on save.
+    """
+    def __init__(self, name, mode='rb+', buffering=-1, lockFile=None,
+            opts=None):
+        StateFile.__init__(self, name, mode, buffering, lockFile,
+            **StateFile.getLockArgs(opts))
+        self._name = name
+        self._opts = opts
+
+    @classmethod
+    def fromOpts(cls, name, opts, lockFile=None):
+        return cls(name, lockFile=lockFile, opts=opts)
+
+    def getObject(self):
+        """
+        Returns the CommandState stored in the state file, if any
+        """
+        self.seek(0)
+        data = self.read()
+        if not data.startswith(StateCodec.magic):
+            # Possibly a state file from the pickle backend
+            obj = StateFile.getObject(self)
+            if isinstance(obj, CommandState):
+                return obj
+            return None
+        try:
+            obj = StateCodec.decode(data, self._opts)
+        except ValueError:
+            return None
+        self._upgrade(obj)
+        return obj
+
+    def saveObject(self, obj):
+        atomicWrite(self._name, StateCodec.encode(obj))
+
+
+class LogStateFile(BinaryStateFile):
+    """
+    A state file which is kept as a snapshot of the CommandState plus an
+    append-only journal of the run records since that snapshot.  A run
+    only appends a small record to the journal and the journal is
+    periodically compacted into a new snapshot.  The snapshot is replaced
+    atomically and journal records carry a checksum so that a crash
+    mid-write cannot corrupt the history.
+    """
+    # magic, version, record type, sequence number, payload length, crc32
+    recHeader = struct.Struct('>4sBBQII')
+    recMagic = b'CWRJ'
+    # Version 1 records have pickled payloads, version 2 use the StateCodec
+    # and version 3 adds the StateCodec meta section
+    recVersion = 3
+    # The last email number which precedes the failure in a version 2
+    # payload
+    recEmailNum = struct.Struct('>I')
+    # The last email number and meta length which precede the meta and the
+    # failure in a version 3 payload
+    recPrefix = struct.Struct('>II')
+
+    def __init__(self, name, mode='rb+', buffering=-1, lockFile=None,
+            opts=None, compactEvery=100):
+        BinaryStateFile.__init__(self, name, mode, buffering, lockFile, opts)
+        self._journalName = '%s.journal' % name
+        self._compactEvery = compactEvery
+        self._numRecords = 0
+
+    @classmethod
+    def fromOpts(cls, name, opts, lockFile=None):
+        return cls(name, lockFile=lockFile, opts=opts,
+            compactEvery=opts.compactEvery)
+
+    def getObject(self):
+        """
+        Returns the snapshot with all the journal records replayed on it
+        """
+        obj = BinaryStateFile.getObject(self)
+        if obj is None:
+            return None
+        self._numRecords = self.replayJournal(obj, self._journalName)
+        return obj
+
+    @classmethod
+    def replayJournal(cls, obj, journalName, truncate=True):
+        """
+        Replays the records in the journal, which aren't already in the
+        snapshot, on obj.  If truncate is set, a corrupt tail of the journal
+        is truncated off.
+
+            returns -> <int>:   The number of records replayed
+        """
+        numRecords = 0
+        for recType, ver, seq, payload in cls._readJournal(journalName,
+                truncate):
+            if seq <= obj._journalSeq:
+                # Already in the snapshot
+                continue
+            meta = None
+            if ver == 1:
+                import pickle
+                fail, lastEmailNum = pickle.loads(payload)
+            elif ver == 2:
+                lastEmailNum, = cls.recEmailNum.unpack_from(payload)
+                fail = None
+                if len(payload) > cls.recEmailNum.size:
+                    fail = StateCodec.decodeFailure(payload,
+                        cls.recEmailNum.size, obj.cmdList)[0]
+            else:
+                lastEmailNum, metaLen = cls.recPrefix.unpack_from(payload)
+                off = cls.recPrefix.size
+                meta = payload[off:off + metaLen]
+                off += metaLen
+                fail = None
+                if len(payload) > off:
+                    fail = StateCodec.decodeFailure(payload, off,
+                        obj.cmdList)[0]
+            obj.applyRecord(recType, fail, lastEmailNum)
+            StateCodec.applyMeta(obj, meta)
+            obj._journalSeq = seq
+            numRecords += 1
+        return numRecords
+
+    def saveObject(self, obj):
+        """
+        Appends the record for the last run to the journal, compacting the
+        journal into a new snapshot when needed
+        """
+        if os.path.getsize(self._name) == 0 or \
+                self._numRecords >= self._compactEvery:
+            return self.compact(obj)
+        if obj._lastRecord is None:
+            # Nothing changed in this run
+            return
+        import zlib
+        meta = StateCodec.encodeMeta(obj)
+        payload = self.recPrefix.pack(obj._lastEmailNum, len(meta)) + meta
+        if obj._lastRecord == REC_FAIL:
+            payload += StateCodec.encodeFailure(obj.failures[-1])
+        obj._journalSeq += 1
+        rec = self.recHeader.pack(self.recMagic, self.recVersion,
+            obj._lastRecord, obj._journalSeq, len(payload),
+            zlib.crc32(payload)) + payload
+        fd = os.open(self._journalName, os.O_CREAT | os.O_WRONLY |
+            os.O_APPEND, 0o600)
+        with os.fdopen(fd, 'wb') as fh:
+            fh.write(rec)
+            fh.flush()
+            os.fsync(fh.fileno())
+        self._numRecords += 1
+
+    def saveSnapshot(self, obj):
+        self.compact(obj)
+
+    def compact(self, obj):
+        """
+        Writes a new snapshot atomically and empties the journal
+        """
+        obj._lastRecord = None
+        BinaryStateFile.saveObject(self, obj)
+        # The snapshot has the sequence number of the last record in it so
+        # a crash before this truncation just means the records are skipped
+        if os.path.exists(self._journalName):
+            with open(self._journalName, 'r+b') as fh:
+                fh.truncate(0)
+        self._numRecords = 0
+
+    @classmethod
+    def _readJournal(cls, journalName, truncate=True):
+        """
+        Generator for the valid records in the journal.  Reading stops at
+        the first incomplete or corrupt record, which is then truncated off
+        if truncate is set.
+        """
+        if not os.path.exists(journalName):
+            return
+        import zlib
+        with open(journalName, 'r+b' if truncate else 'rb') as fh:
+            if not truncate and not isOwnFile(fh):
+                # A report, which only reads the caller's own journals as
+                # they can hold pickles, see _readStateFile()
+                return
+            good = 0
+            while True:
+                head = fh.read(cls.recHeader.size)
+                if not head:
+                    break
+                try:
+                    magic, ver, recType, seq, length, crc = \
+                        cls.recHeader.unpack(head)
+                except struct.error:
+                    break
+                if magic != cls.recMagic or ver not in (1, 2, 3):
+                    break
+                payload = fh.read(length)
+                if len(payload) != length or zlib.crc32(payload) != crc:
+                    break
+                good = fh.tell()
+                yield (recType, ver, seq, payload)
+            if truncate and good != fh.seek(0, os.SEEK_END):
+                fh.truncate(good)
+
+
+class SqliteStateFile(StateFile):
+    """
+    Keeps the state of all the jobs in a single SQLite database, one row
+    per job.  The CommandState is stored in the StateCodec format, along
+    with indexed columns for the last status, run time and failure streak
+    so the state of all the jobs can be queried quickly.  Instead of lock
+    files, a job is locked by claiming its row with the PID of the running
+    cwrap.  A claim by a PID which no longer exists is stale and is taken
+    over.
+    """
+    schema = (
+        '''CREATE TABLE IF NOT EXISTS jobs (
+            name TEXT PRIMARY KEY,
+            hash TEXT NOT NULL,
+            command TEXT,
+            last_status INTEGER,
+            last_run_time REAL,
+            last_runtime REAL,
+            num_fails INTEGER NOT NULL DEFAULT 0,
+            run_count INTEGER NOT NULL DEFAULT 0,
+            state BLOB,
+            lock_pid INTEGER,
+            lock_time REAL
+        )''',
+        'CREATE INDEX IF NOT EXISTS jobs_hash ON jobs (hash)',
+        'CREATE INDEX IF NOT EXISTS jobs_last_status ON jobs (last_status)',
+        'CREATE INDEX IF NOT EXISTS jobs_last_run_time ON jobs '
+            '(last_run_time)',
+        'CREATE INDEX IF NOT EXISTS jobs_failing ON jobs (num_fails) '
+            'WHERE num_fails > 0',
+    )
+    # The seconds to wait for another connection's write transaction
+    busyTimeout = 10
+
+    def __init__(self, name, lockFile=None, opts=None):
+        """
+        name<str>:          The path the state file would have with the
+                            file backends, which identifies the job
+        """
+        self._name = name
+        self._opts = opts
+        self._conn = None
+        self._locked = False
+        self._lockFd = None
+        self._lockName = lockFile
+        lockArgs = StateFile.getLockArgs(opts)
+        self._lockMode = lockArgs.get('lockMode', 'file')
+        self._lockWait = lockArgs.get('lockWait', 0)
+        # An explicit lock file is still honored, as it may be shared with
+        # other commands
+        if lockFile:
+            self._lock()
+        import sqlite3
+        try:
+            self._conn = self.connect(self.getDbName(opts))
+            self._lockRow()
+        except sqlite3.OperationalError as e:
+            # The database stayed locked by other writers for longer than
+            # the busy timeout, which is another job holding the lock
+            self.close()
+            raise LockError('State database is busy, cannot lock the job '
+                'in %s: %s' % (self.getDbName(opts), e))
+        except Exception:
+            self.close()
+            raise
+
+    @classmethod
+    def fromOpts(cls, name, opts, lockFile=None):
+        return cls(name, lockFile=lockFile, opts=opts)
+
+    @staticmethod
+    def getDbName(opts):
+        return opts.stateDb or os.path.join(opts.stateDir, 'cwrap.db')
+
+    @classmethod
+    def connect(cls, dbName, readOnly=False):
+        """
+        Returns a connection to the database, creating it if need be
+        """
+        import sqlite3
+        if readOnly:
+            return sqlite3.connect('file:%s?mode=ro' % dbName, uri=True,
+                timeout=cls.busyTimeout, isolation_level=None)
+        if not os.path.exists(dbName):
+            os.close(os.open(dbName, os.O_CREAT | os.O_WRONLY, 0o600))
+        # A batch run and the daemon use a job's connection from whichever
+        # worker thread handles the job, but never from two at once
+        conn = sqlite3.connect(dbName, timeout=cls.busyTimeout,
+            isolation_level=None, check_same_thread=False)
+        # WAL lets the status queries run while jobs are being saved, and
+        # with it a NORMAL sync only risks the last commits on power loss
+        conn.execute('PRAGMA journal_mode=WAL')
+        conn.execute('PRAGMA synchronous=NORMAL')
+        for stmt in cls.schema:
+            conn.execute(stmt)
+        return conn
+
+    def close(self):
+        if self._conn is not None:
+            if self._locked:
+                try:
+                    self._conn.execute('UPDATE jobs SET lock_pid = NULL, '
+                        'lock_time = NULL WHERE name = ? AND lock_pid = ?',
+                        (self._key(), os.getpid()))
+                except Exception as e:
+                    # The claim is stale once we exit, so it's taken over
+                    print('Failed to unlock "{}" in {}: {}'.format(
+                        self._key(), self.getDbName(self._opts), e),
+                        file=sys.stderr)
+                self._locked = False
+            self._conn.close()
+            self._conn = None
+        if self._lockName:
+            self._unlock()
+
+    def getObject(self):
+        """
+        Returns the CommandState of the job, migrating it from a state file
+        of the other backends if it isn't in the database yet
+        """
+        row = self._conn.execute('SELECT state FROM jobs WHERE name = ?',
+            (self._key(),)).fetchone()
+        if row is None or row[0] is None:
+            if os.path.exists(self._name):
+                return readState(self._name, self._opts)
+            return None
+        try:
+            obj = StateCodec.decode(row[0], self._opts)
+        except (ValueError, struct.error):
+            return None
+        self._upgrade(obj)
+        return obj
+
+    def saveObject(self, obj):
+        self._conn.execute('UPDATE jobs SET state = ?, command = ?, '
+            'last_status = ?, last_run_time = ?, last_runtime = ?, '
+            'num_fails = ?, run_count = ? WHERE name = ? AND lock_pid = ?',
+            (StateCodec.encode(obj), ' '.join(obj.cmdList), obj.lastExitCode,
+            obj.lastRunEnd,
+            obj.lastRunTime, obj.NumFails, obj.runCount, self._key(),
+            os.getpid()))
+
+    def _key(self):
+        return os.path.basename(self._name)
+
+    def _lockRow(self):
+        """
+        Claims the row of the job, creating it if need be, or raises
+        LockError if another running cwrap has it
+        """
+        key = self._key()
+        deadline = time.monotonic() + self._lockWait
+        while True:
+            self._conn.execute('BEGIN IMMEDIATE')
+            try:
+                row = self._conn.execute('SELECT lock_pid FROM jobs WHERE '
+                    'name = ?', (key,)).fetchone()
+                if row is None:
+                    self._conn.execute('INSERT INTO jobs (name, hash, '
+                        'lock_pid, lock_time) VALUES (?, ?, ?, ?)', (key,
+                        splitStateFileName(key)[1], os.getpid(), time.time()))
+                    self._locked = True
+                elif row[0] is None or (row[0] != os.getpid() and
+                        not pidExists(row[0])):
+                    self._conn.execute('UPDATE jobs SET lock_pid = ?, '
+                        'lock_time = ? WHERE name = ?', (os.getpid(),
+                        time.time(), key))
+                    self._locked = True
+                self._conn.execute('COMMIT')
+            except Exception:
+                self._conn.execute('ROLLBACK')
+                raise
+            if self._locked:
+                return
+            if time.monotonic() >= deadline:
+                raise LockError('Job is locked by PID %d in %s: %s' % (
+                    row[0], self.getDbName(self._opts), key), row[0])
+            time.sleep(0.05)
+
+    @classmethod
+    def iterStates(cls, opts, failingOnly=False, summary=False, name=None):
+        """
+        Generator for the (state file name, CommandState) of the jobs in the
+        database, from a consistent snapshot and without locking them
+
+            summary<bool>:  Don't decode the failure history of the states
+            name<str>:      Only the job with this state file name
+        """
+        dbName = cls.getDbName(opts)
+        if not os.path.exists(dbName):
+            return
+        decode = StateCodec.decodeSummary if summary else StateCodec.decode
+        conn = cls.connect(dbName, True)
+        try:
+            sql = 'SELECT name, state FROM jobs WHERE state IS NOT NULL'
+            args = ()
+            if failingOnly:
+                sql += ' AND num_fails > 0'
+            if name:
+                sql += ' AND name = ?'
+                args = (os.path.basename(name),)
+            conn.execute('BEGIN')
+            for key, data in conn.execute(sql + ' ORDER BY name', args):
+                try:
+                    st = decode(data, opts)
+                except (ValueError, struct.error):
+                    continue
+                cls._upgrade(st)
+                yield (os.path.join(opts.stateDir, key), st)
+            conn.execute('COMMIT')
+        finally:
+            conn.close()
+
+STATE_BACKENDS = {
+    'pickle': StateFile,
+    'binary': BinaryStateFile,
+    'log': LogStateFile,
+    'sqlite': SqliteStateFile,
+}
+
 
 class Failure(object):
     """
     This is a simple class to encapsulate the items pertaining to a failure
     """
+    __slots__ = ('command', 'timeStarted', 'runTime', 'exitCode', '_stdout',
+        '_stderr', 'pyError', 'rusage', 'warning')
+    # The values of the attributes missing from older pickled failures
+    defaults = {'rusage': None, 'warning': False}
     mainDelim = '=' * 40
     subDelim = '-' * 40
     def __init__(self, command, timeStarted, runTime, exitCode,
-            stdout='', stderr='', pythonError=''):
+            stdout='', stderr='', pythonError='', rusage=None, warning=False):
         """
         Pass in all the info for a command run
 
@@ -245,31 +1314,127 @@ class Failure(object):
             timeStarted<float>: The timestamp for when this was started
             runTime<float>:     The amount of time that the process ran for
             exitCode<int>:      The exit code from the process
-            stdout<str>:        The output printed to stdout
-            stderr<str>:        The output printed to stderr
+            stdout<str>:        The output printed to stdout, or those
+                                bytes from compressOutput()
+            stderr<str>:        The output printed to stderr, or those
+                                bytes from compressOutput()
             pythonError<str>:   An error that occured in Python trying to
                                 run the program (exitCode should be -1)
+            rusage<tuple>:      The resource usage of the process, see
+                                RUSAGE_FIELDS
+            warning<bool>:      The run succeeded but is reported as a
+                                warning, e.g. a run time anomaly with
+                                "--anomaly warn"
         """
         self.command = command
         self.timeStarted = timeStarted
         self.runTime = runTime
         self.exitCode = exitCode
-        self.stdout = stdout
-        self.stderr = stderr
+        self._stdout = stdout
+        self._stderr = stderr
         self.pyError = pythonError
+        self.rusage = rusage
+        self.warning = warning
+
+    def getStatus(self):
+        """
+        Returns the status of the run, "warning" or "failure"
+        """
+        return 'warning' if self.warning else 'failure'
+
+    def getStdout(self):
+        return decompressOutput(self._stdout)
+
+    def setStdout(self, stdout):
+        self._stdout = stdout
+    stdout = property(getStdout, setStdout)
+
+    def getStderr(self):
+        return decompressOutput(self._stderr)
+
+    def setStderr(self, stderr):
+        self._stderr = stderr
+    stderr = property(getStderr, setStderr)
+
+    def getStoredOutput(self):
+        """
+        Returns the (stdout, stderr) as they are stored, each either the text
+        or its compressed bytes
+        """
+        return (self._stdout, self._stderr)
+
+    def compress(self, codec):
+        """
+        Compresses the stored output with the codec, see compressOutput().
+        It's only decompressed when it's read.
+        """
+        self._stdout = compressOutput(self._stdout, codec)
+        self._stderr = compressOutput(self._stderr, codec)
+
+    def shareOutput(self, other):
+        """
+        Makes this failure reference the stored output of the other failure
+        where they are the same, so it's only kept, and pickled, once
+        """
+        if self._stdout == other._stdout:
+            self._stdout = other._stdout
+        if self._stderr == other._stderr:
+            self._stderr = other._stderr
+
+    def getDigest(self):
+        """
+        Returns a digest of the exit code and the output, which is the same
+        for failures which failed the same way
+        """
+        h = blake2b(digest_size=OUTPUT_DIGEST_SIZE)
+        h.update(str(self.exitCode).encode('utf-8'))
+        for stored in self.getStoredOutput():
+            h.update(outputDigest(stored))
+        h.update(self.pyError.encode('utf-8', 'surrogateescape'))
+        return h.digest()
+
+    def __getstate__(self):
+        # The output is pickled as it's stored, compressed or not
+        return dict((k.lstrip('_'), getattr(self, k)) for k in self.__slots__)
+
+    def __setstate__(self, state):
+        # Failures pickled before __slots__ was added have a plain dict
+        # state, newer ones may have a (None, slots) tuple
+        if isinstance(state, tuple):
+            state = state[1]
+        for k in self.__slots__:
+            setattr(self, k, state.get(k.lstrip('_'),
+                self.defaults.get(k, '')))
+
+    def asDict(self):
+        """
+        Returns the failure as a dict for JSON
+        """
+        ret = self.__getstate__()
+        ret['stdout'] = self.stdout
+        ret['stderr'] = self.stderr
+        if self.rusage:
+            ret['rusage'] = dict(zip(RUSAGE_FIELDS, self.rusage))
+        return ret
 
     def __str__(self):
+        stdout = self.stdout
+        stderr = self.stderr
         ret = '%s\nCommand: %s\n' % (self.mainDelim, ' '.join(self.command))
         ret += 'Start Time: %s\n' % time.ctime(self.timeStarted)
         ret += 'Run Time (seconds): %.02f\n' % self.runTime
         ret += 'Exit Code: %d (-1 is a python error)\n' % self.exitCode
-        if self.stdout:
-            ret += '\nSTDOUT:\n%s\n%s\n%s\n' % (self.subDelim, self.stdout,
+        if self.warning:
+            ret += 'Status: warning, the command succeeded\n'
+        if self.rusage:
+            ret += 'Resources: %s\n' % formatRusage(self.rusage)
+        if stdout:
+            ret += '\nSTDOUT:\n%s\n%s\n%s\n' % (self.subDelim, stdout,
                 self.subDelim)
-        if self.stderr:
-            ret += '\nSTDERR:\n%s\n%s\n%s\n' % (self.subDelim, self.stderr,
+        if stderr:
+            ret += '\nSTDERR:\n%s\n%s\n%s\n' % (self.subDelim, stderr,
                 self.subDelim)
-        if not self.stdout and not self.stderr:
+        if not stdout and not stderr:
             ret += '\nNothing printed to STDOUT or STDERR\n'
         if self.pyError:
             ret += '\nPYTHON ERROR:\n%s\n%s\n%s\n' % (self.subDelim,
@@ -277,11 +1442,232 @@ class Failure(object):
         ret += '%s\n' % self.mainDelim
         return ret
 
-class CommandState(object):
+
+class RingBuffer(object):
     """
-    This is the object that will be used to maintain the state of failures
-    of the process that this script is wrapping.  This object instance will
-    be serialized to disk and imported to preserve all state when run.
+    A byte buffer that only keeps the most recent maxSize bytes written to it
+    """
+    def __init__(self, maxSize=0):
+        """
+        maxSize<int>:       The maximum number of bytes to keep.  Zero means
+                            that the buffer is unbounded.
+        """
+        self.maxSize = maxSize
+        self.total = 0
+        self._buf = bytearray()
+
+    def write(self, data):
+        self.total += len(data)
+        self._buf += data
+        if self.maxSize and len(self._buf) > self.maxSize:
+            del self._buf[:len(self._buf) - self.maxSize]
+
+    def getNumDropped(self):
+        return self.total - len(self._buf)
+    numDropped = property(getNumDropped)
+
+    def getvalue(self):
+        return bytes(self._buf)
+
+
+class OutputCapture(object):
+    """
+    This handles the output of a single stream (stdout or stderr) of the
+    wrapped command.  The output is kept in a bounded ring buffer and can
+    optionally be written in full to a spill file and/or passed through live
+    to one of our own streams.
+    """
+    def __init__(self, maxSize=0, spillName=None, passthrough=None):
+        """
+        maxSize<int>:           The size of the in memory ring buffer, zero
+                                for unbounded
+        spillName<str>:         The path of a file to write the full output to
+        passthrough<file>:      A binary file object to write the output to
+                                as it arrives
+        """
+        self.buf = RingBuffer(maxSize)
+        self.spillName = spillName
+        self.passthrough = passthrough
+        self._spill = None
+        if spillName:
+            fd = os.open(spillName, os.O_CREAT | os.O_WRONLY | os.O_TRUNC,
+                0o600)
+            self._spill = os.fdopen(fd, 'wb')
+
+    def write(self, data):
+        self.buf.write(data)
+        if self._spill:
+            self._spill.write(data)
+        if self.passthrough:
+            self.passthrough.write(data)
+            self.passthrough.flush()
+
+    def close(self):
+        if self._spill:
+            self._spill.close()
+            self._spill = None
+
+    def getText(self):
+        """
+        Returns the captured output, decoded, with a marker prepended if the
+        beginning of the output was dropped from the ring buffer
+        """
+        ret = self.buf.getvalue().decode('utf-8', 'ignore')
+        if self.buf.numDropped:
+            marker = '[... %d bytes truncated' % self.buf.numDropped
+            if self.spillName:
+                marker += ', full output in %s' % self.spillName
+            ret = '%s ...]\n%s' % (marker, ret)
+        return ret
+
+    def copyTo(self, fh):
+        """
+        Writes the full output to the binary file object, fh, reading it
+        from the spill file if there is one.  Otherwise, it's the output
+        kept in the ring buffer, after a marker if the beginning of it was
+        dropped.
+        """
+        if self.spillName:
+            import shutil
+            with open(self.spillName, 'rb') as spill:
+                shutil.copyfileobj(spill, fh, CHUNK_SIZE)
+        else:
+            if self.buf.numDropped:
+                fh.write(('[... %d bytes truncated, see --capture-limit '
+                    '...]\n' % self.buf.numDropped).encode('utf-8'))
+            fh.write(self.buf.getvalue())
+        fh.flush()
+
+
+class RunSlots(object):
+    """
+    A host-wide counting semaphore which limits the number of commands run
+    at once by all the cwraps of a user sharing a state directory.  Each
+    slot is a token file in the user's "cwrap-slots.<uid>" directory which
+    is held with an flock while a command runs, so the slot of a cwrap which
+    dies is freed by the kernel.  A cwrap waiting for a slot registers a
+    file with its priority, PID and thread, and a free slot is only taken if
+    no waiter with a higher priority is still alive.
+    """
+    pollInterval = 0.05
+
+    def __init__(self, stateDir, numSlots, priority=0, wait=0):
+        """
+            numSlots<int>:      The number of commands which can run at once
+            priority<int>:      Waiters with a higher priority get a slot
+                                first
+            wait<float>:        The seconds to wait for a slot before giving
+                                up, zero waits forever
+        """
+        # The slots are per user, as the files are private
+        self._dir = os.path.join(stateDir, 'cwrap-slots.%d' % os.getuid())
+        self._numSlots = numSlots
+        self._priority = priority
+        self._wait = wait
+        self._fd = None
+
+    @classmethod
+    def fromOpts(cls, opts):
+        """
+        Returns the slots for the options, or None if the number of commands
+        run at once isn't limited
+        """
+        if not opts.maxRunning:
+            return None
+        return cls(opts.stateDir, opts.maxRunning, opts.slotPriority,
+            opts.slotWait)
+
+    def acquire(self):
+        """
+        Blocks until a slot is taken or raises LockError after waiting for
+        the wait period
+        """
+        if not os.path.isdir(self._dir):
+            os.makedirs(self._dir, 0o700, exist_ok=True)
+        if os.stat(self._dir).st_uid != os.getuid():
+            raise LockError('The run slots directory %s belongs to another '
+                'user' % self._dir)
+        waitName = None
+        deadline = None
+        if self._wait:
+            deadline = time.monotonic() + self._wait
+        try:
+            while True:
+                if not self._higherWaiting():
+                    self._fd = self._take()
+                    if self._fd is not None:
+                        return
+                if waitName is None:
+                    # The thread tells apart the waiters of a daemon or a
+                    # batch, which share the PID
+                    import threading
+                    waitName = os.path.join(self._dir, 'wait.%d.%d.%d' % (
+                        self._priority, os.getpid(),
+                        threading.get_native_id()))
+                    os.close(os.open(waitName, os.O_CREAT | os.O_WRONLY,
+                        0o600))
+                if deadline is not None and time.monotonic() >= deadline:
+                    raise LockError('Timed out after %g seconds waiting for '
+                        'one of the %d run slots in %s' % (self._wait,
+                        self._numSlots, self._dir))
+                time.sleep(self.pollInterval)
+        finally:
+            if waitName is not None:
+                try:
+                    os.unlink(waitName)
+                except OSError:
+                    pass
+
+    def release(self):
+        if self._fd is not None:
+            fcntl.flock(self._fd, fcntl.LOCK_UN)
+            os.close(self._fd)
+            self._fd = None
+
+    def _take(self):
+        """
+        Returns the fd of the slot taken, or None if they are all taken
+        """
+        for i in range(self._numSlots):
+            fd = os.open(os.path.join(self._dir, 'slot.%d' % i),
+                os.O_CREAT | os.O_RDWR, 0o600)
+            try:
+                fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                os.close(fd)
+                continue
+            return fd
+        return None
+
+    def _higherWaiting(self):
+        """
+        Returns whether a live waiter has a higher priority, removing the
+        files of the waiters which have died
+        """
+        for name in os.listdir(self._dir):
+            parts = name.split('.')
+            if len(parts) != 4 or parts[0] != 'wait':
+                continue
+            try:
+                priority, pid = int(parts[1]), int(parts[2])
+            except ValueError:
+                continue
+            if priority <= self._priority:
+                continue
+            if pidExists(pid):
+                return True
+            try:
+                os.unlink(os.path.join(self._dir, name))
+            except OSError:
+                pass
+        return False
+
+
+class CommandState(object):
+    """
+    This is the object that will be used to maintain the state of failures
+    of the process that this script is wrapping.  This object instance will
+    be serialized to disk and imported to preserve all state when run.
     """
     def __init__(self, opts, cmdList):
         """
@@ -298,99 +1684,621 @@ class CommandState(object):
         self.cmdList = cmdList
         self._reset()
         self._ph = None
+        # Whether the command runs in its own process group, see
+        # _getSpawnArgs()
+        self._ownGroup = False
         # This is used for calculating backoffs
         self._lastEmailNum = 0
+        # These are used by the log state backend to journal each run
+        self._journalSeq = 0
+        self._lastRecord = None
+        # The resource usage of the last run, successful or not
+        self.lastRusage = None
+        self._resetMetrics()
+        self._resetRuntimeStats()
 
     def getNumFails(self):
-        return len(self.failures)
+        return self.failCount
     NumFails = property(getNumFails)
 
+    def getNumDropped(self):
+        return self.failCount - len(self.failures)
+    NumDropped = property(getNumDropped)
+
     def cleanup(self):
         try:
-            self._ph.terminate()
-            if self._ph.poll() is None:
-                self._ph.kill()
+            if self._ph.returncode is None:
+                self._signal(signal.SIGKILL)
         except:
             pass
         self._ph = None
 
-    def run(self):
+    def __getstate__(self):
+        # Don't serialize the process handle or the output streams
+        state = self.__dict__.copy()
+        for k in ('_ph', '_out', '_err', '_startMono', '_rusage',
+                '_treeRss', '_notifiers', '_timeout', '_ownGroup'):
+            state.pop(k, None)
+        return state
+
+    def run(self, out=None, err=None, env=None, cwd=None):
         """
         Performs this run and prints an error report if necessary.
+
+            out<file>:      The binary file object to write our output to,
+                            the default is stdout
+            err<file>:      The binary file object to write the command's
+                            stderr to, the default is stderr
+            env<dict>:      The environment to run the command with, the
+                            default is our own
+            cwd<str>:       The directory to run the command in, the default
+                            is our own
         """
         if self.opts.fuzz:
-            time.sleep(randint(0, self.opts.fuzz))
-        start = self.lastRunStartTime = time.time()
-        stdout = ''
-        stderr = ''
-        if self.opts.timeout:
-            # We set an alarm for the execution of this program since a
-            # timeout was set
-            signal.signal(signal.SIGALRM, self._timeoutHandler)
-            signal.alarm(self.opts.timeout)
-        try:
-            if self.opts.singStr:
-                self._ph = sp.Popen(self.cmdList[0], shell=True,
-                    stdout=sp.PIPE, stderr=sp.PIPE, encoding='utf-8',
-                    errors='ignore')
-            else:
-                self._ph = sp.Popen(self.cmdList, stdout=sp.PIPE,
-                    stderr=sp.PIPE, encoding='utf-8', errors='ignore')
-            stdout, stderr = self._ph.communicate()
-            if self.opts.timeout:
-                # If we get here, disable the alarm
-                signal.alarm(0)
+            time.sleep(self.getFuzzDelay())
+        slots, slotError = self._getSlot()
+        self._startRun(out, err)
+        outCap, errCap = self._getCaptures()
+        if slotError:
+            return self._finishRun(-1, outCap, errCap, slotError)
+        deadline = None
+        if self._timeout:
+            # The capture loop enforces the timeout
+            deadline = self._startMono + self._timeout
+        try:
+            argv, kwargs = self._getSpawnArgs(env)
+            self._ph = sp.Popen(argv, stdout=sp.PIPE, stderr=sp.PIPE,
+                env=env, cwd=cwd, **kwargs)
+            self._capture(outCap, errCap, deadline)
         except Exception as e:
-            self.lastRunRunTime = time.time() - start
-            self.lastRunExitCode = -1
-            self.lastRunStdout = ''
-            self.lastRunStderr = ''
-            t = ''
-            if not isinstance(e, CmdTimeout):
-                import traceback
-                t = traceback.format_exc()
-            self.lastRunPyError = '%s\n%s' % (e, t)
-            self._procFail()
-            return False
-        self.lastRunRunTime = time.time() - start
-        self.lastRunExitCode = self._ph.returncode
-        self.lastRunStdout = stdout
-        self.lastRunStderr = stderr
-        self.lastRunPyError = ''
-        if self._ph.returncode == 0:
-            # We have a successful run, reset everything and then just
-            # print the stdout and stderr vals
-            self._reset()
-            if not self.opts.quiet:
-                sys.stdout.write(stdout)
-                sys.stderr.write(stderr)
-            return True
-        self._procFail()
-        return False
+            return self._finishRun(-1, outCap, errCap, self._getPyError(e))
+        finally:
+            if slots is not None:
+                slots.release()
+        return self._finishRun(self._ph.returncode, outCap, errCap)
+
+    async def runAsync(self, out, err, env=None, cwd=None):
+        """
+        The asyncio version of run().  This is used to run many commands
+        concurrently from a single event loop.
+        """
+        import asyncio
+        if self.opts.fuzz:
+            await asyncio.sleep(self.getFuzzDelay())
+        slots, slotError = await asyncio.to_thread(self._getSlot)
+        self._startRun(out, err)
+        outCap, errCap = self._getCaptures()
+        if slotError:
+            return self._finishRun(-1, outCap, errCap, slotError)
+        deadline = None
+        if self._timeout:
+            deadline = self._startMono + self._timeout
+        try:
+            argv, kwargs = self._getSpawnArgs(env)
+            # A plain Popen rather than an asyncio subprocess, whose child
+            # watcher would reap the process before wait4() could get its
+            # resource usage
+            self._ph = sp.Popen(argv, stdout=sp.PIPE, stderr=sp.PIPE,
+                env=env, cwd=cwd, **kwargs)
+            await self._captureAsync(outCap, errCap, deadline)
+        except Exception as e:
+            return self._finishRun(-1, outCap, errCap, self._getPyError(e))
+        finally:
+            if slots is not None:
+                slots.release()
+        return self._finishRun(self._ph.returncode, outCap, errCap)
 
-    def _timeoutHandler(self, signum, frame):
+    def _getSpawnArgs(self, env=None):
         """
-        This is just an alarm signal handler to handle the timeout specified
-        on the command line.
+        Returns the argv and the extra Popen keyword args to run the command
+        with.  With fast spawn, a "--single-string" command only goes
+        through the shell if it uses any shell syntax or isn't a binary or
+        "#!" script that exec can run, and where subprocess would fork(),
+        the command is run by its full path with close_fds off, which lets
+        subprocess use posix_spawn() instead.  A "--single-string" command
+        gets its own process group, whether or not it goes through the
+        shell, so that a timeout kills the whole pipeline and any
+        background children, not just the command.
+
+            returns -> (<list>, <dict>)
+        """
+        if env is None:
+            env = os.environ
+        path = env.get('PATH', os.defpath)
+        argv = self.cmdList
+        exe = None
+        kwargs = {}
+        self._ownGroup = self.opts.singStr
+        if self.opts.singStr:
+            kwargs['start_new_session'] = True
+            if self.opts.fastSpawn:
+                argv = splitSimpleCommand(self.cmdList[0])
+                if argv is not None:
+                    exe = findExecutable(argv[0], path)
+            if exe is None:
+                # The shell runs scripts without a "#!" line and reports a
+                # command which isn't found, as before
+                return (['/bin/sh', '-c', self.cmdList[0]], kwargs)
+        if not self.opts.fastSpawn or SUBPROCESS_VFORK:
+            return (argv, kwargs)
+        if exe is None:
+            exe = findExecutable(argv[0], path)
+        # Our own descriptors aren't inheritable, so there is nothing for
+        # close_fds to close but any inherited from our parent
+        kwargs['close_fds'] = False
+        if exe:
+            kwargs['executable'] = exe
+        return (argv, kwargs)
+
+    def getFuzzDelay(self):
+        """
+        Returns the seconds to delay the run by with "--fuzz".  This is an
+        offset into the fuzz window derived from the hash of the command
+        line, so a job always starts at the same offset and the jobs of a
+        host are spread evenly over the window instead of randomly.
+        """
+        dig = md5(''.join(self.cmdList).encode('utf-8')).digest()
+        return int.from_bytes(dig[:8], 'big') / 2 ** 64 * self.opts.fuzz
+
+    def _getSlot(self):
         """
-        self._ph.terminate()
-        if self._ph.poll() is None:
-            self._ph.kill()
-        raise CmdTimeout('Command reached timeout of %d seconds' %
-            self.opts.timeout)
+        Waits for a host-wide run slot if "--max-running" is set.  The wait
+        isn't part of the run time.
 
-    def _procFail(self):
+            returns -> (<RunSlots>, <str>):     The slots to release after
+                                                the run, or the error to
+                                                fail the run with if no slot
+                                                was free in time
+        """
+        slots = RunSlots.fromOpts(self.opts)
+        if slots is None:
+            return (None, None)
+        try:
+            slots.acquire()
+        except (LockError, OSError) as e:
+            return (None, '%s\n' % e)
+        return (slots, None)
+
+    def _startRun(self, out, err):
+        """
+        Sets up the output streams and the run variables for a new run
+        """
+        if out is None:
+            sys.stdout.flush()
+            out = sys.stdout.buffer
+        if err is None:
+            sys.stderr.flush()
+            err = sys.stderr.buffer
+        self._out = out
+        self._err = err
+        self._lastRecord = None
+        self._notifiers = getNotifiers(self.opts)
+        # The wall clock start time is for reports, the run time comes from
+        # the monotonic clock so clock steps don't affect it
+        self.lastRunStartTime = time.time()
+        self._startMono = time.monotonic()
+        self._timeout = self.getTimeout()
+        self._rusage = None
+        self._treeRss = 0
+
+    def _finishRun(self, exitCode, outCap, errCap, pyError=''):
+        """
+        Records the outcome of the run and either passes the output through
+        on success or processes the failure.
+
+            returns -> <bool>:  Whether the run was successful
+        """
+        outCap.close()
+        errCap.close()
+        self.lastRunRunTime = time.monotonic() - self._startMono
+        self.lastRunExitCode = exitCode
+        self.lastRunPyError = pyError
+        self.lastRunRusage = self.lastRusage = self._rusage
+        anomaly = None
+        if exitCode == 0:
+            anomaly = self._checkRuntime(self.lastRunRunTime)
+            if self.opts.anomaly == 'off':
+                anomaly = None
+        failed = exitCode != 0 or (anomaly is not None and
+            self.opts.anomaly == 'fail')
+        self._updateMetrics(not failed)
+        if not failed:
+            # We have a successful run, print the stdout and stderr vals
+            if not self.opts.quiet and not self.opts.liveOutput:
+                outCap.copyTo(self._out)
+                errCap.copyTo(self._err)
+            if not anomaly:
+                # Reset everything
+                self._lastRecord = REC_SUCCESS
+                self._reset()
+                return True
+            self._err.write(('WARNING: %s: %s\n' % (' '.join(
+                self.cmdList), anomaly)).encode('utf-8'))
+            self._err.flush()
+        if exitCode == 0:
+            self.lastRunPyError = anomaly
+        # The output is only decoded for a failure, which reports it.  A
+        # warning is recorded and reported like a failure too, with its own
+        # status.
+        self.lastRunStdout = outCap.getText()
+        self.lastRunStderr = errCap.getText()
+        self._procFail(not failed)
+        return not failed
+
+    def _resetRuntimeStats(self):
+        """
+        Initializes the streaming run time statistics of the successful
+        runs: the exponentially weighted mean and variance and a decaying
+        quantile sketch, which all take constant space
+        """
+        self.runTimeMean = None
+        self.runTimeVar = 0.0
+        # [bin, weight] pairs for the non-empty bins
+        self.runTimeSketch = []
+        self.runTimeSamples = 0
+        # The number of consecutive anomalies
+        self.anomalyStreak = 0
+        self.anomalyCount = 0
+
+    def _updateRuntimeStats(self, runTime):
+        """
+        Adds the run time of a successful run to the statistics
+        """
+        if self.runTimeMean is None:
+            self.runTimeMean = runTime
+        else:
+            diff = runTime - self.runTimeMean
+            incr = RUNTIME_DECAY * diff
+            self.runTimeMean += incr
+            self.runTimeVar = (1 - RUNTIME_DECAY) * (self.runTimeVar +
+                diff * incr)
+        sketch = {}
+        for b, w in self.runTimeSketch:
+            w *= 1 - RUNTIME_DECAY
+            # Drop the bins which have decayed away
+            if w >= 0.001:
+                sketch[b] = w
+        b = 0
+        if runTime > RUNTIME_SKETCH_MIN:
+            b = min(int(math.ceil(math.log(runTime / RUNTIME_SKETCH_MIN) /
+                math.log(RUNTIME_SKETCH_GROWTH))), RUNTIME_SKETCH_BINS - 1)
+        sketch[b] = sketch.get(b, 0.0) + 1
+        self.runTimeSketch = [[b, round(w, 4)]
+            for b, w in sorted(sketch.items())]
+        self.runTimeSamples += 1
+
+    def getRuntimeQuantile(self, q):
+        """
+        Returns the estimate of the q quantile of the recent successful run
+        times, the upper bound of its sketch bin, or None if there are none
+        """
+        total = sum(w for b, w in self.runTimeSketch)
+        if not total:
+            return None
+        seen = 0.0
+        for b, w in self.runTimeSketch:
+            seen += w
+            if seen >= q * total:
+                break
+        return RUNTIME_SKETCH_MIN * RUNTIME_SKETCH_GROWTH ** b
+
+    def getRuntimeThreshold(self):
+        """
+        Returns the run time over which a successful run is an anomaly, the
+        99th percentile times the "--anomaly-factor", or None until there
+        have been "--anomaly-min-runs" successful runs
+        """
+        if self.runTimeSamples < self.opts.anomalyMinRuns:
+            return None
+        return max(self.getRuntimeQuantile(0.99) * self.opts.anomalyFactor,
+            ANOMALY_MIN_RUNTIME)
+
+    def getSuggestedTimeout(self):
+        """
+        Returns a timeout for the command, in whole seconds, based on its
+        run time history, or None if the history is too short
+        """
+        threshold = self.getRuntimeThreshold()
+        if threshold is None:
+            return None
+        return int(math.ceil(threshold))
+
+    def getTimeout(self):
+        """
+        Returns the timeout for this run, "--timeout" or the suggested one
+        with "--auto-timeout", or zero for none
+        """
+        if self.opts.timeout or not self.opts.autoTimeout:
+            return self.opts.timeout
+        return self.getSuggestedTimeout() or 0
+
+    def _checkRuntime(self, runTime):
+        """
+        Checks the run time of a successful run against the threshold from
+        the statistics and adds it to them, unless it's an anomaly, so a
+        single slow run doesn't raise the threshold.  After
+        "--anomaly-min-runs" consecutive anomalies, the run time is taken to
+        have changed for good and the statistics are learned anew.
+
+            returns -> <str>:   The description of the anomaly or None
+        """
+        threshold = self.getRuntimeThreshold()
+        if threshold is None or runTime <= threshold:
+            self.anomalyStreak = 0
+            self._updateRuntimeStats(runTime)
+            return None
+        self.anomalyCount += 1
+        self.anomalyStreak += 1
+        ret = ('The run time of %.2f seconds is over the anomaly threshold '
+            'of %.2f seconds, %g times the 99th percentile of the recent run '
+            'times.  The mean run time is %.2f seconds.' % (runTime,
+            threshold, self.opts.anomalyFactor, self.runTimeMean))
+        if self.anomalyStreak >= self.opts.anomalyMinRuns:
+            count = self.anomalyCount
+            self._resetRuntimeStats()
+            self.anomalyCount = count
+            self._updateRuntimeStats(runTime)
+        return ret
+
+    def _resetMetrics(self):
+        """
+        Initializes the counters and gauges exported as metrics
+        """
+        self.runCount = 0
+        self.lastExitCode = None
+        self.lastRunTime = None
+        self.lastRunEnd = None
+        self.lastSuccessTime = None
+        self.emailsSent = 0
+        self.runTimeBuckets = [0] * len(RUNTIME_BUCKETS)
+        self.runTimeSum = 0.0
+        # The number of overlapping runs by the policy applied to them
+        self.overlaps = {}
+        self.lastOverlapTime = None
+
+    def _updateMetrics(self, success):
+        """
+        Updates the metrics with the last run
+        """
+        self.runCount += 1
+        self.lastExitCode = self.lastRunExitCode
+        self.lastRunTime = self.lastRunRunTime
+        self.lastRunEnd = self.lastRunStartTime + self.lastRunRunTime
+        if success:
+            self.lastSuccessTime = self.lastRunEnd
+        self.runTimeSum += self.lastRunRunTime
+        for i, le in enumerate(RUNTIME_BUCKETS):
+            if self.lastRunRunTime <= le:
+                self.runTimeBuckets[i] += 1
+                break
+
+    def addOverlaps(self, overlaps):
+        """
+        Counts the overlapping runs, as returned by takeOverlaps()
+        """
+        for policy, t in overlaps:
+            self.overlaps[policy] = self.overlaps.get(policy, 0) + 1
+            self.lastOverlapTime = max(self.lastOverlapTime or 0, t)
+
+    def _getPyError(self, e):
+        """
+        Returns the python error text for an exception raised during a run
+        """
+        t = ''
+        if not isinstance(e, CmdTimeout):
+            import traceback
+            t = traceback.format_exc()
+        return '%s\n%s' % (e, t)
+
+    def _getCaptures(self):
+        """
+        Returns the OutputCapture objects for stdout and stderr based on the
+        capture options
+        """
+        caps = []
+        stFName = None
+        if self.opts.spill:
+            stFName = StateFile.getStateFileName(self.opts, self.cmdList)
+        for ext, stream in (('stdout', self._out), ('stderr', self._err)):
+            spillName = passthrough = None
+            if stFName:
+                spillName = '%s.%s' % (stFName, ext)
+            if self.opts.liveOutput and not self.opts.quiet:
+                passthrough = stream
+            caps.append(OutputCapture(self.opts.captureLimit, spillName,
+                passthrough))
+        return caps
+
+    def _capture(self, outCap, errCap, deadline=None):
+        """
+        Reads the output pipes of the running process incrementally,
+        feeding the data to the captures, until both are closed and then
+        waits for the process to exit.  If a monotonic deadline is given,
+        the process is killed and CmdTimeout raised when it is reached.
+        """
+        import selectors
+        sel = selectors.DefaultSelector()
+        sel.register(self._ph.stdout, selectors.EVENT_READ, outCap)
+        sel.register(self._ph.stderr, selectors.EVENT_READ, errCap)
+        nextSample = None
+        if self.opts.sampleProc:
+            nextSample = time.monotonic()
+        try:
+            while sel.get_map():
+                timeout = None
+                now = time.monotonic()
+                if nextSample is not None:
+                    if now >= nextSample:
+                        self._treeRss = max(self._treeRss,
+                            getTreeRss(self._ph.pid))
+                        nextSample = now + PROC_SAMPLE_INTERVAL
+                    timeout = nextSample - now
+                if deadline is not None:
+                    if deadline <= now:
+                        self._killTimedOut()
+                    if timeout is None or deadline - now < timeout:
+                        timeout = deadline - now
+                for key, events in sel.select(timeout):
+                    data = os.read(key.fd, CHUNK_SIZE)
+                    if not data:
+                        sel.unregister(key.fileobj)
+                        key.fileobj.close()
+                        continue
+                    key.data.write(data)
+        finally:
+            # On a timeout or an error, the pipes which are still open are
+            # closed here so they don't leak in a long running daemon
+            for key in list(sel.get_map().values()):
+                key.fileobj.close()
+            sel.close()
+        # The output can be closed before the process exits
+        timeout = None
+        if deadline is not None:
+            timeout = max(deadline - time.monotonic(), 0)
+        try:
+            self._wait(timeout)
+        except sp.TimeoutExpired:
+            self._killTimedOut()
+
+    def _wait(self, timeout=None):
+        """
+        Waits for the process to exit and collects its resource usage with
+        wait4().  This raises subprocess.TimeoutExpired if the process hasn't
+        exited within timeout seconds.
+        """
+        if self._ph.returncode is not None:
+            return
+        flags = 0
+        if timeout is not None:
+            flags = os.WNOHANG
+            end = time.monotonic() + timeout
+        while True:
+            try:
+                pid, status, ru = os.wait4(self._ph.pid, flags)
+            except ChildProcessError:
+                # Reaped by someone else, we just don't get the rusage
+                self._ph.wait()
+                return
+            if pid:
+                break
+            if time.monotonic() >= end:
+                raise sp.TimeoutExpired(self._ph.args, timeout)
+            time.sleep(0.005)
+        self._ph.returncode = os.waitstatus_to_exitcode(status)
+        self._rusage = (ru.ru_utime, ru.ru_stime, ru.ru_maxrss,
+            ru.ru_inblock, ru.ru_oublock, ru.ru_nvcsw, ru.ru_nivcsw,
+            self._treeRss)
+
+    async def _captureAsync(self, outCap, errCap, deadline=None):
+        """
+        The asyncio version of _capture().  The process is reaped, and
+        killed on a timeout, by _wait() and terminate() in a thread so that
+        its resource usage is collected the same way.
+        """
+        import asyncio
+        loop = asyncio.get_running_loop()
+
+        async def pump(pipe, cap):
+            reader = asyncio.StreamReader()
+            transport = (await loop.connect_read_pipe(
+                lambda: asyncio.StreamReaderProtocol(reader), pipe))[0]
+            try:
+                while True:
+                    data = await reader.read(CHUNK_SIZE)
+                    if not data:
+                        break
+                    cap.write(data)
+            finally:
+                # Also closes the pipe
+                transport.close()
+
+        async def sample():
+            while True:
+                self._treeRss = max(self._treeRss, getTreeRss(self._ph.pid))
+                await asyncio.sleep(PROC_SAMPLE_INTERVAL)
+
+        sampler = None
+        if self.opts.sampleProc:
+            sampler = asyncio.ensure_future(sample())
+        try:
+            timeout = None
+            if deadline is not None:
+                timeout = max(deadline - time.monotonic(), 0)
+            try:
+                await asyncio.wait_for(asyncio.gather(
+                    pump(self._ph.stdout, outCap),
+                    pump(self._ph.stderr, errCap)), timeout)
+            except asyncio.TimeoutError:
+                await asyncio.to_thread(self._killTimedOut)
+            # The output can be closed before the process exits
+            if deadline is not None:
+                timeout = max(deadline - time.monotonic(), 0)
+            try:
+                await asyncio.to_thread(self._wait, timeout)
+            except sp.TimeoutExpired:
+                await asyncio.to_thread(self._killTimedOut)
+        finally:
+            if sampler is not None:
+                sampler.cancel()
+
+    def _killTimedOut(self):
+        """
+        Handles the timeout specified on the command line.  The process is
+        sent a SIGTERM and, if it hasn't exited after the kill grace period,
+        a SIGKILL.  This always raises CmdTimeout.
+        """
+        self.terminate()
+        raise self._getTimeoutError()
+
+    def terminate(self):
+        """
+        Stops the running command, if any, with a SIGTERM and, if it hasn't
+        exited after the kill grace period, a SIGKILL
+        """
+        if getattr(self, '_ph', None) is None or \
+                self._ph.returncode is not None:
+            return
+        self._signal(signal.SIGTERM)
+        try:
+            self._wait(self.opts.killGrace)
+        except sp.TimeoutExpired:
+            self._signal(signal.SIGKILL)
+            self._wait()
+
+    def _getTimeoutError(self):
+        return CmdTimeout('Command reached timeout of %g seconds' %
+            self._timeout)
+
+    def _signal(self, sig):
+        """
+        Sends the signal to the process, or to its whole process group if it
+        has its own
+        """
+        try:
+            if self._ownGroup:
+                os.killpg(self._ph.pid, sig)
+            else:
+                self._ph.send_signal(sig)
+        except ProcessLookupError:
+            pass
+
+    def _procFail(self, warning=False):
         """
         This processes a failure and adds it to the list of failures.  It
         then determines whether the specified threshold has been reached and
         writes out the failures if it has.
+
+            warning<bool>:  The run succeeded and is processed as a warning
         """
+        limit = self.opts.maxFailOutput
         f = Failure(self.cmdList, self.lastRunStartTime, self.lastRunRunTime,
-            self.lastRunExitCode, self.lastRunStdout, self.lastRunStderr,
-            self.lastRunPyError)
-        self.failures.append(f)
-        if self.opts.syslog:
-            self._logFail(f)
+            self.lastRunExitCode, truncateOutput(self.lastRunStdout, limit),
+            truncateOutput(self.lastRunStderr, limit), self.lastRunPyError,
+            self.lastRunRusage, warning)
+        f.compress(self.opts.compressOutput)
+        self._addFailure(f)
+        self._lastRecord = REC_FAIL
+        report = None
         if self.NumFails:
             sendEmail = False
             # Determine whether it's time to send an email.  Multiple
@@ -408,12 +2316,62 @@ class CommandState(object):
                 self._lastEmailNum = self.NumFails
             if sendEmail:
                 sioFail = self._getFailText()
+                report = sioFail.getvalue()
                 if self.opts.mail:
-                    self._sendEmail(sioFail.getvalue())
+                    self.emailsSent += 1
                 if not self.opts.suppressOutput:
-                    print(sioFail.getvalue())
+                    self._out.write(('%s\n' % report).encode('utf-8'))
+                    self._out.flush()
                 sioFail.close()
                 self._reset(False)
+        # The notifiers queue anything slow until deliverNotifications()
+        # is called once the state is saved
+        for n in self._notifiers:
+            n.notify(self, f, report)
+
+    def getNextReport(self):
+        """
+        Returns the number of consecutive failures at which the next failure
+        report will be made, following the backoff if it's set, or None if
+        no more reports will be made in this failure streak.  This mirrors
+        the decision in _procFail().
+        """
+        numFails = self.opts.numFails
+        if self.opts.fstFail and self.NumFails == 0:
+            return 1
+        if self.opts.backoff and self._lastEmailNum > 0:
+            nextNum = self._lastEmailNum * 2
+            if nextNum > self.NumFails and nextNum % numFails == 0:
+                return nextNum
+            return None
+        return (self.NumFails // numFails + 1) * numFails
+
+    def applyRecord(self, recType, fail, lastEmailNum):
+        """
+        Applies a journaled run record to this state.  This is used by the
+        log state backend to replay the runs since the last snapshot.
+        """
+        if recType == REC_SUCCESS:
+            self._reset()
+        elif recType == REC_FAIL:
+            self._addFailure(fail)
+            self.lastRusage = fail.rusage
+        self._lastEmailNum = lastEmailNum
+
+    def _addFailure(self, f):
+        """
+        Adds the failure to the history and updates the failure counters
+        """
+        if self.failures:
+            f.shareOutput(self.failures[-1])
+        self.failures.append(f)
+        self.failCount += 1
+        self.failRunTime += f.runTime
+        if self.failCount == 1:
+            self.firstFailTime = f.timeStarted
+        if self.opts.maxHistory:
+            # Always keep enough failures around for a full report
+            del self.failures[:-max(self.opts.maxHistory, self.opts.numFails)]
 
     def _getFailText(self):
         """
@@ -432,98 +2390,1035 @@ class CommandState(object):
             sio.write('has been reached for the following\n')
             sio.write('command which has failed %d times in a row:' %
                 self.NumFails)
-        sio.write('\n%s\n\nFAILURES:\n' % ' '.join(self.cmdList))
-        for f in self.failures[-self.opts.numFails:]:
+        sio.write('\n%s\n' % ' '.join(self.cmdList))
+        if self.NumDropped:
+            sio.write('\n%d earlier failures, starting at %s, are no '
+                'longer in the history.\n' % (self.NumDropped,
+                time.ctime(self.firstFailTime)))
+        sio.write('Total run time of all %d failures (seconds): %.02f\n' %
+            (self.NumFails, self.failRunTime))
+        sio.write('\nFAILURES:\n')
+        fails = self.failures[-self.opts.numFails:]
+        if not self.opts.collapseFails:
+            for f in fails:
+                sio.write(str(f))
+            return sio
+        # Consecutive failures which failed the same way are only shown once
+        digests = [f.getDigest() for f in fails]
+        i = 0
+        while i < len(fails):
+            f = fails[i]
+            j = i + 1
+            while j < len(fails) and digests[j] == digests[i]:
+                j += 1
             sio.write(str(f))
+            if j - i > 1:
+                sio.write('Repeated x%d with the same exit code and output, '
+                    'first seen %s,\nlast seen %s\n%s\n' % (j - i,
+                    time.ctime(f.timeStarted),
+                    time.ctime(fails[j - 1].timeStarted), Failure.mainDelim))
+            i = j
         return sio
 
-    def _getEmailHeaders(self):
-        """
-        Generates the email headers and returns the string
-        """
-        buf = StringIO()
-        buf.write('From: %s\r\n' % self.opts.mailFrom)
-        buf.write('Subject: %s\r\n' % self.opts.mailSubject)
-        buf.write('To: %s\r\n' % self.opts.mailRecips[0])
-        if len(self.opts.mailRecips) > 1:
-            buf.write('Cc: %s\r\n' % ','.join(self.opts.mailRecips[1:]))
-        buf.write('Content-Type: text/plain; charset="us-ascii"\r\n')
-        buf.write('MIME-Version: 1.0\r\n')
-        buf.write('\r\n')
-        ret = buf.getvalue()
-        buf.close()
-        return ret
+    def takeNotifiers(self):
+        """
+        Returns the notifiers of the last run and clears them, so the next
+        run can start while they are delivered
+        """
+        notifiers, self._notifiers = self._notifiers, []
+        return notifiers
 
-    def _sendEmail(self, failText):
+    def deliverNotifications(self, detach=True, notifiers=None):
         """
-        Sends an email using the command line options
+        Delivers the notifications queued by the notifiers during the last
+        run.  This is called after the state has been saved and its lock
+        released, so a slow mail or web server can't hold up the next run
+        of the job.  If detach is set, the notifiers which may be slow are
+        flushed by a detached child process and this returns immediately.
+
+        notifiers<list>:    The notifiers to flush instead of the ones of
+                            the last run
         """
-        failText = self._getEmailHeaders() + failText
-        s = None
+        if notifiers is None:
+            notifiers = self.takeNotifiers()
+        notifiers = [n for n in notifiers if n.pending()]
+        slow = [n for n in notifiers if n.slow]
+        for n in notifiers:
+            if not n.slow:
+                self._flushNotifier(n, False)
+        if not slow or (detach and detachProcess()):
+            return
+        try:
+            for n in slow:
+                self._flushNotifier(n, detach)
+        finally:
+            if detach:
+                os._exit(0)
+
+    def _flushNotifier(self, notifier, detached):
+        try:
+            notifier.flush()
+        except Exception as e:
+            msg = 'Failed to deliver the %s notifications for %s: %s' % (
+                notifier.name, ' '.join(self.cmdList), e)
+            if detached:
+                syslog.syslog(syslog.LOG_USER | syslog.LOG_ERR, msg)
+            else:
+                print(msg, file=sys.stderr)
+
+    def _reset(self, resetFails=True):
+        """
+        Resets all the variables back to empty defaults
+        """
+        if resetFails:
+            self.failures = []
+            self.failCount = 0
+            self.failRunTime = 0.0
+            self.firstFailTime = None
+        self.lastRunExitCode = None
+        self.lastRunStdout = None
+        self.lastRunStderr = None
+        self.lastRunStartTime = None
+        self.lastRunRunTime = None
+        self.lastRunPyError = None
+        self.lastRunRusage = None
+
+    def _getEscCmd(self):
+        cmd = "'%s'" % self.cmdList[0].replace("'", "'\"'\"'")
+        return cmd
+
+class Mailer(object):
+    """
+    Sends emails using the email options, either over SMTP or with the local
+    sendmail command.  The SMTP session is opened by the first send and is
+    reused for the following ones until close() is called.
+    """
+    def __init__(self, opts):
+        self.opts = opts
+        self._smtp = None
+
+    def send(self, mailFrom, recips, msg):
+        """
+        Sends the message, which must include its headers
+        """
+        msg = msg.encode('utf-8')
         if not self.opts.smtpServer:
-            return self._sendSendmail(failText)
+            return self._sendSendmail(mailFrom, recips, msg)
+        if self._smtp is None:
+            self._smtp = self._connect()
+        try:
+            self._smtp.sendmail(mailFrom, recips, msg)
+        except Exception:
+            # Don't reuse a session in an unknown state
+            self.close()
+            raise
+
+    def sendRetry(self, mailFrom, recips, msg):
+        """
+        Sends the message, retrying up to opts.mailRetries times.  The delay
+        before each retry doubles, with some jitter so that many failing
+        jobs don't retry in lockstep.
+        """
+        from random import randint
+        delay = self.opts.mailRetryDelay
+        for i in range(self.opts.mailRetries + 1):
+            try:
+                return self.send(mailFrom, recips, msg)
+            except Exception:
+                if i == self.opts.mailRetries:
+                    raise
+            time.sleep(delay * (0.5 + randint(0, 1000) / 1000.0))
+            delay *= 2
+
+    def close(self):
+        if self._smtp is None:
+            return
+        try:
+            self._smtp.quit()
+        except Exception:
+            self._smtp.close()
+        self._smtp = None
+
+    def _connect(self):
+        from smtplib import SMTP, SMTP_SSL
+        import socket
+        timeout = self.opts.smtpTimeout or socket._GLOBAL_DEFAULT_TIMEOUT
         if self.opts.smtpSSL:
-            s = SMTP_SSL()
+            s = SMTP_SSL(timeout=timeout)
         else:
-            s = SMTP()
+            s = SMTP(timeout=timeout)
         s.connect(self.opts.smtpServer, self.opts.smtpPort)
         s.ehlo()
         if self.opts.smtpTLS:
             s.starttls()
+            s.ehlo()
         if self.opts.smtpUser:
             s.login(self.opts.smtpUser, self.opts.smtpPass)
-        s.sendmail(self.opts.mailFrom, self.opts.mailRecips, failText)
-        s.quit()
+        return s
 
-    def _sendSendmail(self, failText):
+    def _sendSendmail(self, mailFrom, recips, msg):
         """
         Send an email using the local sendmail command
         """
-        cmd = [self.opts.sendmail, '-f', self.opts.mailFrom]
-        cmd.extend(self.opts.mailRecips)
+        cmd = [self.opts.sendmail, '-f', mailFrom]
+        cmd.extend(recips)
         p = sp.Popen(cmd, stdin=sp.PIPE, stdout=sp.PIPE, stderr=sp.PIPE)
-        stdout, stderr = p.communicate(failText)
+        try:
+            stdout, stderr = p.communicate(msg,
+                timeout=self.opts.smtpTimeout or None)
+        except sp.TimeoutExpired:
+            p.kill()
+            p.communicate()
+            raise MailError('Timed out sending email with "sendmail" after '
+                '%g seconds' % self.opts.smtpTimeout)
         if p.returncode != 0:
+            stdout = stdout.decode('utf-8', 'replace')
+            stderr = stderr.decode('utf-8', 'replace')
             print('Mail error: \n%s\n%s' % (stdout, stderr), file=sys.stderr)
             raise MailError('Error sending email with "sendmail":\n'
                 'STDOUT:\n%s\nSTDERR:\n%s\n' % (stdout, stderr))
 
-    def _logFail(self, fail):
+class MailSpool(object):
+    """
+    A directory of failure reports waiting to be emailed.  Each report is
+    a JSON file written atomically, so a flusher never sees a partial one.
+    The flusher digests the reports for the same sender and recipients into
+    a single email and sends all of them over one SMTP session.
+    """
+    suffix = '.msg'
+
+    def __init__(self, spoolDir):
+        self.spoolDir = spoolDir
+
+    def enqueue(self, mailFrom, recips, subject, text):
         """
-        Logs the failure to syslog
+        Queues a failure report
         """
+        from random import randint
+        import json
+        now = time.time()
+        name = '%d-%d-%05d%s' % (now * 1000000, os.getpid(),
+            randint(0, 99999), self.suffix)
+        atomicWrite(os.path.join(self.spoolDir, name), json.dumps({
+            'from': mailFrom,
+            'recips': recips,
+            'subject': subject,
+            'text': text,
+            'queued': now,
+        }).encode('utf-8'))
+
+    def flush(self, opts):
+        """
+        Sends all the queued reports.  Reports which fail to send are left
+        in the spool for the next flush.  If another flusher is already
+        running, this returns immediately.
+
+            returns -> <int>:   The number of reports sent
+        """
+        lockFd = os.open(os.path.join(self.spoolDir, '.flush.lock'),
+            os.O_CREAT | os.O_RDWR, 0o600)
+        try:
+            try:
+                fcntl.flock(lockFd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                return 0
+            groups = {}
+            for fname, report in self._readReports():
+                key = (report['from'], tuple(report['recips']))
+                groups.setdefault(key, []).append((fname, report))
+            sent = 0
+            mailer = Mailer(opts)
+            try:
+                for (mailFrom, recips), reports in sorted(groups.items()):
+                    subject, text = self._digest([r for f, r in reports])
+                    try:
+                        mailer.send(mailFrom, list(recips),
+                            formatEmail(mailFrom, recips, subject, text,
+                            opts.emailAttach))
+                    except Exception as e:
+                        print('Failed to send %d spooled report(s) to %s: %s'
+                            % (len(reports), ','.join(recips), e),
+                            file=sys.stderr)
+                        continue
+                    for fname, report in reports:
+                        os.unlink(fname)
+                    sent += len(reports)
+            finally:
+                mailer.close()
+            return sent
+        finally:
+            os.close(lockFd)
+
+    def _readReports(self):
+        """
+        Generator for the (file name, report) of the queued reports, oldest
+        first.  Reports which can't be parsed are renamed out of the way.
+        """
+        import json
+        for name in sorted(os.listdir(self.spoolDir)):
+            if not name.endswith(self.suffix):
+                continue
+            fname = os.path.join(self.spoolDir, name)
+            try:
+                with open(fname, 'rb') as fh:
+                    report = json.loads(fh.read().decode('utf-8'))
+                if not (report['from'] and report['recips']):
+                    raise ValueError('No sender or recipients')
+            except FileNotFoundError:
+                continue
+            except (ValueError, KeyError, TypeError) as e:
+                print('Invalid spooled report %s: %s' % (fname, e),
+                    file=sys.stderr)
+                os.rename(fname, '%s.bad' % fname)
+                continue
+            yield (fname, report)
+
+    @staticmethod
+    def _digest(reports):
+        """
+        Returns the (subject, text) of the email for the reports
+        """
+        if len(reports) == 1:
+            return (reports[0]['subject'], reports[0]['text'])
+        subjects = set(r['subject'] for r in reports)
+        if len(subjects) == 1:
+            subject = subjects.pop()
+        else:
+            subject = 'cwrap.py failure digest'
+        subject = '%s (%d reports)' % (subject, len(reports))
+        sio = StringIO()
+        sio.write('This is a digest of %d failure reports.\n' % len(reports))
+        for i, r in enumerate(reports):
+            sio.write('\n%s\nReport %d of %d: %s\nQueued: %s\n\n' % ('=' * 72,
+                i + 1, len(reports), r['subject'], time.ctime(r['queued'])))
+            sio.write(r['text'])
+            sio.write('\n')
+        return (subject, sio.getvalue())
+
+class Notifier(metaclass=abc.ABCMeta):
+    """
+    The base class of the notifiers, which tell someone about the failures
+    of a command.  notify() is called for every failure during the run and
+    must be quick.  Anything slow, like talking to a server, is batched up
+    and done by flush(), which is called after the state has been saved
+    and its lock released.
+    """
+    # The name of the notifier in --notify
+    name = None
+    # Whether flush() may be slow enough to be done by a detached process
+    slow = False
+    # The default timeout in seconds and number of failures per batch
+    timeout = 5
+    batch = 100
+
+    def __init__(self, opts, target=None, timeout=None, batch=None):
+        """
+        opts<Namespace>:    The command line options
+        target<str>:        Where to send the notifications
+        timeout<float>:     The timeout for sending a batch
+        batch<int>:         The maximum number of failures in a batch
+        """
+        self.opts = opts
+        self.target = target
+        if timeout is not None:
+            self.timeout = float(timeout)
+        if batch is not None:
+            self.batch = int(batch)
+        self._events = []
+
+    def notify(self, comSt, fail, report):
+        """
+        Called for each failure.  The default queues the failure as a JSON
+        event for flush().
+
+            comSt<CommandState>:    The state of the failed command
+            fail<Failure>:          The failure
+            report<str>:            The failure report if the number of
+                                    failures hit the reporting threshold,
+                                    otherwise None
+        """
+        import socket
+        self._events.append({
+            'host': socket.gethostname(),
+            'job': os.path.basename(StateFile.getStateFileName(comSt.opts,
+                comSt.cmdList)),
+            'numFails': comSt.NumFails,
+            'report': report is not None,
+            'status': fail.getStatus(),
+            'failure': fail.asDict(),
+        })
+
+    def pending(self):
+        """
+        Returns whether there is anything for flush() to do
+        """
+        return bool(self._events)
+
+    def flush(self):
+        """
+        Delivers the queued events in batches
+        """
+        events, self._events = self._events, []
+        for i in range(0, len(events), self.batch):
+            self.send(events[i:i + self.batch])
+
+    @abc.abstractmethod
+    def send(self, events):
+        """
+        Delivers a batch of at most self.batch of the queued events
+        """
+
+class EmailNotifier(Notifier):
+    """
+    Emails the failure reports, or queues them in the spool directory
+    """
+    name = 'email'
+
+    def __init__(self, opts, *args, **kwargs):
+        Notifier.__init__(self, opts, *args, **kwargs)
+        # Queueing in the spool is quick, sending isn't
+        self.slow = not opts.spoolDir
+
+    def notify(self, comSt, fail, report):
+        if report is not None:
+            self._events.append(report)
+
+    def send(self, reports):
+        opts = self.opts
+        if opts.spoolDir:
+            spool = MailSpool(opts.spoolDir)
+            for report in reports:
+                spool.enqueue(opts.mailFrom, opts.mailRecips,
+                    opts.mailSubject, report)
+            return
+        mailer = Mailer(opts)
+        try:
+            for report in reports:
+                mailer.sendRetry(opts.mailFrom, opts.mailRecips,
+                    formatEmail(opts.mailFrom, opts.mailRecips,
+                    opts.mailSubject, report, opts.emailAttach))
+        finally:
+            mailer.close()
+
+class SyslogNotifier(Notifier):
+    """
+    Logs the failures to syslog, or to the systemd journal with native
+    fields.  The stdout and stderr in a record are each limited to
+    opts.sMaxOutput characters so a noisy job can't flood the logs.
+    """
+    name = 'syslog'
+    # The SD-ID of the "sd-kv" structured data element, in the form of an
+    # RFC 5424 one, 32473 is the example private enterprise number
+    sdId = 'cwrap@32473'
+
+    def notify(self, comSt, fail, report):
         if self.opts.sNumOnly and not \
-                (self.NumFails % self.opts.numFails == 0 or \
-                (self.opts.fstFail and self.NumFails == 1)):
+                (comSt.NumFails % self.opts.numFails == 0 or \
+                (self.opts.fstFail and comSt.NumFails == 1)):
             # Basically, if we only want to log when we've hit the number
             # of failures and we haven't hit that mark, we return
             return
+        # The fields are taken now, while the failure count is this
+        # failure's
+        self._events.append((fail, self._getFields(comSt, fail)))
+
+    def send(self, events):
+        for fail, fields in events:
+            fmt = self.opts.sFormat
+            if fmt == 'journald':
+                try:
+                    self._sendJournal(fail, fields)
+                    continue
+                except OSError:
+                    # No journal, fall back to syslog
+                    fmt = 'kv'
+            if fmt == 'kv':
+                log(' '.join('%s=%s' % (k, self._quoteKv(v))
+                    for k, v in fields))
+            elif fmt == 'sd-kv':
+                log('[%s %s] %s' % (self.sdId, ' '.join('%s="%s"' % (k,
+                    self._escSd(v)) for k, v in fields),
+                    self._getSummary(fail)))
+            else:
+                log(self._getPlain(fail))
+
+    def _getPlain(self, fail):
+        limit = self.opts.sMaxOutput
         msg = 'CMD: %s; EXIT: %d; RUNTIME: %.02f; ' % (fail.command,
             fail.exitCode, fail.runTime)
+        if fail.warning:
+            msg += 'STATUS: warning; '
+
+        if fail.rusage:
+            msg += 'RUSAGE: %s; ' % formatRusage(fail.rusage)
         if fail.pyError:
-            msg += 'PYERR: %s; ' % fail.pyError
+            msg += 'PYERR: %s; ' % truncateOutput(fail.pyError,
+                limit).replace('\n', ' ')
         if fail.stdout:
-            msg += 'STDOUT: %s; ' % fail.stdout.replace('\n', ' ')
+            msg += 'STDOUT: %s; ' % truncateOutput(fail.stdout,
+                limit).replace('\n', ' ')
         if fail.stderr:
-            msg += 'STDERR: %s;' % fail.stderr.replace('\n', ' ')
-        log(msg)
+            msg += 'STDERR: %s;' % truncateOutput(fail.stderr,
+                limit).replace('\n', ' ')
+        return msg
 
-    def _reset(self, resetFails=True):
+    def _getFields(self, comSt, fail):
         """
-        Resets all the variables back to empty defaults
+        Returns the (name, value) fields of the failure for the structured
+        formats
         """
-        if resetFails:
-            self.failures = []
-        self.lastRunExitCode = None
-        self.lastRunStdout = None
-        self.lastRunStderr = None
-        self.lastRunStartTime = None
-        self.lastRunRunTime = None
-        self.lastRunPyError = None
+        limit = self.opts.sMaxOutput
+        fields = [
+            ('cmd', ' '.join(fail.command)),
+            ('exit', fail.exitCode),
+            ('status', fail.getStatus()),
+            ('runtime', round(fail.runTime, 2)),
+            ('numfails', comSt.NumFails),
+        ]
+        if fail.rusage:
+            fields.extend(zip(RUSAGE_FIELDS, fail.rusage))
+        if fail.pyError:
+            fields.append(('pyerr', truncateOutput(fail.pyError, limit)))
+        if fail.stdout:
+            fields.append(('stdout', truncateOutput(fail.stdout, limit)))
+        if fail.stderr:
+            fields.append(('stderr', truncateOutput(fail.stderr, limit)))
+        return fields
+
+    @staticmethod
+    def _getSummary(fail):
+        if fail.warning:
+            return '%s succeeded with a warning after %.02f seconds' % (
+                ' '.join(fail.command), fail.runTime)
+        return '%s failed with exit code %d after %.02f seconds' % (
+            ' '.join(fail.command), fail.exitCode, fail.runTime)
+
+    @staticmethod
+    def _quoteKv(val):
+        if isinstance(val, (int, float)):
+            return str(val)
+        return '"%s"' % val.replace('\\', '\\\\').replace('"',
+            '\\"').replace('\n', '\\n')
+
+    @staticmethod
+    def _escSd(val):
+        return str(val).replace('\\', '\\\\').replace('"',
+            '\\"').replace(']', '\\]').replace('\n', '\\n')
+
+    def _sendJournal(self, fail, cwFields):
+        """
+        Sends the failure to the journal with its fields from _getFields()
+        as native CWRAP_* fields
+        """
+        fields = [
+            ('MESSAGE', self._getSummary(fail)),
+            ('PRIORITY', LOGPRI),
+            ('SYSLOG_FACILITY', getattr(syslog, self.opts.sFacility) >> 3),
+            ('SYSLOG_IDENTIFIER', 'cwrap'),
+        ]
+        fields.extend(('CWRAP_%s' % k.upper(), v) for k, v in cwFields)
+        import socket
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+        try:
+            sock.sendto(encodeJournalFields(fields), JOURNAL_SOCKET)
+        finally:
+            sock.close()
+
+class WebhookNotifier(Notifier):
+    """
+    POSTs each batch of failures to a URL as a JSON array
+    """
+    name = 'webhook'
+    slow = True
+
+    def send(self, events):
+        import json
+        import urllib.request
+        req = urllib.request.Request(self.target,
+            data=json.dumps(events).encode('utf-8'),
+            headers={'Content-Type': 'application/json'}, method='POST')
+        with urllib.request.urlopen(req, timeout=self.timeout) as resp:
+            resp.read()
+
+class UnixNotifier(Notifier):
+    """
+    Sends each batch of failures as a JSON array in a datagram to a Unix
+    socket.  A batch too big for one datagram is split up.
+    """
+    name = 'unix'
+    timeout = 1
+
+    def send(self, events):
+        import socket
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+        try:
+            sock.settimeout(self.timeout)
+            self._send(sock, events)
+        finally:
+            sock.close()
+
+    def _send(self, sock, events):
+        import json
+        try:
+            sock.sendto(json.dumps(events).encode('utf-8'), self.target)
+        except OSError as e:
+            if e.errno != errno.EMSGSIZE or len(events) == 1:
+                raise
+            half = len(events) // 2
+            self._send(sock, events[:half])
+            self._send(sock, events[half:])
+
+class JsonlNotifier(Notifier):
+    """
+    Appends the failures to a file, one JSON object per line.  The whole
+    batch is appended with a single write under a flock so that concurrent
+    jobs don't interleave their lines.
+    """
+    name = 'jsonl'
+
+    def send(self, events):
+        import json
+        data = ''.join('%s\n' % json.dumps(e) for e in events)
+        fd = os.open(self.target, os.O_WRONLY | os.O_APPEND | os.O_CREAT,
+            0o600)
+        try:
+            deadline = time.monotonic() + self.timeout
+            while True:
+                try:
+                    fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                    break
+                except BlockingIOError:
+                    if time.monotonic() >= deadline:
+                        raise
+                    time.sleep(0.01)
+            os.write(fd, data.encode('utf-8'))
+        finally:
+            os.close(fd)
+
+NOTIFIERS = {
+    'webhook': WebhookNotifier,
+    'unix': UnixNotifier,
+    'jsonl': JsonlNotifier,
+}
+
+class DaemonJob(object):
+    """
+    The in memory state of a single job run by the daemon
+    """
+    def __init__(self, stFName, comSt=None):
+        import threading
+        self.stFName = stFName
+        # None until the state is loaded, under loadLock
+        self.comSt = comSt
+        self.loadLock = threading.Lock()
+        self.lock = threading.Lock()
+        self.dirty = False
+
+
+class DaemonRequestHandler(object):
+    """
+    Handles a single request from a cwrap client.  The request is a single
+    line of JSON with the argv, env and cwd of the client.  The response is
+    a line of JSON with the exit code and output lengths followed by the
+    raw stdout and stderr.
+
+    This is used like a socketserver.StreamRequestHandler, but doesn't
+    subclass it so socketserver is only imported by the daemon.
+    """
+    def __init__(self, request, clientAddress, server):
+        self.server = server
+        self.rfile = request.makefile('rb')
+        self.wfile = request.makefile('wb')
+        try:
+            self.handle()
+            self.wfile.flush()
+        finally:
+            self.wfile.close()
+            self.rfile.close()
+
+    def handle(self):
+        import json
+        try:
+            req = json.loads(self.rfile.readline().decode('utf-8'))
+            rc, out, err = self.server.cwDaemon.handleRequest(req)
+        except Exception as e:
+            rc, out, err = (E_FC, b'', ('cwrap daemon error: %s\n' %
+                e).encode('utf-8'))
+        head = json.dumps({'rc': rc, 'stdoutLen': len(out),
+            'stderrLen': len(err)})
+        self.wfile.write(head.encode('utf-8') + b'\n' + out + err)
+
+
+class CwrapDaemon(object):
+    """
+    A long running process which runs the commands sent to it by cwrap
+    clients over a Unix socket.  The CommandState for each job is kept in
+    memory and written to the state files in batches.
+    """
+    def __init__(self, opts):
+        import threading
+        self.opts = opts
+        self.sockPath = opts.socket or os.path.join(opts.stateDir,
+            'cwrap.sock')
+        self._jobs = {}
+        self._jobsLock = threading.Lock()
+        self._stop = threading.Event()
+        self._server = None
+
+    def serve(self):
+        """
+        Serves requests until a SIGTERM or SIGINT is received
+
+            raises -> DaemonError
+        """
+        import socketserver
+
+        class Server(socketserver.ThreadingUnixStreamServer):
+            # Don't wait for the requests being handled on shutdown
+            daemon_threads = True
+
+        self._removeStaleSocket()
+        # Bind under a umask so the socket is never accessible to others,
+        # not even until it could be chmodded
+        oldMask = os.umask(0o177)
+        try:
+            self._server = Server(self.sockPath, DaemonRequestHandler)
+        except OSError as e:
+            raise DaemonError('Could not serve %s: %s' % (self.sockPath, e))
+        finally:
+            os.umask(oldMask)
+        self._server.cwDaemon = self
+        import threading
+        flusher = threading.Thread(target=self._flushLoop, daemon=True)
+        flusher.start()
+        signal.signal(signal.SIGTERM, self._shutdownHandler)
+        signal.signal(signal.SIGINT, self._shutdownHandler)
+        try:
+            self._server.serve_forever()
+        finally:
+            self._stop.set()
+            self._server.server_close()
+            os.unlink(self.sockPath)
+            self.flush(True)
+
+    def _removeStaleSocket(self):
+        """
+        Removes the socket left behind by a daemon which didn't exit
+        cleanly.  Anything else at the path, including the socket of a
+        daemon which is still serving it, is left alone and DaemonError
+        raised.
+        """
+        import socket
+        import stat
+        try:
+            st = os.lstat(self.sockPath)
+        except FileNotFoundError:
+            return
+        if not stat.S_ISSOCK(st.st_mode):
+            raise DaemonError('%s exists and is not a socket' %
+                self.sockPath)
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            sock.connect(self.sockPath)
+        except ConnectionRefusedError:
+            # No one is listening
+            os.unlink(self.sockPath)
+            return
+        except OSError as e:
+            raise DaemonError('Could not check the socket %s: %s' % (
+                self.sockPath, e))
+        finally:
+            sock.close()
+        raise DaemonError('A cwrap daemon is already serving %s' %
+            self.sockPath)
+
+    def handleRequest(self, req):
+        """
+        Runs the command for the request and returns a tuple of the exit
+        code, stdout and stderr for the client
+        """
+        # Default the command path to the client's PATH
+        argv = ['--path', req['env'].get('PATH', os.defpath)] + req['argv']
+        try:
+            opts, cmdList = getOpts(argv, True)
+        except UsageError as e:
+            return (E_FC, b'', ('cwrap: error: %s\n' % e).encode('utf-8'))
+        if opts.daemon:
+            return (E_FC, b'', b'cwrap: error: a daemon request cannot '
+                b'start a daemon\n')
+        job = self._getJob(opts, cmdList)
+        # The retry options become a wait for the job's previous run
+        wait = opts.numRetries * opts.retrySecs
+        if wait:
+            acquired = job.lock.acquire(timeout=wait)
+        else:
+            acquired = job.lock.acquire(False)
+        if not acquired:
+            if opts.ignoreRetFail:
+                return (0, b'', b'')
+            return (E_FC, b'', ('Job is already running: %s\n' %
+                job.stFName).encode('utf-8'))
+        out = BytesIO()
+        err = BytesIO()
+        try:
+            job.comSt.opts = opts
+            job.comSt.run(out, err, req['env'], req['cwd'])
+            job.comSt.cleanup()
+            job.dirty = True
+            # Notifications are sent in the background as the daemon's state
+            # isn't persisted until the next flush anyway
+            notifiers = job.comSt.takeNotifiers()
+            if notifiers:
+                import threading
+                threading.Thread(target=job.comSt.deliverNotifications,
+                    args=(False, notifiers), daemon=True).start()
+        finally:
+            job.lock.release()
+        return (0, out.getvalue(), err.getvalue())
+
+    def flush(self, force=False):
+        """
+        Writes the state of all the jobs that have run since the last flush.
+        Unless force is set, jobs which are currently running are skipped.
+        """
+        with self._jobsLock:
+            jobs = list(self._jobs.values())
+        for job in jobs:
+            if not job.dirty:
+                continue
+            if not job.lock.acquire(force):
+                continue
+            try:
+                stFh = StateFile.getStateFile(job.comSt.opts,
+                    job.comSt.cmdList)
+                try:
+                    stFh.saveSnapshot(job.comSt)
+                finally:
+                    stFh.close()
+                job.dirty = False
+                writeMetricsFile(job.comSt.opts, job.stFName, job.comSt)
+            except Exception as e:
+                print('Failed to flush state %s: %s' % (job.stFName, e),
+                    file=sys.stderr)
+            finally:
+                job.lock.release()
+
+    def _getJob(self, opts, cmdList):
+        """
+        Returns the DaemonJob for the command, loading its state from the
+        state file the first time it is seen.  Getting the state file may
+        sleep for retries, so it is loaded under the job's own lock rather
+        than holding up the requests for every other job.
+        """
+        stFName = StateFile.getStateFileName(opts, cmdList)
+        with self._jobsLock:
+            job = self._jobs.get(stFName)
+            if job is None:
+                job = self._jobs[stFName] = DaemonJob(stFName)
+        with job.loadLock:
+            if job.comSt is None:
+                comSt = None
+                stFh = StateFile.getStateFile(opts, cmdList)
+                try:
+                    comSt = stFh.getObject()
+                finally:
+                    stFh.close()
+                if not comSt:
+                    comSt = CommandState(opts, cmdList)
+                job.comSt = comSt
+        return job
+
+    def _flushLoop(self):
+        while not self._stop.wait(self.opts.flushInterval):
+            self.flush()
+            if self.opts.spoolDir and self.opts.mail:
+                try:
+                    MailSpool(self.opts.spoolDir).flush(self.opts)
+                except Exception as e:
+                    print('Failed to flush the mail spool: %s' % e,
+                        file=sys.stderr)
+
+    def _shutdownHandler(self, signum, frame):
+        import threading
+        # shutdown() blocks until serve_forever() returns, so it can't be
+        # called from the thread running it
+        threading.Thread(target=self._server.shutdown).start()
+
+
+class ConfigCache(object):
+    """
+    Caches the options of a job after they have been parsed, validated and
+    resolved, in a file in its state directory.  The cache is keyed by a
+    digest of the command line and the environment it is parsed in, and is
+    only used if the files the validation read or found, like sendmail,
+    haven't changed since, and the directories it checked still exist.  A
+    cache hit skips building the option parser and importing argparse
+    altogether.
+
+    Runs with an SMTP password, given with -W or read from a creds file
+    with -D, are never cached so the password isn't written to disk.  The
+    cache is only read from a file owned by the user which no one else can
+    write to, and if other users can replace files in the state directory,
+    e.g. the default /var/tmp, it is kept in a private "cwrap-cache.<uid>"
+    directory in it instead.
+
+    The cache is written with marshal, which unlike json is built into the
+    interpreter and so costs no import on a hit.
+    """
+    version = 4
+
+    def __init__(self, argv):
+        self.argv = argv
+        self.digest = md5(repr([argv, os.getcwd(), os.environ.get('PATH'),
+            os.getuid(), __version__]).encode('utf-8', 'surrogateescape')
+            ).hexdigest()
+        self.facility = None
+        self.priority = None
+
+    def getFileName(self, stateDir, create=False):
+        """
+        Returns the name of the cache file for the state directory or None
+        if there is no private directory to keep it in
+
+            create<bool>:   Create the private directory if it is needed
+        """
+        cacheDir = self._getCacheDir(stateDir, create)
+        if cacheDir is None:
+            return None
+        return os.path.join(cacheDir, 'cwrap-%s.conf' % self.digest)
+
+    def load(self):
+        """
+        Returns the cached (options, command) or None if there is no valid
+        cache
+        """
+        if '--no-config-cache' in self.argv:
+            return None
+        fname = self.getFileName(self._findStateDir())
+        if fname is None:
+            return None
+        try:
+            fd = os.open(fname, os.O_RDONLY | os.O_NOFOLLOW)
+        except OSError:
+            return None
+        try:
+            with os.fdopen(fd, 'rb') as fh:
+                if not self._isPrivate(os.fstat(fh.fileno())):
+                    return None
+                cache = marshal.loads(fh.read())
+        except (OSError, EOFError, TypeError, ValueError):
+            return None
+        if not isinstance(cache, dict) or \
+                cache.get('version') != self.version or \
+                cache.get('argv') != self.argv:
+            return None
+        for path, mtime in cache['files'].items():
+            if self._getMtime(path) != mtime:
+                return None
+        # Runs write into these, so only their existence is checked
+        for path in cache['dirs']:
+            if not os.path.isdir(path):
+                return None
+        opts = SimpleNamespace(**cache['opts'])
+        if opts.smtpPass or opts.smtpCreds:
+            return None
+        self.facility = cache['facility']
+        self.priority = cache['priority']
+        return (opts, cache['cmdList'])
+
+    def save(self, opts, cmdList, facility, priority):
+        """
+        Saves the validated options.  Errors are ignored as the cache is
+        only an optimization.
+        """
+        fname = self.getFileName(opts.stateDir, True)
+        if fname is None:
+            return
+        if opts.smtpPass or opts.smtpCreds:
+            # Remove a cache of these options written before a password
+            # was added to them
+            try:
+                os.unlink(fname)
+            except OSError:
+                pass
+            return
+        files = [os.path.abspath(__file__), getattr(opts, 'sendmail', None)]
+        cachedOpts = vars(opts).copy()
+        cachedOpts['smtpPass'] = ''
+        cache = {
+            'version': self.version,
+            'argv': self.argv,
+            'files': dict((f, self._getMtime(f)) for f in files if f),
+            'dirs': [d for d in (opts.metricsDir, opts.spoolDir) if d],
+            'opts': cachedOpts,
+            'cmdList': cmdList,
+            'facility': facility,
+            'priority': priority,
+        }
+        try:
+            atomicWrite(fname, marshal.dumps(cache))
+        except (OSError, TypeError, ValueError):
+            pass
+
+    def _findStateDir(self):
+        """
+        Finds the state directory in the command line without parsing it.
+        A wrong guess, e.g. from a -d of the command, just misses the cache.
+        """
+        argv = self.argv
+        for i, arg in enumerate(argv):
+            if arg in ('-d', '--state-directory') and i + 1 < len(argv):
+                return argv[i + 1]
+            if arg.startswith('--state-directory='):
+                return arg.split('=', 1)[1]
+            if arg.startswith('-d') and len(arg) > 2:
+                return arg[2:]
+        return DEFAULT_STATE_DIR
+
+    @classmethod
+    def _getCacheDir(cls, stateDir, create=False):
+        """
+        Returns the state directory if only the user can replace the files
+        in it, i.e. it isn't writable by others or it is our own sticky
+        directory, otherwise the user's private directory in it, or None if
+        that doesn't exist or belongs to someone else
+        """
+        try:
+            st = os.stat(stateDir)
+        except OSError:
+            return None
+        if not st.st_mode & 0o022 or (st.st_uid == os.getuid() and
+                st.st_mode & 0o1000):
+            return stateDir
+        cacheDir = os.path.join(stateDir, 'cwrap-cache.%d' % os.getuid())
+        try:
+            if create:
+                try:
+                    os.mkdir(cacheDir, 0o700)
+                except FileExistsError:
+                    pass
+            # Not following a symlink, someone else could have made it
+            st = os.lstat(cacheDir)
+        except OSError:
+            return None
+        if (st.st_mode & 0o170000) != 0o040000 or not cls._isPrivate(st):
+            return None
+        return cacheDir
 
-    def _getEscCmd(self):
-        cmd = "'%s'" % self.cmdList[0].replace("'", "'\"'\"'")
-        return cmd
+    @staticmethod
+    def _isPrivate(st):
+        """
+        Returns whether the stat result is of a file owned by the user which
+        no one else can write to
+        """
+        return st.st_uid == os.getuid() and not st.st_mode & 0o022
+
+    @staticmethod
+    def _getMtime(path):
+        try:
+            return os.stat(path).st_mtime_ns
+        except OSError:
+            return None
 
 def handleEmailOpts(parser, opts):
     """
@@ -534,7 +3429,10 @@ def handleEmailOpts(parser, opts):
             parser.error('You cannot suppress output unless you are using '
                 'cwrap to send email')
         return
-    if not opts.mailRecips:
+    if opts.mailFrom is None:
+        import getpass
+        opts.mailFrom = '%s@localhost.localdomain' % getpass.getuser()
+    if not opts.mailRecips and not opts.flushSpool:
         parser.error('You must specify at least one recipient if you are '
             'using cwrap to send mail')
     if opts.smtpCreds:
@@ -569,14 +3467,794 @@ def handleEmailOpts(parser, opts):
         opts.sendmail = sendmail
 
 # Utility functions
-def getOpts():
+def formatEmailHeaders(mailFrom, recips, subject,
+        contentType='text/plain; charset="utf-8"'):
+    """
+    Generates the email headers and returns the string
+    """
+    buf = StringIO()
+    buf.write('From: %s\r\n' % mailFrom)
+    buf.write('Subject: %s\r\n' % subject)
+    buf.write('To: %s\r\n' % recips[0])
+    if len(recips) > 1:
+        buf.write('Cc: %s\r\n' % ','.join(recips[1:]))
+    buf.write('Content-Type: %s\r\n' % contentType)
+    buf.write('MIME-Version: 1.0\r\n')
+    buf.write('\r\n')
+    ret = buf.getvalue()
+    buf.close()
+    return ret
+
+def formatEmail(mailFrom, recips, subject, text, attach=False):
+    """
+    Returns the email for the report text.  If attach is set, the body is
+    a short summary, the text up to the output of the failures, and the
+    full text is attached gzipped, as a MIME multipart message.
+    """
+    if not attach:
+        return formatEmailHeaders(mailFrom, recips, subject) + text
+    import base64
+    import gzip
+    boundary = '=_cwrap_%s' % md5(text.encode('utf-8')).hexdigest()
+    data = text.encode('utf-8')
+    summary = []
+    for line in text.splitlines()[:REPORT_SUMMARY_LINES]:
+        if line == 'FAILURES:':
+            break
+        summary.append(line)
+    summary.append('')
+    summary.append('The full report, with the output of the failures, is '
+        'attached as')
+    summary.append('%s (%d bytes uncompressed).' % (REPORT_ATTACHMENT,
+        len(data)))
+    attachment = base64.encodebytes(gzip.compress(data)).decode('ascii')
+    buf = StringIO()
+    buf.write(formatEmailHeaders(mailFrom, recips, subject,
+        'multipart/mixed; boundary="%s"' % boundary))
+    buf.write('This is a MIME multipart message.\r\n')
+    buf.write('--%s\r\n' % boundary)
+    buf.write('Content-Type: text/plain; charset="utf-8"\r\n')
+    buf.write('Content-Transfer-Encoding: 8bit\r\n\r\n')
+    buf.write('\r\n'.join(summary))
+    buf.write('\r\n--%s\r\n' % boundary)
+    buf.write('Content-Type: application/gzip; name="%s"\r\n' %
+        REPORT_ATTACHMENT)
+    buf.write('Content-Disposition: attachment; filename="%s"\r\n' %
+        REPORT_ATTACHMENT)
+    buf.write('Content-Transfer-Encoding: base64\r\n\r\n')
+    buf.write(attachment.replace('\n', '\r\n'))
+    buf.write('--%s--\r\n' % boundary)
+    return buf.getvalue()
+
+def compressOutput(text, codec):
+    """
+    Returns the output text compressed with the codec, "zlib" or "lzma", as
+    bytes tagged with the codec, see OUTPUT_CODECS.  The text itself is
+    returned if the codec is "none" or compressing it doesn't pay off.
+    """
+    if codec not in OUTPUT_CODECS or not isinstance(text, str):
+        return text
+    data = text.encode('utf-8')
+    if len(data) < OUTPUT_COMPRESS_MIN:
+        return text
+    if codec == 'lzma':
+        import lzma
+        comp = lzma.compress(data)
+    else:
+        import zlib
+        comp = zlib.compress(data)
+    if len(comp) + 1 >= len(data):
+        return text
+    return OUTPUT_CODECS[codec] + comp
+
+def outputDigest(data):
+    """
+    Returns the blake2b digest of stored output, the text or the bytes from
+    compressOutput(), which identifies identical output
+    """
+    if isinstance(data, bytes):
+        return blake2b(data, digest_size=OUTPUT_DIGEST_SIZE,
+            person=b'bytes').digest()
+    return blake2b(data.encode('utf-8', 'surrogateescape'),
+        digest_size=OUTPUT_DIGEST_SIZE, person=b'text').digest()
+
+def decompressOutput(data):
+    """
+    Returns the text of output stored by compressOutput()
+    """
+    if not isinstance(data, bytes):
+        return data
+    tag = data[:1]
+    try:
+        if tag == OUTPUT_CODECS['lzma']:
+            import lzma
+            data = lzma.decompress(data[1:])
+        elif tag == OUTPUT_CODECS['zlib']:
+            import zlib
+            data = zlib.decompress(data[1:])
+        else:
+            raise ValueError('Unknown codec tag %r' % tag)
+    except Exception as e:
+        return '<The output could not be decompressed: %s>' % e
+    return data.decode('utf-8', 'replace')
+
+def parseNotifySpec(spec):
+    """
+    Parses a --notify spec of the form TYPE[,KEY=VAL...]:TARGET
+
+        returns -> (<str>, <str>, <dict>):  The type, target and params
+    """
+    head, sep, target = spec.partition(':')
+    if not sep or not target:
+        raise ValueError('Expected TYPE[,KEY=VAL...]:TARGET')
+    parts = head.split(',')
+    if parts[0] not in NOTIFIERS:
+        raise ValueError('Unknown notifier type "%s", choose from: %s' % (
+            parts[0], ', '.join(sorted(NOTIFIERS))))
+    params = {}
+    for part in parts[1:]:
+        key, sep, val = part.partition('=')
+        if key == 'timeout':
+            params[key] = float(val)
+        elif key == 'batch':
+            params[key] = int(val)
+        else:
+            raise ValueError('Unknown notifier parameter "%s"' % key)
+        if params[key] <= 0:
+            raise ValueError('The notifier %s must be greater than zero' %
+                key)
+    return (parts[0], target, params)
+
+def getNotifiers(opts):
+    """
+    Returns new instances of the notifiers configured by the options
+    """
+    notifiers = []
+    if opts.syslog:
+        notifiers.append(SyslogNotifier(opts))
+    if opts.mail:
+        notifiers.append(EmailNotifier(opts))
+    for name, target, params in opts.notifiers:
+        notifiers.append(NOTIFIERS[name](opts, target, **params))
+    return notifiers
+
+def encodeJournalFields(fields):
+    """
+    Encodes the (name, value) fields in the native journal protocol
+    """
+    buf = BytesIO()
+    for name, val in fields:
+        val = str(val).encode('utf-8')
+        if b'\n' in val:
+            # Values with newlines are sent with their length
+            buf.write(name.encode('ascii') + b'\n')
+            buf.write(struct.pack('<Q', len(val)))
+            buf.write(val + b'\n')
+        else:
+            buf.write(name.encode('ascii') + b'=' + val + b'\n')
+    return buf.getvalue()
+
+def detachProcess():
+    """
+    Forks a child process which is detached from the session and from the
+    stdio of this one, so that neither cron nor the shell waits on it.
+
+        returns -> <bool>:  True in the parent and False in the child
+    """
+    sys.stdout.flush()
+    sys.stderr.flush()
+    pid = os.fork()
+    if pid:
+        os.waitpid(pid, 0)
+        return True
+    # Fork again so the child isn't a session leader and gets reparented
+    os.setsid()
+    if os.fork():
+        os._exit(0)
+    fd = os.open(os.devnull, os.O_RDWR)
+    for i in range(3):
+        os.dup2(fd, i)
+    os.close(fd)
+    return False
+
+def atomicWrite(fname, data, mode=0o600):
+    """
+    Writes data to fname by writing a temp file, syncing it to disk and
+    renaming it over fname.  Either the old or the new contents will be in
+    fname, even if we crash.
+
+        mode<int>:      The permissions of the file, which aren't reduced
+                        by the umask
+    """
+    tmpName = '%s.tmp' % fname
+    fd = os.open(tmpName, os.O_CREAT | os.O_WRONLY | os.O_TRUNC, mode)
+    with os.fdopen(fd, 'wb') as fh:
+        os.fchmod(fh.fileno(), mode)
+        fh.write(data)
+        fh.flush()
+        os.fsync(fh.fileno())
+    os.rename(tmpName, fname)
+    fd = os.open(os.path.dirname(os.path.abspath(fname)), os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+def readLockPid(lockName):
+    """
+    Returns the PID in the lock file or None if it can't be read
+    """
+    try:
+        with open(lockName, 'rb') as fh:
+            return int(fh.read())
+    except (OSError, ValueError):
+        return None
+
+def recordOverlap(stFName, policy):
+    """
+    Records a run which overlapped the previous run of the job.  The state
+    is locked by the previous run, so this is appended to a side file which
+    is added to the state by the next run to save it, see takeOverlaps().
+    """
+    try:
+        fd = os.open('%s.overlaps' % stFName, os.O_CREAT | os.O_WRONLY |
+            os.O_APPEND, 0o600)
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX)
+            os.write(fd, ('%s %f\n' % (policy, time.time())).encode('utf-8'))
+        finally:
+            os.close(fd)
+    except OSError as e:
+        print('Failed to record the overlap for %s: %s' % (stFName, e),
+            file=sys.stderr)
+
+def takeOverlaps(stFName):
+    """
+    Returns the (policy, time) of the overlapping runs recorded by
+    recordOverlap() and clears them.  The state must be locked.
+    """
+    try:
+        fd = os.open('%s.overlaps' % stFName, os.O_RDWR)
+    except FileNotFoundError:
+        return []
+    chunks = []
+    try:
+        fcntl.flock(fd, fcntl.LOCK_EX)
+        while True:
+            chunk = os.read(fd, CHUNK_SIZE)
+            if not chunk:
+                break
+            chunks.append(chunk)
+        os.ftruncate(fd, 0)
+    finally:
+        os.close(fd)
+    overlaps = []
+    for line in b''.join(chunks).decode('utf-8', 'replace').splitlines():
+        policy, _, t = line.partition(' ')
+        try:
+            overlaps.append((policy, float(t)))
+        except ValueError:
+            continue
+    return overlaps
+
+def takeQueuedRun(opts, stFName):
+    """
+    Returns whether a run of the job was queued with "--overlap queue"
+    since the last run started, and removes the request.  This is only
+    called with the lock of the job held.
+    """
+    if opts.overlap != 'queue':
+        return False
+    try:
+        os.unlink('%s.queued' % stFName)
+    except FileNotFoundError:
+        return False
+    return True
+
+def pidExists(pid):
+    """
+    Returns whether a process with the given PID exists
+    """
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        # It exists, but belongs to someone else
+        pass
+    return True
+
+def isCwrapArgs(args):
+    """
+    Returns whether the command line, as a list, runs cwrap, either as a
+    script, like "cwrap" or "python3 /usr/bin/cwrap.py", or as a module with
+    "python3 -m cwrap"
+    """
+    if any(os.path.basename(a).startswith('cwrap') for a in args[:2]):
+        return True
+    # Look for the "-m" among the interpreter options
+    i = 1
+    while i < len(args) and args[i].startswith('-'):
+        a = args[i]
+        if a == '-m':
+            return args[i + 1:i + 2] == ['cwrap']
+        if a.startswith('-m'):
+            return a == '-mcwrap'
+        if a in ('-W', '-X'):
+            # Skip the option's argument
+            i += 1
+        i += 1
+    return False
+
+def isRunOf(pid, paths):
+    """
+    Returns whether the process is a cwrap run of a single job, owned by the
+    user, which has one of the files open: the state file, the lock file or
+    the state database.  A daemon or batch run is never a run of one job.
+    This needs /proc, without it nothing is a run of the job.
+    """
+    procDir = '/proc/%d' % pid
+    try:
+        if os.stat(procDir).st_uid != os.getuid():
+            return False
+        with open(os.path.join(procDir, 'cmdline'), 'rb') as fh:
+            args = fh.read().decode('utf-8', 'replace').split('\0')
+        if not isCwrapArgs(args):
+            return False
+        if any(a in ('--daemon', '--batch') or a.startswith('--batch=')
+                for a in args):
+            return False
+        files = set()
+        for path in paths:
+            try:
+                st = os.stat(path)
+            except OSError:
+                continue
+            files.add((st.st_dev, st.st_ino))
+        fdDir = os.path.join(procDir, 'fd')
+        for fd in os.listdir(fdDir):
+            try:
+                st = os.stat(os.path.join(fdDir, fd))
+            except OSError:
+                continue
+            if (st.st_dev, st.st_ino) in files:
+                return True
+    except OSError:
+        pass
+    return False
+
+def readState(stFName, opts=None, summary=False):
+    """
+    Reads the CommandState from the state file, of any backend, without
+    locking it.  This is for reporting only.  If the state file is replaced
+    or rewritten by a running job while it is being read, it is read again
+    so the state is from a consistent snapshot, but None may be returned if
+    it keeps changing or can't be read.
+
+        summary<bool>:      Only decode the header, command and meta section
+                            of a binary state, not its failure history.  Only
+                            the start of the file is mapped and read, which
+                            makes scanning many states much faster.  Pickled
+                            states are always read in full.
+    """
+    for i in range(STATE_READ_TRIES):
+        try:
+            before = os.stat(stFName)
+        except OSError:
+            return None
+        st = _readStateFile(stFName, opts, summary)
+        try:
+            after = os.stat(stFName)
+        except OSError:
+            return None
+        if (before.st_ino, before.st_size, before.st_mtime_ns) == \
+                (after.st_ino, after.st_size, after.st_mtime_ns):
+            return st
+    return None
+
+def isOwnFile(fh):
+    """
+    Returns whether the open file is owned by the caller.  It is checked on
+    the open file so it can't be swapped for another one after the check.
+    """
+    return os.fstat(fh.fileno()).st_uid == os.getuid()
+
+def _readStateFile(stFName, opts, summary):
+    try:
+        with open(stFName, 'rb') as fh:
+            # Others can put files in a shared state directory, and a
+            # pickle can run any code when it is loaded
+            if not isOwnFile(fh):
+                return None
+            magic = fh.read(len(StateCodec.magic))
+            if magic == StateCodec.magic and summary:
+                import mmap
+                mm = mmap.mmap(fh.fileno(), 0, access=mmap.ACCESS_READ)
+                try:
+                    st = StateCodec.decodeSummary(mm, opts)
+                finally:
+                    mm.close()
+            elif magic == StateCodec.magic:
+                st = StateCodec.decode(magic + fh.read(), opts)
+            else:
+                import pickle
+                st = pickle.loads(magic + fh.read())
+    except Exception:
+        return None
+    if not isinstance(st, CommandState):
+        return None
+    if magic == StateCodec.magic:
+        try:
+            LogStateFile.replayJournal(st, '%s.journal' % stFName, False)
+        except (OSError, ValueError, struct.error):
+            return None
+    StateFile._upgrade(st)
+    return st
+
+def listStateFiles(stateDir):
+    """
+    Returns the sorted paths of all the state files in the state directory
+    """
+    return sorted(os.path.join(stateDir, f) for f in os.listdir(stateDir)
+        if splitStateFileName(f))
+
+def splitStateFileName(name):
+    """
+    Splits the base name of a state file into the name of the binary and
+    the digest of the command
+
+        returns -> (<str>, <str>):  The binary and digest, or None if this
+                                    isn't the name of a state file
+    """
+    binExec, sep, digest = name.rpartition('.')
+    if not sep or len(digest) != 32 or digest.strip('0123456789abcdef'):
+        return None
+    return (binExec, digest)
+
+def _escLabel(val):
+    return val.replace('\\', '\\\\').replace('\n', '\\n').replace('"',
+        '\\"')
+
+def _fmtVal(val):
+    if val == float('inf'):
+        return '+Inf'
+    if isinstance(val, float):
+        return repr(val)
+    return str(val)
+
+def formatMetrics(states, fmt='prometheus'):
+    """
+    Returns the metrics for the command states in the Prometheus text
+    exposition format or, if fmt is "openmetrics", in the OpenMetrics format.
+
+        states<list>:       A list of (state file name, CommandState) tuples
+    """
+    om = fmt == 'openmetrics'
+    lines = []
+
+    def family(name, mtype, help, samples):
+        # OpenMetrics names the counter family without the _total suffix
+        fname = name
+        if om and mtype == 'counter':
+            fname = name[:-len('_total')]
+        lines.append('# HELP %s %s' % (fname, help))
+        lines.append('# TYPE %s %s' % (fname, mtype))
+        for labels, suffix, val in samples:
+            if val is None:
+                continue
+            lines.append('%s%s{%s} %s' % (name, suffix, labels,
+                _fmtVal(val)))
+
+    jobs = []
+    for stFName, st in states:
+        binExec, digest = splitStateFileName(os.path.basename(stFName))
+        labels = 'job="%s",hash="%s",command="%s"' % (_escLabel(binExec),
+            digest, _escLabel(' '.join(st.cmdList)))
+        jobs.append((labels, st))
+    family('cwrap_runs_total', 'counter', 'The number of runs of the command',
+        [(l, '', st.runCount) for l, st in jobs])
+    family('cwrap_last_exit_code', 'gauge', 'The exit code of the last run, '
+        '-1 is a python error', [(l, '', st.lastExitCode) for l, st in jobs])
+    family('cwrap_consecutive_failures', 'gauge', 'The number of '
+        'consecutive failures', [(l, '', st.NumFails) for l, st in jobs])
+    family('cwrap_last_runtime_seconds', 'gauge', 'The run time of the '
+        'last run', [(l, '', st.lastRunTime) for l, st in jobs])
+    family('cwrap_last_run_timestamp_seconds', 'gauge', 'The time the last '
+        'run finished', [(l, '', st.lastRunEnd) for l, st in jobs])
+    family('cwrap_last_success_timestamp_seconds', 'gauge', 'The time the '
+        'last successful run finished',
+        [(l, '', st.lastSuccessTime) for l, st in jobs])
+    family('cwrap_emails_sent_total', 'counter', 'The number of failure '
+        'report emails sent', [(l, '', st.emailsSent) for l, st in jobs])
+    family('cwrap_runtime_mean_seconds', 'gauge', 'The exponentially '
+        'weighted mean of the run times of the successful runs',
+        [(l, '', st.runTimeMean) for l, st in jobs])
+    family('cwrap_runtime_p99_seconds', 'gauge', 'The estimated 99th '
+        'percentile of the run times of the recent successful runs',
+        [(l, '', st.getRuntimeQuantile(0.99)) for l, st in jobs])
+    family('cwrap_runtime_anomalies_total', 'counter', 'The number of '
+        'successful runs whose run time was an anomaly',
+        [(l, '', st.anomalyCount) for l, st in jobs])
+    family('cwrap_overlaps_total', 'counter', 'The number of runs which '
+        'overlapped the previous run, by the policy applied to them',
+        [('%s,policy="%s"' % (l, p), '', st.overlaps.get(p, 0))
+        for l, st in jobs for p in OVERLAP_POLICIES[1:]])
+    family('cwrap_last_overlap_timestamp_seconds', 'gauge', 'The time of '
+        'the last overlapping run',
+        [(l, '', st.lastOverlapTime) for l, st in jobs])
+    samples = []
+    for l, st in jobs:
+        count = 0
+        for le, n in zip(RUNTIME_BUCKETS, st.runTimeBuckets):
+            count += n
+            samples.append(('%s,le="%s"' % (l, _fmtVal(le)), '_bucket',
+                count))
+        samples.append((l, '_sum', st.runTimeSum))
+        samples.append((l, '_count', count))
+    family('cwrap_runtime_seconds', 'histogram', 'The run times of the '
+        'command', samples)
+    if om:
+        lines.append('# EOF')
+    return '\n'.join(lines) + '\n'
+
+def writeMetricsFile(opts, stFName, comSt):
+    """
+    Atomically writes the metrics for the command to a textfile collector
+    .prom file in the metrics directory, if one was given
+    """
+    if not opts.metricsDir:
+        return
+    fname = os.path.join(opts.metricsDir, 'cwrap-%s.prom' %
+        os.path.basename(stFName))
+    try:
+        # The collector usually runs as another user
+        atomicWrite(fname, formatMetrics([(stFName, comSt)],
+            opts.metricsFormat).encode('utf-8'), 0o644)
+    except OSError as e:
+        print('Failed to write metrics file %s: %s' % (fname, e),
+            file=sys.stderr)
+
+def iterStates(opts, failingOnly=False, summary=False):
+    """
+    Generator for the (state file name, CommandState) of all the jobs in
+    the state directory, or in the database of the sqlite backend, read
+    without locking them.  If summary is set, the failure histories of the
+    states aren't decoded, see readState().
+    """
+    if opts.stateBackend == 'sqlite':
+        for item in SqliteStateFile.iterStates(opts, failingOnly, summary):
+            yield item
+        return
+    for stFName in listStateFiles(opts.stateDir):
+        st = readState(stFName, opts, summary)
+        if st is not None and (st.NumFails or not failingOnly):
+            yield (stFName, st)
+
+def dumpMetrics(opts):
+    """
+    Prints the metrics for all the state files in the state directory
+    """
+    sys.stdout.write(formatMetrics(list(iterStates(opts, summary=True)),
+        opts.metricsFormat))
+
+def getStatusRows(opts):
+    """
+    Returns the (streak, last exit code, last run time, last run time in
+    ms, command) of the failing jobs, longest streak first
+    """
+    if opts.stateBackend == 'sqlite':
+        # Answered from the indexed columns without decoding any state
+        dbName = SqliteStateFile.getDbName(opts)
+        if not os.path.exists(dbName):
+            return []
+        conn = SqliteStateFile.connect(dbName, True)
+        try:
+            return [(r[0], r[1], r[2], r[3] * 1000 if r[3] is not None
+                else None, r[4]) for r in conn.execute('SELECT num_fails, '
+                'last_status, last_run_time, last_runtime, command FROM '
+                'jobs WHERE num_fails > 0 ORDER BY num_fails DESC, '
+                'last_run_time DESC')]
+        finally:
+            conn.close()
+    rows = []
+    for stFName, st in iterStates(opts, True, True):
+        rows.append((st.NumFails, st.lastExitCode, st.lastRunEnd,
+            st.lastRunTime * 1000 if st.lastRunTime is not None else None,
+            ' '.join(st.cmdList)))
+    rows.sort(key=lambda r: (-r[0], -(r[2] or 0)))
+    return rows
+
+def printStatus(opts):
+    """
+    Prints the failing jobs
+    """
+    rows = getStatusRows(opts)
+    print('%6s %5s %-19s %11s  %s' % ('STREAK', 'EXIT', 'LAST RUN',
+        'RUNTIME MS', 'COMMAND'))
+    for streak, exitCode, lastRun, runTime, cmd in rows:
+        print('%6d %5s %-19s %11s  %s' % (streak,
+            '-' if exitCode is None else exitCode, _fmtTime(lastRun),
+            '-' if runTime is None else '%.1f' % runTime, cmd))
+
+def inspectJob(opts, cmdList):
+    """
+    Prints the state of the job for the command line, found with the same
+    options the job is run with, without locking it
+
+        returns -> <int>:   The exit code, 1 if the job has no state
+    """
+    stFName = StateFile.getStateFileName(opts, cmdList)
+    lockPid = None
+    if opts.stateBackend == 'sqlite':
+        st = next(SqliteStateFile.iterStates(opts, name=stFName),
+            (None, None))[1]
+    else:
+        st = readState(stFName, opts)
+        lockPid = readLockPid(opts.lockFile or '%s.lock' % stFName)
+        if lockPid is not None and not pidExists(lockPid):
+            lockPid = None
+    if st is None:
+        print('There is no state for the command: %s' % ' '.join(cmdList),
+            file=sys.stderr)
+        return 1
+    # The backoff position depends on the current options
+    st.opts = opts
+    print(formatInspect(stFName, st, lockPid))
+    return 0
+
+def formatInspect(stFName, st, lockPid=None):
+    """
+    Returns the human readable report of the state of a job for --inspect
+    """
+    sio = StringIO()
+    sio.write('State:             %s\n' % stFName)
+    sio.write('Command:           %s\n' % ' '.join(st.cmdList))
+    if lockPid:
+        sio.write('Running:           PID %d\n' % lockPid)
+    sio.write('Runs:              %d\n' % st.runCount)
+    sio.write('Last run:          %s\n' % _fmtTime(st.lastRunEnd))
+    sio.write('Last exit code:    %s\n' % ('-' if st.lastExitCode is None
+        else st.lastExitCode))
+    sio.write('Last runtime:      %s\n' % ('-' if st.lastRunTime is None
+        else '%.3f s' % st.lastRunTime))
+    if st.runCount:
+        sio.write('Mean runtime:      %.3f s\n' % (st.runTimeSum /
+            st.runCount))
+    if st.runTimeMean is not None:
+        sio.write('Recent runtime:    mean %.3f s, sd %.3f s, p50 %.3f s, '
+            'p99 %.3f s\n' % (st.runTimeMean, math.sqrt(st.runTimeVar),
+            st.getRuntimeQuantile(0.5), st.getRuntimeQuantile(0.99)))
+    threshold = st.getRuntimeThreshold()
+    if threshold is not None:
+        sio.write('Anomaly threshold: %.3f s, %d anomalies\n' % (threshold,
+            st.anomalyCount))
+        sio.write('Suggested timeout: %d s\n' % st.getSuggestedTimeout())
+    sio.write('Last success:      %s\n' % _fmtTime(st.lastSuccessTime))
+    if st.lastRusage:
+        sio.write('Last rusage:       %s\n' % formatRusage(st.lastRusage))
+    sio.write('Failure streak:    %d\n' % st.NumFails)
+    if st.NumFails:
+        sio.write('First failure:     %s\n' % _fmtTime(st.firstFailTime))
+        sio.write('Failure runtime:   %.3f s\n' % st.failRunTime)
+    sio.write('Last report:       %s\n' % ('at failure %d' %
+        st._lastEmailNum if st._lastEmailNum else '-'))
+    nextNum = st.getNextReport()
+    sio.write('Next report:       %s%s\n' % ('-' if nextNum is None else
+        'at failure %d' % nextNum, ' (backoff)' if st.opts.backoff else ''))
+    sio.write('Emails sent:       %d\n' % st.emailsSent)
+    if st.overlaps:
+        sio.write('Overlaps:          %s, last at %s\n' % (', '.join(
+            '%s %d' % (p, st.overlaps.get(p, 0))
+            for p in OVERLAP_POLICIES[1:]), _fmtTime(st.lastOverlapTime)))
+    fails = st.failures[-st.opts.numFails:]
+    if fails:
+        sio.write('\nRecent failures:\n')
+        sio.write('%-19s %11s %5s  %s\n' % ('STARTED', 'RUNTIME S', 'EXIT',
+            'OUTPUT'))
+        for f in fails:
+            out = f.pyError or f.stderr or f.stdout or ''
+            lines = out.strip().splitlines()
+            if f.warning and lines:
+                lines[-1] = 'warning: %s' % lines[-1]
+            sio.write('%-19s %11.3f %5d  %s\n' % (_fmtTime(f.timeStarted),
+                f.runTime, f.exitCode, lines[-1][:60] if lines else ''))
+    return sio.getvalue().rstrip('\n')
+
+def _fmtTime(t):
+    if not t:
+        return '-'
+    return time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(t))
+
+def formatRusage(rusage):
+    """
+    Returns a one line, human readable string for a rusage tuple
+    """
+    ret = ('CPU user/sys: %.02f/%.02fs, max RSS: %d KB, block I/O in/out: '
+        '%d/%d, context switches vol/invol: %d/%d' % rusage[:7])
+    if rusage[7]:
+        ret += ', max process tree RSS: %d KB' % rusage[7]
+    return ret
+
+def getTreeRss(pid):
+    """
+    Returns the total RSS, in KB, of the process and all its descendants
+    by reading /proc.  Zero is returned if /proc can't be read.
+    """
+    children = {}
+    rss = {}
+    pageKB = os.sysconf('SC_PAGE_SIZE') // 1024
+    try:
+        pids = [d for d in os.listdir('/proc') if d.isdigit()]
+    except OSError:
+        return 0
+    for d in pids:
+        try:
+            with open('/proc/%s/stat' % d, 'rb') as fh:
+                stat = fh.read()
+        except OSError:
+            continue
+        # The command name can contain spaces, so split after it
+        fields = stat[stat.rfind(b')') + 2:].split()
+        children.setdefault(int(fields[1]), []).append(int(d))
+        rss[int(d)] = int(fields[21]) * pageKB
+    total = 0
+    todo = [pid]
+    while todo:
+        p = todo.pop()
+        total += rss.get(p, 0)
+        todo.extend(children.get(p, []))
+    return total
+
+def truncateOutput(text, limit):
+    """
+    Truncates the text to roughly limit characters by keeping the head and
+    the tail of it with a marker in between.  A limit of zero disables the
+    truncation.
+    """
+    if not limit or len(text) <= limit:
+        return text
+    half = limit // 2
+    return '%s\n[... %d characters truncated ...]\n%s' % (text[:half],
+        len(text) - 2 * half, text[len(text) - half:])
+
+def getOpts(argv=None, raiseUsage=False):
     global LOGPRI
     """
     Parses the command line options and returns the output of
     OptionParser.parse_args()
 
+    argv<list>:         The args to parse instead of sys.argv[1:]
+    raiseUsage<bool>:   Raise a UsageError for bad options instead of
+                        exiting, so that a bad request can't take down the
+                        daemon
+
     returns -> (<OptionParser.Values>, <list>)
     """
+    if argv is None:
+        argv = sys.argv[1:]
+    # The options of a job hardly ever change, so the validated options
+    # from a previous run are used if nothing they depend on changed.  This
+    # is what keeps the parser off the common path, rather than a second,
+    # trimmed parser for the common flags which would have to be kept in
+    # step with this one.  Runs which can't be cached, like those with an
+    # SMTP password, still go through argparse.
+    cache = ConfigCache(argv)
+    cached = cache.load()
+    if cached is not None:
+        if cached[0].syslog:
+            syslog.openlog('cwrap', syslog.LOG_PID, cache.facility)
+            LOGPRI = cache.priority
+        return cached
+
+    from argparse import ArgumentParser, ArgumentError
+
+    class DaemonArgumentParser(ArgumentParser):
+        def error(self, message):
+            raise UsageError(message)
+
+        def exit(self, status=0, message=None):
+            raise UsageError(message or 'exit requested: %d' % status)
+
     # Callback for the state directory that checks to make sure
     # the directory exists and is writable
     def cb_sd(val):
@@ -585,7 +4263,10 @@ def getOpts():
                 'State directory must be a writable directory')
         return val
 
-    p = ArgumentParser()
+    if raiseUsage:
+        p = DaemonArgumentParser()
+    else:
+        p = ArgumentParser()
     gState = p.add_argument_group('State Options', 'These options pertain to '
         'state and lock maintenance')
     gFailure = p.add_argument_group('Failure Options', 'These are the options '
@@ -602,6 +4283,16 @@ def getOpts():
         'addresses than what is in your crontab, you can specify these here. '
         'You can also use an external SMTP server to send the email '
         'instead of the local mailer.')
+    gNotify = p.add_argument_group('Notifier Options', 'Send the failures '
+        'to other places, like an event pipeline, as JSON.')
+    gMetrics = p.add_argument_group('Metrics Options', 'Export the run '
+        'history as metrics for monitoring systems like Prometheus.')
+    gBatch = p.add_argument_group('Batch Options', 'Run a batch of commands '
+        'concurrently from a single cwrap, instead of one cwrap per command.')
+    gDaemon = p.add_argument_group('Daemon Options', 'A cwrap daemon runs '
+        'the commands for many cron jobs from a single long running process. '
+        'The cron jobs then just use "cwrap --socket PATH ..." to have the '
+        'daemon run their command.')
 
     p.add_argument('-V', '--version', dest='version', default=False,
         action='store_true',
@@ -610,8 +4301,50 @@ def getOpts():
         help='Turn on debug output [default: %(default)s]')
 
     gState.add_argument('-d', '--state-directory', dest='stateDir',
-        default='/var/tmp', metavar='PATH', type=cb_sd,
+        default=DEFAULT_STATE_DIR, metavar='PATH', type=cb_sd,
         help='The directory to write the state file to. [default: %(default)s]')
+    gState.add_argument('--state-backend', dest='stateBackend',
+        default='pickle', choices=sorted(STATE_BACKENDS),
+        help='The format of the state file.  "pickle" rewrites the whole '
+        'state on every run.  "binary" uses a compact binary format which '
+        'is replaced atomically.  "log" appends a small record for each run '
+        'to a journal which is periodically compacted into a "binary" state '
+        'file.  "sqlite" keeps the state of all the jobs in a single '
+        'SQLite database, see "--state-db". [default: %(default)s]')
+    gState.add_argument('--compact-every', dest='compactEvery', type=int,
+        default=100, metavar='INT',
+        help='The number of journal records after which the "log" state '
+        'backend compacts the journal into the state file. '
+        '[default: %(default)s]')
+    gState.add_argument('--compress-output', dest='compressOutput',
+        default='zlib', choices=['none'] + sorted(OUTPUT_CODECS),
+        help='How to compress the stdout and stderr of failures in the '
+        'state.  Output shorter than %d bytes is stored as is. '
+        '[default: %%(default)s]' % OUTPUT_COMPRESS_MIN)
+    gState.add_argument('--state-db', dest='stateDb', default=None,
+        metavar='FILE',
+        help='The SQLite database of the "sqlite" state backend '
+        '[default: <state-directory>/cwrap.db]')
+    gState.add_argument('--status', dest='status', default=False,
+        action='store_true',
+        help='Print the failing jobs in the state directory, or in the '
+        'database of the "sqlite" backend, with their failure streaks and '
+        'last run times and exit [default: %(default)s]')
+    gState.add_argument('--inspect', dest='inspect', default=False,
+        action='store_true',
+        help='Print the state of the job for the command, given with the '
+        'same options it is run with, including its recent failures, '
+        'timings and the failure number of the next report, and exit.  '
+        'The job is not run and its state is not locked '
+        '[default: %(default)s]')
+    gState.add_argument('--no-config-cache', dest='configCache',
+        default=True, action='store_false',
+        help='Don\'t cache the validated options in the state directory.  '
+        'Normally the parsing and validation of the options, including '
+        'finding sendmail, is skipped when nothing it depends on has '
+        'changed since the last run.  Runs with an SMTP password are never '
+        'cached '
+        '[default: cache]')
     gState.add_argument('-F', '--lock-file', dest='lockFile', default=None,
         metavar='FILE',
         help='Set a specific lock file to use.  This is useful when running '
@@ -629,6 +4362,30 @@ def getOpts():
         help='This is the number of seconds between retries.  This only '
         'matters if the "-r" option is set to greater than zero. '
         '[default: %(default)s]')
+    gRetry.add_argument('--lock-mode', dest='lockMode', default='file',
+        choices=('file', 'flock'),
+        help='How the state is locked.  "file" creates the lock file '
+        'exclusively and removes it when done, a lock file left behind by a '
+        'process that no longer exists is taken over.  "flock" takes a '
+        'kernel advisory lock on the lock file which is released '
+        'automatically when this process exits. [default: %(default)s]')
+    gRetry.add_argument('--lock-wait', dest='lockWait', type=float,
+        default=0, metavar='SECS',
+        help='With "--lock-mode flock", block for up to SECS seconds waiting '
+        'for the lock.  The lock is acquired the moment the previous '
+        'instance exits.  This is tried before each of the "-r" retries. '
+        '[default: %(default)s]')
+    gRetry.add_argument('--overlap', dest='overlap', default='fail',
+        choices=OVERLAP_POLICIES,
+        help='What to do when the previous run of the job is still '
+        'running.  "fail" retries as set by "-r" and then fails.  "skip" '
+        'exits right away without an error.  "queue" requests one more run '
+        'from the previous run once it is done and exits, all the runs '
+        'queued meanwhile are done by that one run.  "replace" stops the '
+        'previous run and its command, with a SIGTERM and after the kill '
+        'grace period a SIGKILL, and runs in its place, if it is verified '
+        'to be a cwrap run of the job.  The overlaps are counted in the '
+        'state. [default: %(default)s]')
     gRetry.add_argument('-i', '--ignore-retry-fails', dest='ignoreRetFail',
         action='store_true', default=False,
         help='Ignore the failures which occur because this tried to run '
@@ -645,12 +4402,47 @@ def getOpts():
         help='The default is to print a failure report only when a multiple '
         'of the failure threshold is reached. If this is set, an email will '
         '*also* be sent on the first failure. [default: %(default)s]')
+    gFailure.add_argument('--max-history', dest='maxHistory', type=int,
+        default=DEFAULT_MAX_HISTORY, metavar='INT',
+        help='The maximum number of consecutive failures to keep in the '
+        'state file.  Older failures are dropped and only counted.  This '
+        'will never be less than "-n".  Set to zero to keep all of them. '
+        '[default: %(default)s]')
+    gFailure.add_argument('--max-fail-output', dest='maxFailOutput',
+        type=int, default=DEFAULT_MAX_FAIL_OUTPUT, metavar='INT',
+        help='The maximum number of characters of each of stdout and stderr '
+        'to store for a failure.  The beginning and the end of the output '
+        'are kept.  Set to zero to store all of it. [default: %(default)s]')
+    gFailure.add_argument('--no-collapse', dest='collapseFails',
+        action='store_false', default=True,
+        help='Show every failure in a report in full.  By default, '
+        'consecutive failures with the same exit code and output are shown '
+        'once, with the number of times and when they were first and last '
+        'seen.')
     gFailure.add_argument('-b', '--backoff', dest='backoff',
         action='store_true', default=False,
         help='Instead of sending an email out every "-n" failures, if this is '
         'set, emails will be sent out at an exponentially decaying rate.  '
         'If you set the num fails to 3, then an email would be sent at 3 '
         'fails, 6 fails, 12 fails, 24 fails, etc. [default: %(default)s]')
+    gFailure.add_argument('--anomaly', dest='anomaly', default='off',
+        choices=('off', 'warn', 'fail'),
+        help='What to do with a successful run whose run time is over the '
+        'threshold learned from the recent run times, the 99th percentile '
+        'times "--anomaly-factor".  "warn" prints a warning to stderr and '
+        'records and reports the run like a failure, but with the status '
+        '"warning", and "fail" treats the run as a failure. '
+        '[default: %(default)s]')
+    gFailure.add_argument('--anomaly-factor', dest='anomalyFactor',
+        type=float, default=3, metavar='FLOAT',
+        help='The multiple of the 99th percentile of the recent run times '
+        'over which a run is an anomaly [default: %(default)s]')
+    gFailure.add_argument('--anomaly-min-runs', dest='anomalyMinRuns',
+        type=int, default=20, metavar='INT',
+        help='The number of successful runs needed before run times are '
+        'checked for anomalies or a timeout is suggested.  After this many '
+        'anomalies in a row, the run time is taken to have changed for good '
+        'and is learned anew. [default: %(default)s]')
 
     gCommand.add_argument('-p', '--path', dest='PATH',
         default=os.environ['PATH'], metavar='CMD_PATH',
@@ -665,16 +4457,79 @@ def getOpts():
         'in your command to be run: "cat /tmp/file | grep stuff".  That '
         'would be passed directly to a subshell for execution '
         '[default: %(default)s]')
+    gCommand.add_argument('--no-fast-spawn', dest='fastSpawn',
+        action='store_false', default=True,
+        help='Always run a "--single-string" command through the shell and '
+        'start the command the way subprocess does by default.  Otherwise, '
+        'a single string without any shell syntax, whose command is a '
+        'binary or a "#!" script, is run directly and, '
+        'where python would fork() to start it, the command is started '
+        'with posix_spawn() instead.')
     gCommand.add_argument('-t', '--timeout', dest='timeout',
-        metavar='INT', default=0, type=int,
-        help='The number of seconds to allow the command to run before '
-        'terminating.  Set to zero to disable timeouts. [default: %(default)s]')
+        metavar='SECS', default=0, type=float,
+        help='The number of seconds, which can be fractional, to allow the '
+        'command to run before terminating.  Set to zero to disable '
+        'timeouts. [default: %(default)s]')
+    gCommand.add_argument('--auto-timeout', dest='autoTimeout',
+        action='store_true', default=False,
+        help='If no "--timeout" is set, use the timeout suggested by the run '
+        'time history, the anomaly threshold rounded up to whole seconds, '
+        'once there have been "--anomaly-min-runs" successful runs.  See '
+        '"--inspect". [default: %(default)s]')
+    gCommand.add_argument('--kill-grace', dest='killGrace',
+        metavar='SECS', default=5, type=float,
+        help='When the timeout is reached, the command is sent a SIGTERM.  '
+        'If it hasn\'t exited after this many seconds, it is sent a '
+        'SIGKILL.  With "-g", the signals are sent to the whole process '
+        'group of the shell. [default: %(default)s]')
     gCommand.add_argument('-z', '--fuzz', dest='fuzz', metavar='INT',
-        type=int, default=0, help='This will add a random sleep between 0 '
-        'and N seconds before executing the command.  Note that the '
+        type=int, default=0, help='This will add a sleep between 0 and N '
+        'seconds before executing the command.  The sleep is derived from '
+        'the hash of the command line, so a job always starts at the same '
+        'offset and the jobs started at the same time are spread evenly '
+        'over the N seconds.  Note that the '
         '--timeout is only valid in regards to when the command is actually '
         'run.  To calculate run time, you should add timeout + fuzz + '
         'command run time [default: %(default)s]')
+    gCommand.add_argument('--max-running', dest='maxRunning', metavar='INT',
+        type=int, default=0,
+        help='The maximum number of commands run at once by all the cwraps '
+        'of the user using the same state directory.  A run waits for one of the slots '
+        'to be free before starting the command.  Zero is no limit '
+        '[default: %(default)s]')
+    gCommand.add_argument('--slot-priority', dest='slotPriority',
+        metavar='INT', type=int, default=0,
+        help='With "--max-running", the runs waiting with a higher priority '
+        'get a free slot first [default: %(default)s]')
+    gCommand.add_argument('--slot-wait', dest='slotWait', metavar='SECS',
+        type=float, default=0,
+        help='With "--max-running", the number of seconds to wait for a '
+        'slot before failing the run.  Zero waits forever '
+        '[default: %(default)s]')
+    gCommand.add_argument('--capture-limit', dest='captureLimit',
+        metavar='BYTES', type=int, default=DEFAULT_CAPTURE_LIMIT,
+        help='The maximum number of bytes of output to keep in memory for '
+        'each of stdout and stderr.  Only the last BYTES bytes of each are '
+        'kept for reports and printed for a successful run, unless '
+        '"--spill" is set.  Set to zero to keep all the output. '
+        '[default: %(default)s]')
+    gCommand.add_argument('--spill', dest='spill', default=False,
+        action='store_true',
+        help='Write the full stdout and stderr of the command to spill files '
+        'next to the state file.  Use this with "--capture-limit" to keep '
+        'memory usage flat while still having the full output available '
+        '[default: %(default)s]')
+    gCommand.add_argument('--live-output', dest='liveOutput', default=False,
+        action='store_true',
+        help='Pass the output of the command through as it is printed, '
+        'instead of when the command exits.  Note that this means the '
+        'output of failed runs is printed as well.  This has no effect if '
+        '"-q" is set [default: %(default)s]')
+    gCommand.add_argument('--sample-proc', dest='sampleProc', default=False,
+        action='store_true',
+        help='Sample the memory use of the whole process tree of the '
+        'command from /proc while it runs and record the maximum along '
+        'with the other resource usage [default: %(default)s]')
     gCommand.add_argument('-q', '--quiet', dest='quiet', default=False,
         action='store_true',
         help='Only output error reports.  If the command runs successfully, '
@@ -703,6 +4558,18 @@ def getOpts():
         'Normally, *all* failures are logged, but you can use this option to '
         'only write to syslog only when --num-fails is reached '
         '[default: %(default)s]')
+    gSyslog.add_argument('--syslog-format', dest='sFormat',
+        default='plain', choices=('plain', 'kv', 'sd-kv', 'journald'),
+        help='The format of the syslog messages.  "kv" is key=value pairs, '
+        '"sd-kv" is the pairs in a structured data element in the syntax of '
+        'RFC 5424, in the message of a regular syslog record, and "journald" '
+        'sends native CWRAP_* fields to the systemd journal '
+        '[default: %(default)s]')
+    gSyslog.add_argument('--syslog-max-output', dest='sMaxOutput',
+        type=int, default=1024, metavar='CHARS',
+        help='Limit the stdout, stderr and python error in each syslog '
+        'message to this many characters from their head and tail, or zero '
+        'to not limit them [default: %(default)s]')
 
     gEmail.add_argument('-M', '--send-mail', action='store_true', dest='mail',
         default=False, help='Send an email from within cwrap itself.  This '
@@ -716,10 +4583,10 @@ def getOpts():
         'normally cause crond to send an email.  This can *only* be specified '
         'if you are using cwrap to send an email (-M).  [default: %(default)s]')
     gEmail.add_argument('-E', '--email-from', dest='mailFrom',
-        default='%s@localhost.localdomain' % getpass.getuser(),
+        default=None,
         metavar='EMAIL_ADDR', help='The email address to use as the sending '
         'address.  It is advised that you set this to a non-default. '
-        '[default: %(default)s]')
+        '[default: <user>@localhost.localdomain]')
     gEmail.add_argument('-R', '--email-recipient', action='append',
         default=[], dest='mailRecips', metavar='EMAIL_ADDR',
         help='The recipient(s) to send '
@@ -755,21 +4622,101 @@ def getOpts():
         'credentials file instead.  All you should have in the file is: '
         'USERNAME:PASSWORD [default: %(default)s]')
 
-    opts, cmdList = p.parse_known_args()
+    gEmail.add_argument('--email-attach', dest='emailAttach',
+        action='store_true', default=False,
+        help='Send a short summary of the failures in the body of the '
+        'email and attach the full report, with the output of the '
+        'failures, gzipped [default: %(default)s]')
+    gEmail.add_argument('--smtp-timeout', dest='smtpTimeout', type=float,
+        default=30, metavar='SECS',
+        help='The timeout for connecting to and talking to the SMTP server, '
+        'or for the sendmail command.  Zero disables it. '
+        '[default: %(default)s]')
+    gEmail.add_argument('--mail-retries', dest='mailRetries', type=int,
+        default=3, metavar='INT',
+        help='The number of times to retry sending a failed email '
+        '[default: %(default)s]')
+    gEmail.add_argument('--mail-retry-delay', dest='mailRetryDelay',
+        type=float, default=10, metavar='SECS',
+        help='The delay before the first retry of a failed email.  It '
+        'doubles for each retry after that [default: %(default)s]')
+    gEmail.add_argument('--spool-dir', dest='spoolDir', default=None,
+        metavar='PATH',
+        help='Queue the emails in this directory instead of sending them. '
+        'They are sent by "--flush-spool" or by a daemon with the same '
+        'spool directory [default: %(default)s]')
+    gEmail.add_argument('--flush-spool', dest='flushSpool', default=False,
+        action='store_true',
+        help='Send all the emails queued in the spool directory, '
+        'digesting the ones for the same recipients into one email, and '
+        'exit [default: %(default)s]')
+
+    gDaemon.add_argument('--daemon', dest='daemon', default=False,
+        action='store_true',
+        help='Run as a daemon serving the requests of cwrap clients on the '
+        'socket given by "--socket", which only the user can access.  This '
+        'fails if another daemon is serving the socket. '
+        '[default: %(default)s]')
+    gDaemon.add_argument('--socket', dest='socket', default=None,
+        metavar='PATH',
+        help='The Unix socket of the daemon.  When not running the daemon, '
+        'this has to be the *first* argument, and the rest of the command '
+        'line is sent to the daemon to be run.  If the daemon can\'t be '
+        'reached, the command is run locally instead. '
+        '[default: <state-directory>/cwrap.sock]')
+    gDaemon.add_argument('--flush-interval', dest='flushInterval',
+        type=float, default=5, metavar='SECS',
+        help='The number of seconds between writes of the state of the jobs '
+        'run by the daemon to their state files [default: %(default)s]')
+
+    gNotify.add_argument('--notify', dest='notify', action='append',
+        default=[], metavar='TYPE[,KEY=VAL...]:TARGET',
+        help='Send every failure to TARGET.  TYPE is "webhook" to POST '
+        'JSON to a URL, "unix" to send JSON datagrams to a Unix socket or '
+        '"jsonl" to append JSON lines to a file.  KEY can be "timeout" or '
+        '"batch".  This option can be specified multiple times. '
+        '[default: %(default)s]')
+
+    gMetrics.add_argument('--metrics-dir', dest='metricsDir', default=None,
+        metavar='PATH',
+        help='Write the metrics for the command to a .prom file in this '
+        'directory after every run.  Point the node_exporter textfile '
+        'collector at this directory. [default: %(default)s]')
+    gMetrics.add_argument('--metrics', dest='metrics', default=False,
+        action='store_true',
+        help='Print the metrics for all the state files in the state '
+        'directory and exit [default: %(default)s]')
+    gMetrics.add_argument('--metrics-format', dest='metricsFormat',
+        default='prometheus', choices=('prometheus', 'openmetrics'),
+        help='The format of the metrics [default: %(default)s]')
+
+    gBatch.add_argument('--batch', dest='batch', default=None,
+        metavar='FILE',
+        help='Run each of the commands in FILE, one per line, concurrently '
+        'from this single cwrap.  Use "-" to read the commands from stdin.  '
+        'Each command is treated as if it had been run with all the other '
+        'options given here, including "-g". [default: %(default)s]')
+    gBatch.add_argument('--concurrency', dest='concurrency', type=int,
+        default=4, metavar='INT',
+        help='The maximum number of batch commands to run at the same time '
+        '[default: %(default)s]')
+
+    opts, cmdList = p.parse_known_args(argv)
 
     if opts.version:
         print('cwrap: %s' % __version__)
         sys.exit(0)
-    # Eval the syslog priority and facility if syslogging is on
+    # Look up the syslog priority and facility if syslogging is on
+    fac = pri = None
     if opts.syslog:
         try:
-            fac = eval('syslog.%s' % opts.sFacility)
-        except:
+            fac = getattr(syslog, opts.sFacility)
+        except AttributeError:
             p.error('Invalid syslog facility, "%s", see "man syslog" for '
                 'facility choices')
         try:
-            pri = eval('syslog.%s' % opts.sPriority)
-        except:
+            pri = getattr(syslog, opts.sPriority)
+        except AttributeError:
             p.error('Invalid syslog priority, "%s", see "man syslog" for '
                  'priority (level) options')
         try:
@@ -778,33 +4725,142 @@ def getOpts():
             p.error('Error opening syslog with facility %s: %s' % (
                 opts.sFacility, e))
         LOGPRI = pri
+    if opts.sMaxOutput < 0:
+        p.error('The max syslog output must be a positive integer, or zero '
+            'to disable it')
     if opts.numFails < 1:
         p.error('Number of fails must be at least 1.')
+    if opts.compactEvery < 1:
+        p.error('The compaction interval must be at least 1')
+    if opts.maxHistory < 0:
+        p.error('The max history must be a positive integer, or zero to '
+            'disable it')
+    if opts.maxFailOutput < 0:
+        p.error('The max failure output must be a positive integer, or zero '
+            'to disable it')
     if opts.numRetries < 0:
         p.error('Number of retries can not be less than 0')
+    if opts.lockWait < 0:
+        p.error('The lock wait must be a positive number, or zero to '
+            'disable it')
     if opts.retrySecs < 1:
         p.error('Retry seconds cannot be less than 1')
     if opts.timeout < 0:
-        p.error('Command timeout must be set to a positive integer or zero to'
+        p.error('Command timeout must be set to a positive number or zero to '
             'disable it')
+    if opts.killGrace < 0:
+        p.error('The kill grace period cannot be negative')
+    if opts.captureLimit < 0:
+        p.error('The capture limit must be a positive integer, or zero to '
+            'disable it')
+    if opts.anomalyFactor <= 0:
+        p.error('The anomaly factor must be greater than zero')
+    if opts.anomalyMinRuns < 1:
+        p.error('The anomaly minimum runs must be at least 1')
+    if opts.maxRunning < 0:
+        p.error('The maximum number of running commands cannot be negative')
+    if opts.slotWait < 0:
+        p.error('The slot wait cannot be negative')
     if opts.fuzz < 0:
         p.error('The fuzz time must be a positive integer, or zero to '
             'disable it')
-    if not cmdList:
+    if opts.flushInterval <= 0:
+        p.error('The flush interval must be greater than zero')
+    if opts.concurrency < 1:
+        p.error('The concurrency must be at least 1')
+    if opts.batch and cmdList:
+        p.error('You cannot specify a command with --batch')
+    if opts.metricsDir and not os.path.isdir(opts.metricsDir):
+        p.error('The metrics directory, %s, does not exist' %
+            opts.metricsDir)
+    opts.notifiers = []
+    for spec in opts.notify:
+        try:
+            opts.notifiers.append(parseNotifySpec(spec))
+        except ValueError as e:
+            p.error('Invalid notifier, "%s": %s' % (spec, e))
+    if opts.smtpTimeout < 0:
+        p.error('The SMTP timeout must be a positive number, or zero to '
+            'disable it')
+    if opts.mailRetries < 0:
+        p.error('Number of mail retries can not be less than 0')
+    if opts.mailRetryDelay < 0:
+        p.error('The mail retry delay cannot be negative')
+    if opts.spoolDir and not os.path.isdir(opts.spoolDir):
+        p.error('The spool directory, %s, does not exist' % opts.spoolDir)
+    if opts.flushSpool:
+        if not opts.spoolDir:
+            p.error('You must specify a spool directory to flush')
+        opts.mail = True
+    if opts.inspect and not cmdList:
+        p.error('You must specify the command of the job to inspect')
+    if not cmdList and not (opts.daemon or opts.batch or opts.metrics or
+            opts.status or
+            opts.flushSpool):
         p.error('You must specify a command to be executed')
 
     handleEmailOpts(p, opts)
 
+    if cmdList and opts.configCache and not opts.inspect:
+        cache.save(opts, cmdList, fac, pri)
     return (opts, cmdList)
 
 def sigHandler(frame, num):
     global STATEFILE
-    STATEFILE.close()
+    if COMSTATE is not None:
+        # Stop the command as well, so that whoever signaled us, such as a
+        # run with "--overlap replace", can take over from a clean slate
+        COMSTATE.terminate()
+    if STATEFILE is not None:
+        STATEFILE.close()
     sys.exit(0)
 
 def log(msg):
     syslog.syslog(LOGPRI, msg)
 
+def closeSyslog():
+    try:
+        syslog.closelog()
+    except:
+        pass
+
+def splitSimpleCommand(cmd):
+    """
+    Splits a "--single-string" command into its argv if it is a simple
+    command which doesn't need the shell: no quoting, expansions,
+    redirections, pipes, lists or variable assignments, and not a shell
+    builtin or keyword.  Otherwise, None is returned.
+    """
+    if not SHELL_SAFE_CHARS.issuperset(cmd):
+        return None
+    argv = cmd.split()
+    if not argv or argv[0] in SHELL_BUILTINS:
+        return None
+    return argv
+
+def findExecutable(name, path):
+    """
+    Returns the full path of the executable, searching the path like exec
+    does if it doesn't contain a "/", or None if it isn't found or exec
+    can't run it.  Only binaries and scripts with a "#!" line are returned,
+    the shell runs other executable files as shell scripts itself.
+    """
+    if '/' in name:
+        paths = [name]
+    else:
+        paths = [os.path.join(d or '.', name) for d in path.split(':')]
+    for p in paths:
+        if os.access(p, os.X_OK) and not os.path.isdir(p):
+            try:
+                with open(p, 'rb') as fh:
+                    head = fh.read(4)
+            except OSError:
+                return None
+            if head == b'\x7fELF' or head.startswith(b'#!'):
+                return p
+            return None
+    return None
+
 def findInPath(opts, binary):
     """
     Searches the user's PATH for binary and returns the full path to it
@@ -815,16 +4871,164 @@ def findInPath(opts, binary):
             return p
     return None
 
+def runBatch(opts):
+    """
+    Runs all the commands in the batch file concurrently, with at most
+    opts.concurrency of them running at once
+    """
+    if opts.batch == '-':
+        lines = sys.stdin.read().splitlines()
+    else:
+        with open(opts.batch) as fh:
+            lines = fh.read().splitlines()
+    import shlex
+    cmds = []
+    for line in lines:
+        line = line.strip()
+        if not line or line.startswith('#'):
+            continue
+        if opts.singStr:
+            cmds.append([line])
+        else:
+            cmds.append(shlex.split(line))
+    import asyncio
+    asyncio.run(_runBatch(opts, cmds))
+
+async def _runBatch(opts, cmds):
+    import asyncio
+    sem = asyncio.Semaphore(opts.concurrency)
+
+    async def runOne(cmdList):
+        stFh = comSt = None
+        stFName = StateFile.getStateFileName(opts, cmdList)
+        queued = True
+        while queued:
+            async with sem:
+                if stFh is None:
+                    # Getting the state file may sleep for retries, so it's
+                    # done in a thread to not block the loop
+                    try:
+                        stFh = await asyncio.to_thread(
+                            StateFile.getStateFile, opts, cmdList, True)
+                    except OverlapError:
+                        return
+                    except FileCreationError as e:
+                        if not opts.ignoreRetFail:
+                            print(e, file=sys.stderr)
+                        return
+                out = BytesIO()
+                err = BytesIO()
+                queued = False
+                # The state is loaded, saved and unlocked in threads too, as
+                # it blocks on the disk or on the state database
+                try:
+                    if comSt is None:
+                        comSt = await asyncio.to_thread(stFh.getObject)
+                        if not comSt:
+                            comSt = CommandState(opts, cmdList)
+                        comSt.opts = opts
+                    await comSt.runAsync(out, err)
+                    comSt.cleanup()
+                    comSt.addOverlaps(takeOverlaps(stFName))
+                    await asyncio.to_thread(stFh.saveObject, comSt)
+                    # The run queued by the runs which overlapped this one
+                    # is done without letting go of the lock, see main()
+                    queued = takeQueuedRun(opts, stFName)
+                finally:
+                    if not queued:
+                        await asyncio.to_thread(stFh.close)
+                writeMetricsFile(opts, stFName, comSt)
+                # Write out the output of each command as a whole so the
+                # output of concurrent commands isn't interleaved
+                sys.stdout.buffer.write(out.getvalue())
+                sys.stdout.buffer.flush()
+                sys.stderr.buffer.write(err.getvalue())
+                sys.stderr.buffer.flush()
+            # Send the notifications outside of the semaphore so a slow
+            # server doesn't hold up the other commands
+            await asyncio.to_thread(comSt.deliverNotifications, False)
+
+    await asyncio.gather(*[runOne(c) for c in cmds])
+
+def runClient(argv):
+    """
+    Sends the command line to a cwrap daemon and writes out its response.
+    The first item in argv is the --socket option.
+
+        returns -> <int>:   The exit code, or None if the daemon can't be
+                            reached
+    """
+    if argv[0] == '--socket':
+        sockPath = argv[1]
+        argv = argv[2:]
+    else:
+        sockPath = argv[0].split('=', 1)[1]
+        argv = argv[1:]
+    import json
+    import socket
+    req = json.dumps({'argv': argv, 'env': dict(os.environ),
+        'cwd': os.getcwd()})
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        sock.connect(sockPath)
+    except OSError as e:
+        print('Could not connect to the cwrap daemon at %s, running the '
+            'command locally: %s' % (sockPath, e), file=sys.stderr)
+        sock.close()
+        return None
+    with sock:
+        sock.sendall(req.encode('utf-8') + b'\n')
+        fh = sock.makefile('rb')
+        resp = json.loads(fh.readline().decode('utf-8'))
+        sys.stdout.buffer.write(fh.read(resp['stdoutLen']))
+        sys.stderr.buffer.write(fh.read(resp['stderrLen']))
+    return resp['rc']
+
 def main():
-    global STATEFILE
+    global STATEFILE, COMSTATE
+    if len(sys.argv) > 2 and sys.argv[1].startswith('--socket'):
+        rc = runClient(sys.argv[1:])
+        if rc is not None:
+            sys.exit(rc)
+        del sys.argv[1:2 if '=' in sys.argv[1] else 3]
     opts, cmdList = getOpts()
+    if opts.daemon:
+        try:
+            CwrapDaemon(opts).serve()
+        except DaemonError as e:
+            print(e, file=sys.stderr)
+            sys.exit(E_FC)
+        return
     oldPath = os.environ['PATH']
     if oldPath != opts.PATH:
         os.environ['PATH'] = opts.PATH
+    if opts.batch:
+        runBatch(opts)
+        os.environ['PATH'] = oldPath
+        closeSyslog()
+        return
+    if opts.metrics:
+        dumpMetrics(opts)
+        return
+    if opts.status:
+        printStatus(opts)
+        return
+    if opts.inspect:
+        sys.exit(inspectJob(opts, cmdList))
+    if opts.flushSpool:
+        MailSpool(opts.spoolDir).flush(opts)
+        return
     stFName = StateFile.getStateFileName(opts, cmdList)
+    # Set the signal handlers
+    signal.signal(signal.SIGINT, sigHandler)
+    signal.signal(signal.SIGHUP, sigHandler)
+    signal.signal(signal.SIGTERM, sigHandler)
     stFh = None
     try:
-        stFh = StateFile.getStateFile(opts, cmdList)
+        stFh = StateFile.getStateFile(opts, cmdList, True)
+    except OverlapError:
+        # Skipped, or queued for the previous run to do
+        sys.exit(0)
     except FileCreationError as e:
         if opts.debug:
             import traceback; traceback.print_exc()
@@ -837,25 +5041,31 @@ def main():
             print(e, file=sys.stderr)
             sys.exit(E_FC)
     STATEFILE = stFh
-    # Set the signal handlers
-    signal.signal(signal.SIGINT, sigHandler)
-    signal.signal(signal.SIGHUP, sigHandler)
-    signal.signal(signal.SIGTERM, sigHandler)
     # Either get the command state from a previous run or create it
     comSt = stFh.getObject()
     if not comSt:
         comSt = CommandState(opts, cmdList)
     # Set any new command line opts
     comSt.opts = opts
-    comSt.run()
-    comSt.cleanup()
-    stFh.saveObject(comSt)
-    stFh.close()
+    COMSTATE = comSt
+    queued = True
+    while queued:
+        comSt.run()
+        comSt.cleanup()
+        comSt.addOverlaps(takeOverlaps(stFName))
+        stFh.saveObject(comSt)
+        # Do the run queued by the runs which overlapped this one.  The
+        # request is taken, and the run done, without letting go of the
+        # lock, so it can't race with a new run taking the lock and the
+        # request itself.
+        queued = takeQueuedRun(opts, stFName)
+        if not queued:
+            STATEFILE = COMSTATE = None
+            stFh.close()
+        writeMetricsFile(opts, stFName, comSt)
+        comSt.deliverNotifications()
     os.environ['PATH'] = oldPath
-    try:
-        syslog.closelog()
-    except:
-        pass
+    closeSyslog()
 
 if __name__ == '__main__':
     main()
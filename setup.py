@@ -11,6 +11,9 @@ setup(name='cron-wrap' ,
     long_description='Full documentation can be found in the man page or here: '
         'http://stuffivelearned.org/doku.php?id=programming:python:cwrap' ,
     scripts=['cwrap.py'] ,
+    # Also installed as a module so "python3 -m cwrap" can use the cached
+    # bytecode instead of compiling the script on every run
+    py_modules=['cwrap'] ,
     data_files = [ ('man/man1' , ['cwrap.py.1']) ] ,
     classifiers=[
         'Development Status :: 5 - Production/Stable' ,